@@ -36,10 +36,14 @@ setup(
     tests_require=tests_require,
     extras_require=dict(
         test=tests_require,
+        trace=['numpy'],
+        sweep=['scandir'],
     ),
     entry_points={
       'console_scripts': [
           'relstorage_pack = relstorage_packer.refcount:run',
+          'relstorage_pack_benchmark = relstorage_packer.benchmark:run',
+          'relstorage_blob_sweep = relstorage_packer.sweep:run',
       ],
     },
 )
@@ -0,0 +1,548 @@
+"""relstorage_packer - synthetic object graphs and an end-to-end benchmark
+
+Fills an empty RelStorage with a seeded synthetic tree of objects, packs it
+in init mode, turns part of it into garbage and packs again in update mode.
+Each pack runs in its own process, its statistics are read from
+``packer_state``. The result is written as JSON, runs with the same
+parameters are comparable between versions.
+
+Never run this against a database with data you want to keep!
+"""
+from .scanner import micro_benchmark
+from .state import get_state
+from .utils import get_conn_and_cursor
+from .utils import get_storage
+from ZODB.DB import DB
+from ZODB.utils import u64
+from persistent import Persistent
+import json
+import logging
+import optparse
+import os
+import pkg_resources
+import random
+import re
+import subprocess
+import sys
+import time
+import transaction
+
+FORMAT_VERSION = 1
+OBJECTS = 10000
+FANOUT = 5
+PAYLOAD_SIZE = 100
+TXN_SIZE = 100
+GARBAGE_RATIO = 0.1
+CYCLE_SHARE = 0.2
+BLOB_SHARE = 0.0
+BLOB_SIZE = 10000
+
+log = logging.getLogger("pack.benchmark")
+
+################################################################################
+# Synthetic graph
+
+class Node(Persistent):
+    """an object of the synthetic graph"""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.children = []
+        self.back = None
+        self.blob = None
+
+    def add(self, child):
+        self.children.append(child)
+        self._p_changed = True
+
+    def remove(self, child):
+        self.children.remove(child)
+        self._p_changed = True
+
+
+class TransactionSizes(object):
+    """draws the number of changes per transaction from a distribution"""
+
+    def __init__(self, rand, mean, distribution):
+        self.rand = rand
+        self.mean = mean
+        self.distribution = distribution
+
+    def next(self):
+        if self.distribution == 'exponential':
+            size = self.rand.expovariate(1.0 / self.mean)
+        elif self.distribution == 'pareto':
+            # alpha 1.5, heavy tail with the given mean
+            size = self.rand.paretovariate(1.5) * self.mean / 3.0
+        else:
+            size = self.mean
+        return max(int(size), 1)
+
+
+class Committer(object):
+    """commits after a drawn number of changes and counts transactions"""
+
+    def __init__(self, conn, sizes):
+        self.conn = conn
+        self.sizes = sizes
+        self.pending = 0
+        self.due = sizes.next()
+        self.transactions = 0
+
+    def changed(self, num=1):
+        self.pending += num
+        if self.pending >= self.due:
+            self.commit()
+
+    def commit(self):
+        if not self.pending:
+            return
+        transaction.commit()
+        self.conn.cacheMinimize()
+        self.transactions += 1
+        self.pending = 0
+        self.due = self.sizes.next()
+
+
+def generate(db, rand, options):
+    """add a tree of options.objects nodes below the root
+
+    node i is a child of node (i - 1) // fanout, so parents always come
+    first. returns their oids and the number of transactions.
+    """
+    conn = db.open()
+    committer = Committer(
+        conn,
+        TransactionSizes(rand, options.txn_size, options.txn_dist)
+    )
+    blobs = options.blob_share > 0
+    if blobs and db.storage.blobhelper is None:
+        log.warning('Storage has no blob directory, no blobs are created')
+        blobs = False
+    if blobs:
+        from ZODB.blob import Blob
+    nodes = []
+    for idx in xrange(options.objects):
+        node = Node(os.urandom(options.payload_size))
+        if blobs and rand.random() < options.blob_share:
+            node.blob = Blob()
+            with node.blob.open('w') as blobfile:
+                blobfile.write(os.urandom(options.blob_size))
+        if idx:
+            nodes[(idx - 1) // options.fanout].add(node)
+        else:
+            conn.root()['benchmark'] = node
+        nodes.append(node)
+        committer.changed()
+    committer.commit()
+    oids = [each._p_oid for each in nodes]
+    conn.close()
+    return oids, committer.transactions
+
+
+class SyntheticGraph(object):
+    """final shape of the synthetic tree after the mutation
+
+    node i is a child of node (i - 1) // fanout unless i is detached, back
+    maps a first child to the node it references back. zoids gives the order
+    of the nodes in the database, by default their index.
+    """
+
+    def __init__(self, num, fanout, detached=(), back=None, zoids=None):
+        self.num = num
+        self.fanout = fanout
+        self.detached = set(detached)
+        self.back = dict(back or {})
+        self.zoids = zoids if zoids is not None else range(num)
+        self.inrefs = [[] for idx in xrange(num)]
+        for idx in xrange(num):
+            for ref in self.refs(idx):
+                self.inrefs[ref].append(idx)
+
+    def parent(self, idx):
+        return (idx - 1) // self.fanout
+
+    def refs(self, idx):
+        """the nodes idx references"""
+        first = idx * self.fanout + 1
+        refs = [
+            child for child in xrange(first, min(first + self.fanout,
+                                                  self.num))
+            if child not in self.detached
+        ]
+        if idx in self.back:
+            refs.append(self.back[idx])
+        return refs
+
+    def unreachable(self):
+        """the nodes not reachable from the root node 0"""
+        reached = set([0])
+        pending = [0]
+        while pending:
+            for ref in self.refs(pending.pop()):
+                if ref not in reached:
+                    reached.add(ref)
+                    pending.append(ref)
+        return set(xrange(self.num)) - reached
+
+    def refcounted(self, garbage, removed=()):
+        """the garbage reference counting removes once removed is gone:
+        nodes without incoming references, cascading
+        """
+        removed = set(removed)
+        numinrefs = {}
+        for idx in garbage - removed:
+            numinrefs[idx] = len(
+                [ref for ref in self.inrefs[idx] if ref not in removed]
+            )
+        orphans = [idx for idx, num in numinrefs.items() if not num]
+        gone = set()
+        while orphans:
+            idx = orphans.pop()
+            gone.add(idx)
+            for ref in self.refs(idx):
+                if ref in numinrefs and ref not in gone:
+                    numinrefs[ref] -= 1
+                    if not numinrefs[ref]:
+                        orphans.append(ref)
+        return gone
+
+    def candidates(self):
+        """the cycle candidates recorded by the analysis of the update,
+        detached nodes still referenced back, in the order of their zoids
+        """
+        found = set(self.back.values()) & self.detached
+        return sorted(found, key=lambda idx: self.zoids[idx])
+
+    def collected(self, garbage, max_candidates):
+        """the nodes removed by the trial deletion of the first
+        max_candidates candidates, as collect_cycles does
+        """
+        removed = set()
+        for idx in self.candidates()[:max_candidates]:
+            if idx in removed:
+                continue
+            members = set([idx])
+            pending = [idx]
+            while pending and members is not None:
+                for ref in self.inrefs[pending.pop()]:
+                    if ref in removed or ref in members:
+                        continue
+                    if ref not in garbage:
+                        members = None
+                        break
+                    members.add(ref)
+                    pending.append(ref)
+            if members is not None:
+                removed.update(members)
+        return removed
+
+    def expected_removed(self, mode='refcount', max_candidates=0):
+        """number of objects an update run in mode removes
+
+        trace mode removes all garbage. reference counting removes the
+        garbage not kept alive by a cycle, with max_candidates > 0 after the
+        collection of the cycles at the first candidates. candidates
+        recorded during the removal are left to the next run.
+        """
+        garbage = self.unreachable()
+        if mode == 'trace':
+            return len(garbage)
+        removed = set()
+        if max_candidates > 0:
+            removed = self.collected(garbage, max_candidates)
+        return len(removed | self.refcounted(garbage, removed))
+
+
+def detach(rand, num, options):
+    """draw the subtrees to detach, some of them with a reference cycle
+
+    returns the detached nodes and the back references of first children.
+    """
+    detached = []
+    back = {}
+    for idx in rand.sample(xrange(1, num), int((num - 1) * options.garbage)):
+        child_idx = idx * options.fanout + 1
+        if child_idx < num and rand.random() < options.cycle_share:
+            # the first child points back
+            back[child_idx] = idx
+        detached.append(idx)
+    return detached, back
+
+
+def mutate(db, rand, oids, options):
+    """detach random subtrees, some of them with a reference cycle
+
+    returns the number of transactions and the final SyntheticGraph.
+    """
+    conn = db.open()
+    committer = Committer(
+        conn,
+        TransactionSizes(rand, options.txn_size, options.txn_dist)
+    )
+    num = len(oids)
+    detached, back = detach(rand, num, options)
+    backrefs = dict((idx, child_idx) for child_idx, idx in back.items())
+    for idx in detached:
+        node = conn.get(oids[idx])
+        if idx in backrefs:
+            conn.get(oids[backrefs[idx]]).back = node
+        conn.get(oids[(idx - 1) // options.fanout]).remove(node)
+        committer.changed(2)
+    committer.commit()
+    conn.close()
+    graph = SyntheticGraph(
+        num,
+        options.fanout,
+        detached,
+        back,
+        [u64(oid) for oid in oids]
+    )
+    return committer.transactions, graph
+
+################################################################################
+# Packing
+
+def pack(config_file, args):
+    """run relstorage_pack in a child process
+
+    returns wall clock seconds and peak RSS in kB of the child.
+    """
+    code = 'from relstorage_packer.refcount import run; run()'
+    cmd = [sys.executable, '-c', code] + args + [config_file]
+    log.info('Run %s' % ' '.join(args + [config_file]))
+    start = time.time()
+    child = subprocess.Popen(cmd)
+    dummy, status, usage = os.wait4(child.pid, 0)
+    secs = time.time() - start
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
+        raise RuntimeError('relstorage_pack failed with status %d' % status)
+    return secs, usage.ru_maxrss
+
+
+def _rate(num, secs):
+    if not secs:
+        return None
+    return num / secs
+
+
+def pack_phase(storage, config_file, args):
+    """pack and return the metrics of the run"""
+    secs, peak_rss = pack(config_file, args)
+    connection, cursor = get_conn_and_cursor(storage)
+    try:
+        stats = get_state(cursor)['stats'] or {}
+    finally:
+        connection.rollback()
+        connection.close()
+    analysis_secs = stats.get('analysis_secs', 0)
+    cleanup_secs = stats.get('cleanup_secs', 0)
+    return {
+        'secs': secs,
+        'peak_rss_kb': peak_rss,
+        'analysis_secs': analysis_secs,
+        'cleanup_secs': cleanup_secs,
+        'processed_tids': stats.get('processed_tids', 0),
+        'processed_zoids': stats.get('processed_zoids', 0),
+        'processed_refs': stats.get('processed_refs', 0),
+        'removed': stats.get('removed', 0),
+        'stopped': stats.get('stopped', False),
+        'tids_per_sec': _rate(stats.get('processed_tids', 0), analysis_secs),
+        'zoids_per_sec': _rate(stats.get('processed_zoids', 0), analysis_secs),
+        'refs_per_sec': _rate(stats.get('processed_refs', 0), analysis_secs),
+        'orphans_per_sec': _rate(stats.get('removed', 0), cleanup_secs),
+    }
+
+
+def pack_mode(pack_options):
+    """mode and number of cycle candidates of the pack options"""
+    args = ' '.join(pack_options)
+    mode = 'refcount'
+    if re.search(r'(--mode[= ]?|-m ?)trace\b', args):
+        mode = 'trace'
+    max_candidates = 0
+    match = re.search(r'--collect-cycles[= ]?(\d+)', args)
+    if match:
+        max_candidates = int(match.group(1))
+    return mode, max_candidates
+
+
+def server_version(storage):
+    connection, cursor = get_conn_and_cursor(storage)
+    try:
+        cursor.execute("SHOW server_version;")
+        return cursor.fetchone()[0]
+    finally:
+        connection.rollback()
+        connection.close()
+
+def write_result(result, path=None):
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as outfile:
+            outfile.write(output + '\n')
+    else:
+        print output
+
+################################################################################
+# Main Runner
+
+def run(argv=sys.argv):
+    parser = optparse.OptionParser(
+        description='Benchmark relstorage_pack on a synthetic object graph. '
+                    'Needs an empty database, all data in it is lost!',
+        usage="%prog config_file | %prog --scanner"
+    )
+    parser.add_option(
+        "--zap", dest="zap", default=False, action="store_true",
+        help="Remove all data of the storage first, required.",
+    )
+    parser.add_option(
+        "-n", "--objects", dest="objects", default=OBJECTS, type="int",
+        help="Number of objects (default: %d)." % OBJECTS,
+    )
+    parser.add_option(
+        "--fanout", dest="fanout", default=FANOUT, type="int",
+        help="Number of children per object (default: %d)." % FANOUT,
+    )
+    parser.add_option(
+        "--payload-size", dest="payload_size", default=PAYLOAD_SIZE,
+        type="int",
+        help="Bytes of random payload per object (default: %d)." %
+             PAYLOAD_SIZE,
+    )
+    parser.add_option(
+        "--txn-size", dest="txn_size", default=TXN_SIZE, type="int",
+        help="Mean number of changed objects per transaction "
+             "(default: %d)." % TXN_SIZE,
+    )
+    parser.add_option(
+        "--txn-dist", dest="txn_dist", default="fixed", type="choice",
+        choices=["fixed", "exponential", "pareto"],
+        help="Distribution of transaction sizes: fixed, exponential or "
+             "pareto (default: fixed).",
+    )
+    parser.add_option(
+        "--garbage", dest="garbage", default=GARBAGE_RATIO, type="float",
+        help="Share of objects detached from their parent before the update "
+             "run, their subtrees become garbage (default: %s)." %
+             GARBAGE_RATIO,
+    )
+    parser.add_option(
+        "--cycle-share", dest="cycle_share", default=CYCLE_SHARE,
+        type="float",
+        help="Share of detached objects whose first child references them "
+             "back (default: %s)." % CYCLE_SHARE,
+    )
+    parser.add_option(
+        "--blob-share", dest="blob_share", default=BLOB_SHARE, type="float",
+        help="Share of objects with a blob (default: %s)." % BLOB_SHARE,
+    )
+    parser.add_option(
+        "--blob-size", dest="blob_size", default=BLOB_SIZE, type="int",
+        help="Bytes per blob (default: %d)." % BLOB_SIZE,
+    )
+    parser.add_option(
+        "--seed", dest="seed", default=0, type="int",
+        help="Seed of the random generator (default: 0).",
+    )
+    parser.add_option(
+        "--pack-option", dest="pack_options", default=[], action="append",
+        metavar="OPTION",
+        help="Option passed to relstorage_pack, repeatable, "
+             "e.g. --pack-option=--jobs=4.",
+    )
+    parser.add_option(
+        "--scanner", dest="scanner", default=False, action="store_true",
+        help="Only run the micro-benchmark of reference extraction against "
+             "referencesf, needs no database.",
+    )
+    parser.add_option(
+        "-o", "--output", dest="output", default=None,
+        help="Write the JSON result to this file (default: stdout).",
+    )
+    options, args = parser.parse_args(argv[1:])
+    if options.scanner:
+        log.info('Benchmark reference extraction.')
+        result = micro_benchmark()
+        result['format'] = FORMAT_VERSION
+        result['version'] = pkg_resources.get_distribution(
+            'relstorage_packer'
+        ).version
+        write_result(result, options.output)
+        return
+    if len(args) != 1:
+        parser.error("The name of one configuration file is required.")
+    if not options.zap:
+        parser.error("All data of the storage is removed, confirm with --zap.")
+    if options.objects < 2 or options.fanout < 1 or options.txn_size < 1:
+        parser.error("Objects, fan-out and transaction size are too small.")
+    for share in (options.garbage, options.cycle_share, options.blob_share):
+        if not 0 <= share <= 1:
+            parser.error("Shares must be between 0 and 1.")
+    config_file = args[0]
+    rand = random.Random(options.seed)
+    result = {
+        'format': FORMAT_VERSION,
+        'version': pkg_resources.get_distribution('relstorage_packer').version,
+        'python': sys.version.split()[0],
+        'parameters': dict(
+            (name, getattr(options, name)) for name in (
+                'objects', 'fanout', 'payload_size', 'txn_size', 'txn_dist',
+                'garbage', 'cycle_share', 'blob_share', 'blob_size', 'seed',
+                'pack_options',
+            )
+        ),
+        'phases': {},
+    }
+    phases = result['phases']
+
+    storage = get_storage(config_file)
+    result['postgresql'] = server_version(storage)
+    storage.zap_all()
+    db = DB(storage)
+    try:
+        log.info('Generate %d objects.' % options.objects)
+        start = time.time()
+        oids, transactions = generate(db, rand, options)
+        phases['generate'] = {
+            'secs': time.time() - start,
+            'objects': len(oids),
+            'transactions': transactions,
+        }
+        phases['init'] = pack_phase(
+            storage,
+            config_file,
+            ['--init', '--restart'] + options.pack_options
+        )
+
+        log.info('Detach subtrees.')
+        start = time.time()
+        transactions, graph = mutate(db, rand, oids, options)
+        garbage = graph.unreachable()
+        phases['mutate'] = {
+            'secs': time.time() - start,
+            'transactions': transactions,
+            'garbage': len(garbage),
+            'cyclic_garbage': len(garbage - graph.refcounted(garbage)),
+        }
+        phases['update'] = pack_phase(
+            storage,
+            config_file,
+            options.pack_options
+        )
+    finally:
+        db.close()
+
+    update = phases['update']
+    mode, max_candidates = pack_mode(options.pack_options)
+    update['expected_removed'] = graph.expected_removed(mode, max_candidates)
+    write_result(result, options.output)
+    if update['stopped']:
+        log.warning('Update run stopped early, removals are not verified.')
+    elif update['removed'] != update['expected_removed']:
+        log.error(
+            'Update run removed %d objects, expected %d.' %
+            (update['removed'], update['expected_removed'])
+        )
+        sys.exit(1)
@@ -0,0 +1,265 @@
+"""relstorage_packer - asynchronous removal of blobs of removed objects"""
+from .metrics import metrics
+from .utils import get_conn_and_cursor
+from ZODB.utils import p64
+import Queue
+import errno
+import logging
+import os
+import shutil
+import threading
+
+THREADS = 4
+QUEUE_FACTOR = 100
+CHECK_SIZE = 10000
+JOURNAL_NAME = '.relstorage_packer_journal'
+
+log = logging.getLogger("pack.blobs")
+
+
+def prune_empty_dirs(base_dir, path):
+    """remove empty parent directories of path bottom-up below base_dir
+
+    stops at the first directory not empty or gone. a live site may be about
+    to store a blob in a directory just removed, so this is opt-in.
+    """
+    base_dir = os.path.abspath(base_dir)
+    path = os.path.dirname(os.path.abspath(path))
+    while path.startswith(base_dir + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError, e:
+            if e.errno in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                return
+            raise
+        log.debug('-> Removed empty directory %s' % path)
+        path = os.path.dirname(path)
+
+
+def tree_size(path):
+    """size in bytes of all files below path"""
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def missing_zoids(cursor, zoids):
+    """the zoids without a row in object_state, one anti-join"""
+    stmt = """
+    SELECT z.zoid
+    FROM unnest(%(zoids)s::bigint[]) AS z(zoid)
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM object_state s
+        WHERE s.zoid = z.zoid
+    )
+    ORDER BY z.zoid;
+    """
+    cursor.execute(stmt, {'zoids': zoids})
+    missing = [zoid for (zoid,) in cursor]
+    cursor.connection.rollback()
+    return missing
+
+
+def remove_blob(fshelper, zoid, prune=False):
+    """remove the blob directory of zoid, with prune its empty parents too
+
+    returns the number of bytes removed.
+    """
+    blobpath = fshelper.getPathForOID(p64(zoid))
+    log.debug('-> Blobs for zoid=%s are at %s' % (zoid, blobpath))
+    if not os.path.exists(blobpath):
+        log.debug('-> No Blobs to remove')
+        return 0
+    log.debug('-> Remove Blobs')
+    size = tree_size(blobpath)
+    shutil.rmtree(blobpath)
+    if prune:
+        prune_empty_dirs(fshelper.base_dir, blobpath)
+    return size
+
+
+class BlobRemover(object):
+    """removes blobs of removed zoids in a bounded pool of threads
+
+    zoids are appended to a journal in the blob directory before their
+    removal from the database is committed and queued after the commit.
+    whenever the queue runs empty the journal is cut down to the zoids
+    journaled but not queued yet, so it does not grow over a run. it is
+    removed once all queued blobs are removed without errors. a journal left
+    over by a crashed run is processed on start, blobs of the zoids still in
+    object_state (their transaction was rolled back) are kept. so no pending
+    removal gets lost.
+
+    with a throttle the removed bytes per second are limited, with prune
+    empty parent directories of removed blobs are removed.
+    """
+
+    def __init__(self, storage, threads=THREADS, throttle=None, prune=False):
+        self.fshelper = None
+        self.throttle = throttle
+        self.prune = prune
+        if storage.blobhelper is None:
+            log.debug('No blobstorage available')
+            return
+        self.fshelper = storage.blobhelper.fshelper
+        self.journal_path = os.path.join(
+            self.fshelper.base_dir,
+            JOURNAL_NAME
+        )
+        self.errors = 0
+        # zoids journaled and not queued yet, number of queued zoids
+        self.unqueued = set()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(maxsize=threads * QUEUE_FACTOR)
+        self.threads = []
+        for idx in range(threads):
+            thread = threading.Thread(
+                target=self._work,
+                name='blobremover-%d' % idx
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        # opened on first use, a remover without removals (e.g. of a
+        # follower) leaves the journal of others alone
+        self.journal_file = None
+        self.owns_journal = os.path.exists(self.journal_path)
+        if self.owns_journal:
+            self._replay(storage)
+
+    def _read_journal(self):
+        """iterate over sorted batches of up to CHECK_SIZE journaled zoids"""
+        with open(self.journal_path) as journal:
+            batch = set()
+            for line in journal:
+                if not line.strip():
+                    continue
+                batch.add(int(line))
+                if len(batch) >= CHECK_SIZE:
+                    yield sorted(batch)
+                    batch = set()
+            if batch:
+                yield sorted(batch)
+
+    def _replay(self, storage):
+        """queue the journaled zoids of a prior run removed from the
+        database
+        """
+        connection, cursor = get_conn_and_cursor(storage)
+        journaled = 0
+        removed = 0
+        try:
+            for batch in self._read_journal():
+                missing = missing_zoids(cursor, batch)
+                journaled += len(batch)
+                removed += len(missing)
+                with self.lock:
+                    self.pending += len(missing)
+                for zoid in missing:
+                    self.queue.put(zoid)
+        finally:
+            connection.close()
+        log.info(
+            'Remove %d of %d blobs journaled by a prior run' %
+            (removed, journaled)
+        )
+
+    def _drained(self):
+        """one queued zoid is done, cut the journal down once none is left
+        """
+        with self.lock:
+            self.pending -= 1
+            if self.pending or self.errors or self.journal_file is None:
+                return
+            self.journal_file.seek(0)
+            self.journal_file.truncate()
+            self.journal_file.write(
+                ''.join(['%d\n' % zoid for zoid in sorted(self.unqueued)])
+            )
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def _work(self):
+        while True:
+            zoid = self.queue.get()
+            try:
+                if zoid is None:
+                    return
+                size = remove_blob(self.fshelper, zoid, self.prune)
+                if size:
+                    metrics.inc('removed_blobs_total')
+                    metrics.inc('blob_bytes_freed_total', size)
+                if self.throttle is not None:
+                    self.throttle.blob_removed(size)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                log.exception('Failed to remove blobs for zoid=%s' % zoid)
+            finally:
+                if zoid is not None:
+                    try:
+                        self._drained()
+                    except Exception:
+                        log.exception('Failed to cut down the journal')
+                self.queue.task_done()
+
+    def journal(self, zoids):
+        """append zoids to the journal, call before the commit of their
+        removal. thread safe
+        """
+        if self.fshelper is None or not zoids:
+            return
+        with self.lock:
+            if self.journal_file is None:
+                self.journal_file = open(self.journal_path, 'a')
+                self.owns_journal = True
+            self.unqueued.update(zoids)
+            self.journal_file.write(
+                ''.join(['%d\n' % zoid for zoid in zoids])
+            )
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def remove(self, zoids):
+        """queue removal of the blobs of journaled zoids, call after the
+        commit of their removal. thread safe
+        """
+        if self.fshelper is None or not zoids:
+            return
+        with self.lock:
+            self.unqueued.difference_update(zoids)
+            self.pending += len(zoids)
+        for zoid in zoids:
+            self.queue.put(zoid)
+
+    def close(self, remove_journal=True):
+        """wait for all queued removals, remove the journal if all went well
+
+        without remove_journal (the packer lock is not held) the journal is
+        left to the run holding the lock.
+        """
+        if self.fshelper is None:
+            return
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.journal_file is not None:
+            self.journal_file.close()
+        if self.errors:
+            log.error(
+                '%d blob removals failed, journal %s is kept for the next '
+                'run' % (self.errors, self.journal_path)
+            )
+            return
+        if not (self.owns_journal and remove_journal):
+            return
+        try:
+            os.remove(self.journal_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,304 @@
+"""relstorage_packer - bulk load of the inverse object graph for an initial run"""
+from .distributed import UNIT_INIT
+from .distributed import clear_units
+from .distributed import coordinate
+from .metrics import metrics
+from .reader import StateReader
+from .schema import create_indexes
+from .schema import create_tables
+from .schema import drop_tables
+from .serverrefs import load_range
+from .serverrefs import local_edges
+from .serverrefs import range_end
+from .state import INIT_PHASES
+from .state import PHASE_ANALYZE
+from .state import PHASE_INIT_BUILD
+from .state import PHASE_INIT_LOAD
+from .state import get_state
+from .state import set_state
+from .utils import copy_rows
+from .utils import table_exists
+from .utils import timed_commit
+import logging
+import time
+
+COPY_SIZE = 10000
+LOG_INTERVAL_SECS = 5
+LOAD_COLUMNS = ('zoid', 'inref', 'tid')
+CHECKPOINT_INTERVAL_SECS = 60
+STATES_STMT = """
+SELECT zoid, tid, state
+FROM object_state
+WHERE zoid > %d
+ORDER BY zoid;
+"""
+
+log = logging.getLogger("pack.bulkinit")
+
+################################################################################
+# Load table
+
+def _create_load_table(cursor):
+    log.info("Create unlogged table object_inrefs_load (drop existing).")
+    stmt = """
+    DROP TABLE IF EXISTS object_inrefs_load;
+    CREATE UNLOGGED TABLE object_inrefs_load (
+        zoid       BIGINT NOT NULL,
+        inref      BIGINT NOT NULL,
+        tid        BIGINT NOT NULL
+    );
+    """
+    cursor.execute(stmt)
+
+
+def _load_table_filled(cursor):
+    """whether the load table exists and still has the row of the root
+    written at the start of the load.
+
+    an unlogged table is truncated after a crash of the database server.
+    """
+    if not table_exists(cursor, 'object_inrefs_load'):
+        return False
+    stmt = """
+    SELECT 1
+    FROM object_inrefs_load
+    WHERE zoid = 0
+    AND inref = -1
+    LIMIT 1;
+    """
+    cursor.execute(stmt)
+    return bool(cursor.rowcount)
+
+
+def _load_edges(connection, cursor, reader, extractor):
+    """stream object_state ordered by zoid and COPY all edges into the load
+    table
+
+    rows are (zoid, inref, tid): either an edge with inref as incoming
+    reference on zoid or zoid == inref for each object in object_state.
+
+    about every CHECKPOINT_INTERVAL_SECS the load is committed together with
+    the last loaded zoid as checkpoint in packer_state.
+    """
+    zoid_count = 0
+    refs_count = 0
+    tick = checkpoint_tick = time.time()
+    rows = []
+    for source_zoid, tid, target_zoids in extractor.extract(reader.rows()):
+        zoid_count += 1
+        rows.append((source_zoid, source_zoid, tid))
+        for target_zoid in target_zoids:
+            refs_count += 1
+            rows.append((target_zoid, source_zoid, tid))
+        if len(rows) < COPY_SIZE:
+            continue
+        copy_rows(cursor, 'object_inrefs_load', LOAD_COLUMNS, rows)
+        rows = []
+        metrics.set('processed_zoids_total', zoid_count)
+        metrics.set('processed_refs_total', refs_count)
+        if (time.time() - checkpoint_tick) > CHECKPOINT_INTERVAL_SECS:
+            set_state(cursor, checkpoint=source_zoid)
+            timed_commit(connection)
+            checkpoint_tick = time.time()
+        if (time.time() - tick) > LOG_INTERVAL_SECS:
+            log.info(
+                'Loaded %d zoids with %d refs' % (zoid_count, refs_count)
+            )
+            tick = time.time()
+    copy_rows(cursor, 'object_inrefs_load', LOAD_COLUMNS, rows)
+    metrics.set('processed_zoids_total', zoid_count)
+    metrics.set('processed_refs_total', refs_count)
+    log.info('Loaded %d zoids with %d refs' % (zoid_count, refs_count))
+    return {'numzoids': zoid_count, 'numrefs': refs_count}
+
+
+def _load_edges_server(connection, cursor, checkpoint):
+    """fill the load table inside the database, one INSERT ... SELECT with
+    the function relstorage_packer_refs per range of zoids
+
+    each range is committed together with its last zoid as checkpoint.
+    """
+    zoid_count = 0
+    refs_count = 0
+    tick = time.time()
+    while True:
+        end = range_end(cursor, checkpoint)
+        failed, zoids, refs = load_range(cursor, checkpoint, end)
+        if failed:
+            log.info('Extract references of %d zoids locally' % len(failed))
+            rows = local_edges(cursor, failed)
+            copy_rows(cursor, 'object_inrefs_load', LOAD_COLUMNS, rows)
+            refs += len(rows)
+        zoid_count += zoids
+        refs_count += refs
+        metrics.set('processed_zoids_total', zoid_count)
+        metrics.set('processed_refs_total', refs_count)
+        if end is None:
+            break
+        checkpoint = end
+        set_state(cursor, checkpoint=checkpoint)
+        timed_commit(connection)
+        if (time.time() - tick) > LOG_INTERVAL_SECS:
+            log.info(
+                'Loaded %d zoids with %d refs' % (zoid_count, refs_count)
+            )
+            tick = time.time()
+    log.info('Loaded %d zoids with %d refs' % (zoid_count, refs_count))
+    return {'numzoids': zoid_count, 'numrefs': refs_count}
+
+
+################################################################################
+# Build of object_inrefs
+
+def _build_inrefs(cursor, partitions=0, outrefs=False):
+    """create object_inrefs and object_refcount from the load table, primary
+    keys and indexes are built at the end
+    """
+    log.info("Create tables object_inrefs and object_refcount (drop existing).")
+    drop_tables(cursor)
+    create_tables(cursor, partitions, outrefs)
+
+    log.info("Insert edges into object_inrefs.")
+    stmt = """
+    INSERT INTO object_inrefs (zoid, inref, tid)
+    SELECT zoid, inref, max(tid)
+    FROM object_inrefs_load
+    WHERE zoid <> inref
+    GROUP BY zoid, inref;
+    """
+    cursor.execute(stmt)
+
+    # the counter of a zoid is 1 (self) plus the number of its distinct
+    # incoming edges.
+    log.info("Insert counters into object_refcount.")
+    stmt = """
+    INSERT INTO object_refcount (zoid, tid, numinrefs)
+    SELECT zoid, max(tid), 1 + sum(num)
+    FROM (
+        SELECT zoid, tid, 1 AS num
+        FROM object_inrefs
+        UNION ALL
+        SELECT zoid, tid, 0 AS num
+        FROM object_inrefs_load
+        WHERE zoid = inref
+    ) counters
+    GROUP BY zoid;
+    """
+    cursor.execute(stmt)
+
+    if outrefs:
+        log.info("Insert reference arrays into object_outrefs.")
+        stmt = """
+        INSERT INTO object_outrefs (zoid, refs)
+        SELECT inref, array_agg(zoid ORDER BY zoid)
+        FROM object_inrefs
+        GROUP BY inref;
+        """
+        cursor.execute(stmt)
+
+    log.info("Build primary keys and indexes.")
+    create_indexes(cursor, outrefs)
+    stmt = """
+    DROP TABLE object_inrefs_load;
+    ANALYZE object_inrefs;
+    ANALYZE object_refcount;
+    """
+    cursor.execute(stmt)
+    if outrefs:
+        cursor.execute("ANALYZE object_outrefs;")
+
+
+def _start_load(cursor):
+    """create the load table and record the start of an initialization
+
+    objects changed while loading have a tid higher than the highest tid at
+    the start, they are analyzed again after the load.
+    """
+    _create_load_table(cursor)
+    # the root object is always referenced from outside
+    copy_rows(
+        cursor,
+        'object_inrefs_load',
+        LOAD_COLUMNS,
+        [(0, 0, 1), (0, -1, 1)]
+    )
+    cursor.execute("SELECT max(tid) FROM object_state;")
+    (init_tid,) = cursor.fetchone()
+    set_state(
+        cursor,
+        phase=PHASE_INIT_LOAD,
+        init_tid=init_tid or 0,
+        checkpoint=-1,
+        last_tid=None,
+    )
+
+
+def bulk_init(connection, cursor, storage, extractor, restart=False,
+              partitions=0, outrefs=False, server_refs=False, units=0):
+    """initialize object_inrefs from scratch in one pass over object_state
+
+    an initialization interrupted while loading continues after the last
+    checkpoint, unless restart is given. with partitions > 1 object_inrefs is
+    hash partitioned. with outrefs the optional table object_outrefs is
+    created. with server_refs the references are extracted inside the
+    database. with units > 0 the load is split into that many units of zoids
+    processed by the workers of a distributed initialization.
+
+    do transactions in here manually, the load commits checkpoints.
+    """
+    result = {'numzoids': 0, 'numrefs': 0}
+    try:
+        state = get_state(cursor)
+        started = False
+        if restart or state['phase'] not in INIT_PHASES:
+            _start_load(cursor)
+            started = True
+        elif not _load_table_filled(cursor):
+            # building from a truncated load table would count every
+            # object as orphan
+            log.info('Load table is lost, start from scratch.')
+            _start_load(cursor)
+            started = True
+        connection.commit()
+        state = get_state(cursor)
+        if state['phase'] == PHASE_INIT_LOAD:
+            if state['checkpoint'] >= 0:
+                log.info(
+                    'Resume load after checkpoint zoid=%d' %
+                    state['checkpoint']
+                )
+            if units:
+                done = coordinate(
+                    connection, cursor, storage, extractor, UNIT_INIT, -1,
+                    units, fresh=started
+                )
+                result = {
+                    'numzoids': sum([unit[2] for unit in done]),
+                    'numrefs': sum([unit[3] for unit in done]),
+                }
+                clear_units(cursor, UNIT_INIT)
+            elif server_refs:
+                result = _load_edges_server(
+                    connection, cursor, state['checkpoint']
+                )
+            else:
+                reader = StateReader(
+                    storage, STATES_STMT % state['checkpoint']
+                )
+                try:
+                    result = _load_edges(
+                        connection, cursor, reader, extractor
+                    )
+                finally:
+                    reader.close()
+            set_state(cursor, phase=PHASE_INIT_BUILD, checkpoint=None)
+            connection.commit()
+        else:
+            log.info('Resume build of object_inrefs.')
+        _build_inrefs(cursor, partitions, outrefs)
+        set_state(cursor, phase=PHASE_ANALYZE, last_tid=state['init_tid'])
+        timed_commit(connection)
+    except:
+        connection.rollback()
+        raise
+    return result
@@ -0,0 +1,236 @@
+"""relstorage_packer - the main database connection of a run
+
+The connection keeps one cursor across commits and its prepared statements,
+the deletes of the removal. A PostgreSQL backend grows with the plans and
+caches of a long session, so the connection is recycled between
+transactions: when the backend holds more memory than allowed (measured in
+``pg_backend_memory_contexts``, PostgreSQL 14+ with the right to read it) or
+after a number of statements.
+"""
+from .metrics import metrics
+from .utils import get_conn_and_cursor
+from .utils import timed_commit
+import logging
+import threading
+import time
+import weakref
+
+MB = 1024 * 1024
+LOCK_KEY = 23
+MAX_STATEMENTS = 200000
+MAX_BACKEND_MEMORY = 512
+# statements between two measurements of the backend memory
+CHECK_INTERVAL = 1000
+HANDOVER_POLL_SECS = 0.05
+
+log = logging.getLogger("pack.connmanager")
+
+# names of the prepared statements per connection
+_prepared = weakref.WeakKeyDictionary()
+
+
+def prepared(cursor, name, stmt, *params):
+    """the EXECUTE of stmt as prepared statement name
+
+    stmt refers to its parameters as $1, $2, ..., params are their names in
+    the parameters of the EXECUTE. stmt is prepared on first use per
+    connection.
+    """
+    names = _prepared.setdefault(cursor.connection, set())
+    if name not in names:
+        cursor.execute('PREPARE %s AS %s' % (name, stmt))
+        names.add(name)
+    return 'EXECUTE %s(%s);' % (
+        name, ', '.join(['%%(%s)s' % param for param in params])
+    )
+
+
+class ConnectionManager(object):
+    """owns the main connection and its cursor
+
+    max_statements and max_memory (in MB) limit the life of a connection,
+    0 disables the limit.
+    """
+
+    def __init__(self, storage, max_statements=MAX_STATEMENTS,
+                 max_memory=MAX_BACKEND_MEMORY):
+        self.storage = storage
+        self.max_statements = max_statements
+        self.max_memory = max_memory * MB
+        self.connection = None
+        self.cursor = None
+        self.measurable = False
+        self.checked_at = 0
+        self.locked = False
+        self._open()
+
+    def _open(self):
+        self.connection, self.cursor = get_conn_and_cursor(self.storage)
+        self.checked_at = 0
+        self.measurable = False
+        if self.max_memory:
+            self.measurable = self._memory_readable()
+        if self.locked and not self.lock():
+            raise RuntimeError('Lost the packer lock when reconnecting')
+
+    def lock(self):
+        """try to take the advisory lock of the packer, it is taken again on
+        a recycled connection. returns whether the lock is held.
+        """
+        self.cursor.execute("SELECT pg_try_advisory_lock(%d);" % LOCK_KEY)
+        self.locked = self.cursor.fetchone()[0]
+        timed_commit(self.connection)
+        return self.locked
+
+    def unlock(self):
+        """release the advisory lock of the packer if held"""
+        if not self.locked:
+            return
+        self.cursor.execute("SELECT pg_advisory_unlock(%d);" % LOCK_KEY)
+        timed_commit(self.connection)
+        self.locked = False
+
+    def _memory_readable(self):
+        stmt = """
+        SELECT to_regclass('pg_catalog.pg_backend_memory_contexts');
+        """
+        self.cursor.execute(stmt)
+        readable = self.cursor.fetchone()[0] is not None
+        if readable:
+            stmt = """
+            SELECT has_table_privilege(
+                'pg_catalog.pg_backend_memory_contexts', 'SELECT'
+            );
+            """
+            self.cursor.execute(stmt)
+            readable = self.cursor.fetchone()[0]
+        self.connection.rollback()
+        if not readable:
+            log.info(
+                'Backend memory not measurable, recycle the connection after '
+                '%d statements only' % self.max_statements
+            )
+        return readable
+
+    def backend_memory(self):
+        """bytes allocated by the backend of the connection"""
+        stmt = """
+        SELECT sum(total_bytes)
+        FROM pg_backend_memory_contexts;
+        """
+        self.cursor.execute(stmt)
+        return int(self.cursor.fetchone()[0] or 0)
+
+    def exhausted(self):
+        """the reason to recycle the connection or None"""
+        statements = self.cursor.statements
+        if self.max_statements and statements >= self.max_statements:
+            return 'after %d statements' % statements
+        if self.measurable and statements - self.checked_at >= CHECK_INTERVAL:
+            self.checked_at = statements
+            memory = self.backend_memory()
+            if memory > self.max_memory:
+                return 'at %d MB backend memory after %d statements' % (
+                    memory // MB, statements
+                )
+        return None
+
+    def sibling(self):
+        """a new manager of another connection with the same limits"""
+        return ConnectionManager(
+            self.storage,
+            self.max_statements,
+            self.max_memory // MB
+        )
+
+    def commit(self):
+        """commit keeping the cursor, returns the duration"""
+        return timed_commit(self.connection)
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def recycle(self):
+        """replace the connection by a fresh one
+
+        the packer lock is handed over to the new connection before the old
+        one is closed.
+        """
+        old_connection, old_cursor = self.connection, self.cursor
+        locked = self.locked
+        self.locked = False
+        try:
+            self._open()
+            if locked:
+                self._take_over(old_cursor)
+        finally:
+            try:
+                old_connection.close()
+            except Exception:
+                log.exception('Failed to close connection')
+        metrics.inc('reconnects_total')
+
+    def _take_over(self, old_cursor):
+        """move the packer lock from the session of old_cursor to the new one
+
+        the new session queues for the lock, then the old one releases it.
+        a queued session is granted the lock before later tries of other
+        packers, so no other packer gets in between.
+        """
+        pid = self.connection.get_backend_pid()
+        errors = []
+
+        def wait():
+            try:
+                self.cursor.execute("SELECT pg_advisory_lock(%d);" % LOCK_KEY)
+                timed_commit(self.connection)
+            except Exception, e:
+                errors.append(e)
+
+        thread = threading.Thread(target=wait, name='lock-handover')
+        thread.daemon = True
+        thread.start()
+        stmt = """
+        SELECT count(*)
+        FROM pg_locks
+        WHERE locktype = 'advisory'
+        AND pid = %d
+        AND NOT granted;
+        """ % pid
+        while thread.is_alive():
+            old_cursor.execute(stmt)
+            (waiting,) = old_cursor.fetchone()
+            old_cursor.connection.rollback()
+            if waiting:
+                break
+            time.sleep(HANDOVER_POLL_SECS)
+        old_cursor.execute("SELECT pg_advisory_unlock(%d);" % LOCK_KEY)
+        timed_commit(old_cursor.connection)
+        thread.join()
+        if errors:
+            raise errors[0]
+        self.locked = True
+
+    def maybe_recycle(self):
+        """recycle an exhausted connection, call between transactions only
+
+        returns whether the connection was recycled.
+        """
+        reason = self.exhausted()
+        if reason is None:
+            return False
+        log.info('Recycle connection %s' % reason)
+        self.recycle()
+        return True
+
+    def reopen_if_closed(self):
+        """open a new connection if the current one was closed"""
+        if self.connection.closed:
+            metrics.inc('reconnects_total')
+            self._open()
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            log.exception('Failed to close connection')
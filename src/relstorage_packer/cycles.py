@@ -0,0 +1,148 @@
+"""relstorage_packer - incremental collection of unreachable reference cycles
+
+Reference counting never removes objects in an unreachable reference cycle.
+Zoids whose counter was decremented without dropping to 1 are recorded as
+candidates in ``object_inrefs_candidates``. For each candidate a trial
+deletion explores its incoming references in ``object_inrefs``: if the
+explored subgraph is closed, all incoming references come from inside, it is
+not reachable from the root and gets removed.
+"""
+from .removal import BATCH_SIZE
+from .removal import remove_zoids
+from .throttle import Throttle
+from .utils import dbcommit
+import logging
+import time
+
+SUBGRAPH_LIMIT = 10000
+LOG_INTERVAL_SECS = 5
+
+log = logging.getLogger("pack.cycles")
+
+
+@dbcommit
+def init_candidates(cursor):
+    """create the table of cycle candidates if missing"""
+    stmt = """
+    CREATE TABLE IF NOT EXISTS object_inrefs_candidates (
+        zoid       BIGINT NOT NULL PRIMARY KEY
+    );
+    """
+    cursor.execute(stmt)
+
+
+def _get_candidates(cursor, limit):
+    stmt = """
+    SELECT zoid
+    FROM object_inrefs_candidates
+    ORDER BY zoid
+    LIMIT %d;
+    """ % limit
+    cursor.execute(stmt)
+    return [zoid for (zoid,) in cursor]
+
+
+def _trial_deletion(cursor, zoid, limit):
+    """explore the subgraph of zoid along incoming references
+
+    returns the set of zoids of the subgraph if it has no incoming references
+    from outside, otherwise (or if it exceeds limit) None.
+    """
+    stmt = """
+    SELECT 1
+    FROM object_refcount
+    WHERE zoid = %d;
+    """ % zoid
+    cursor.execute(stmt)
+    if not cursor.rowcount:
+        # removed meanwhile
+        return None
+    members = set([zoid])
+    frontier = [zoid]
+    while frontier:
+        stmt = """
+        SELECT inref
+        FROM object_inrefs
+        WHERE zoid = ANY(%(zoids)s::bigint[]);
+        """
+        cursor.execute(stmt, {'zoids': frontier})
+        found = set()
+        for (inref,) in cursor:
+            if inref < 0:
+                # reached the root
+                return None
+            if inref not in members:
+                found.add(inref)
+        members.update(found)
+        if len(members) > limit:
+            log.debug(
+                '-> subgraph of zoid=%d exceeds %d zoids' % (zoid, limit)
+            )
+            return None
+        frontier = list(found)
+    return members
+
+
+def collect_cycles(conns, blobs, max_candidates,
+                   limit=SUBGRAPH_LIMIT, batch_size=BATCH_SIZE,
+                   throttle=None, outrefs=False):
+    """check up to max_candidates candidates and remove unreachable cycles
+
+    each checked candidate is committed, so a run can be interrupted (or stop
+    at the time budget of the throttle) and the next run continues with the
+    remaining candidates.
+
+    do transactions in here manually, because of blobs
+    """
+    if throttle is None:
+        throttle = Throttle()
+    cursor = conns.cursor
+    tick = time.time()
+    checked = 0
+    count = 0
+    for zoid in _get_candidates(cursor, max_candidates):
+        if throttle.expired():
+            break
+        removed = []
+        try:
+            stmt = """
+            DELETE FROM object_inrefs_candidates
+            WHERE zoid = %d;
+            """ % zoid
+            cursor.execute(stmt)
+            garbage = _trial_deletion(cursor, zoid, limit)
+            if garbage:
+                removed = sorted(garbage)
+                log.debug(
+                    '-> Remove cycle of %d zoids at zoid=%d' %
+                    (len(removed), zoid)
+                )
+                for pos in xrange(0, len(removed), batch_size):
+                    remove_zoids(
+                        cursor,
+                        removed[pos:pos + batch_size],
+                        collect=True,
+                        outrefs=outrefs
+                    )
+            blobs.journal(removed)
+            commit_secs = conns.commit()
+        except:
+            conns.rollback()
+            raise
+        blobs.remove(removed)
+        conns.maybe_recycle()
+        cursor = conns.cursor
+        throttle.committed(cursor, len(removed), commit_secs)
+        checked += 1
+        count += len(removed)
+        if (time.time() - tick) > LOG_INTERVAL_SECS:
+            log.info(
+                'Checked %d cycle candidates, removed %d objects' %
+                (checked, count)
+            )
+            tick = time.time()
+    log.info(
+        'finished check of %d cycle candidates, removed %d objects' %
+        (checked, count)
+    )
+    return count
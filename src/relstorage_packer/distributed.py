@@ -0,0 +1,379 @@
+"""relstorage_packer - analysis distributed over several packer processes
+
+The coordinator (``--coordinator``) splits the work into units in the table
+``packer_units``: ranges of zoids for an initialization, ranges of tids for
+an update. Workers on any host (``--worker``) and the coordinator itself
+claim units with ``FOR UPDATE SKIP LOCKED``, read the states in the snapshot
+exported by the coordinator, extract the references and stage the edges:
+into the load table of the initialization or into the table
+``packer_refs_shared`` for an update. A unit is committed together with its
+edges. Once all units are done the coordinator merges the edges.
+"""
+from .reader import StateReader
+from .utils import copy_rows
+from .utils import dbcommit
+from .utils import get_conn_and_cursor
+from .utils import table_exists
+from .utils import timed_commit
+import logging
+import os
+import socket
+import time
+
+UNITS = 64
+COPY_SIZE = 10000
+# claims older than this are taken over, their worker is assumed dead
+CLAIM_TIMEOUT_SECS = 3600
+POLL_SECS = 5
+UNIT_INIT = 'init'
+UNIT_UPDATE = 'update'
+
+COLUMNS = {
+    UNIT_INIT: 'zoid',
+    UNIT_UPDATE: 'tid',
+}
+
+log = logging.getLogger("pack.distributed")
+
+
+@dbcommit
+def init_units(cursor):
+    """create the claim table and the shared staging table if missing"""
+    stmt = """
+    CREATE TABLE IF NOT EXISTS packer_units (
+        unit       INTEGER NOT NULL PRIMARY KEY,
+        kind       TEXT NOT NULL,
+        low        BIGINT NOT NULL,
+        high       BIGINT NOT NULL,
+        snapshot   TEXT,
+        worker     TEXT,
+        claimed    TIMESTAMP,
+        done       TIMESTAMP,
+        numzoids   BIGINT,
+        numrefs    BIGINT
+    );
+    CREATE TABLE IF NOT EXISTS packer_refs_shared (
+        unit       INTEGER NOT NULL,
+        zoid       BIGINT NOT NULL,
+        inref      BIGINT NOT NULL,
+        tid        BIGINT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS packer_refs_shared_unit
+    ON packer_refs_shared (unit);
+    """
+    cursor.execute(stmt)
+    # done units are merged after a crash of the server, their edges must
+    # survive it. created unlogged by earlier versions.
+    stmt = """
+    SELECT relpersistence
+    FROM pg_class
+    WHERE oid = 'packer_refs_shared'::regclass;
+    """
+    cursor.execute(stmt)
+    if cursor.fetchone()[0] == 'u':
+        cursor.execute("ALTER TABLE packer_refs_shared SET LOGGED;")
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def export_snapshot(cursor):
+    """start a repeatable read transaction and export its snapshot, keep the
+    transaction open while others use the snapshot
+    """
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+    cursor.execute("SELECT pg_export_snapshot();")
+    return cursor.fetchone()[0]
+
+
+def clear_units(cursor, kind):
+    """remove all units of kind and their staged edges"""
+    stmt = """
+    DELETE FROM packer_refs_shared
+    WHERE unit IN (
+        SELECT unit
+        FROM packer_units
+        WHERE kind = %(kind)s
+    );
+    DELETE FROM packer_units
+    WHERE kind = %(kind)s;
+    """
+    cursor.execute(stmt, {'kind': kind})
+
+
+def _boundaries(cursor, kind, low, count):
+    """upper bounds of up to count units of about the same number of states
+    after low
+    """
+    fractions = [float(idx) / count for idx in xrange(1, count)]
+    stmt = """
+    SELECT
+        percentile_disc(%%(fractions)s::float8[])
+            WITHIN GROUP (ORDER BY %(column)s),
+        max(%(column)s)
+    FROM object_state
+    WHERE %(column)s > %%(low)s;
+    """ % {'column': COLUMNS[kind]}
+    cursor.execute(stmt, {'fractions': fractions, 'low': low})
+    percentiles, highest = cursor.fetchone()
+    if highest is None:
+        return []
+    return sorted(set(percentiles or []) | set([highest]))
+
+
+def create_units(cursor, snapshot_cursor, kind, low, count):
+    """split the states after low into count units of kind
+
+    the split is computed in the exported snapshot. returns the number of
+    units.
+    """
+    clear_units(cursor, kind)
+    cursor.execute("SELECT COALESCE(max(unit), 0) FROM packer_units;")
+    (unit,) = cursor.fetchone()
+    rows = []
+    for high in _boundaries(snapshot_cursor, kind, low, count):
+        unit += 1
+        rows.append({'unit': unit, 'kind': kind, 'low': low, 'high': high})
+        low = high
+    stmt = """
+    INSERT INTO packer_units (unit, kind, low, high)
+    VALUES (%(unit)s, %(kind)s, %(low)s, %(high)s);
+    """
+    if rows:
+        cursor.executemany(stmt, rows)
+    return len(rows)
+
+
+def units_low(cursor, kind):
+    """lowest bound of the units of kind, None without units"""
+    stmt = """
+    SELECT min(low)
+    FROM packer_units
+    WHERE kind = %(kind)s;
+    """
+    cursor.execute(stmt, {'kind': kind})
+    return cursor.fetchone()[0]
+
+
+def pending_units(cursor, kind=None):
+    """number of units not done yet"""
+    stmt = """
+    SELECT count(*)
+    FROM packer_units
+    WHERE done IS NULL
+    """
+    if kind is not None:
+        stmt += "AND kind = %(kind)s"
+    cursor.execute(stmt, {'kind': kind})
+    return cursor.fetchone()[0]
+
+
+def done_units(cursor, kind):
+    """(unit, high, numzoids, numrefs) of the done units of kind in order"""
+    stmt = """
+    SELECT unit, high, numzoids, numrefs
+    FROM packer_units
+    WHERE kind = %(kind)s
+    AND done IS NOT NULL
+    ORDER BY unit;
+    """
+    cursor.execute(stmt, {'kind': kind})
+    return cursor.fetchall()
+
+
+def drop_unit(cursor, unit):
+    """remove a merged unit and its staged edges"""
+    stmt = """
+    DELETE FROM packer_refs_shared
+    WHERE unit = %(unit)s;
+    DELETE FROM packer_units
+    WHERE unit = %(unit)s;
+    """
+    cursor.execute(stmt, {'unit': unit})
+
+
+def claim_unit(connection, cursor, worker):
+    """claim the next unit not done and not claimed (or claimed by a dead
+    worker), returns (unit, kind, low, high, snapshot) or None
+    """
+    stmt = """
+    UPDATE packer_units u
+    SET worker = %%(worker)s, claimed = now()
+    FROM (
+        SELECT unit
+        FROM packer_units
+        WHERE done IS NULL
+        AND (
+            claimed IS NULL
+            OR claimed < now() - interval '%d seconds'
+        )
+        ORDER BY unit
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) c
+    WHERE u.unit = c.unit
+    RETURNING u.unit, u.kind, u.low, u.high, u.snapshot;
+    """ % CLAIM_TIMEOUT_SECS
+    cursor.execute(stmt, {'worker': worker})
+    unit = cursor.fetchone()
+    timed_commit(connection)
+    return unit
+
+
+def _unit_stmt(kind, low, high):
+    column = COLUMNS[kind]
+    return """
+    SELECT zoid, tid, state
+    FROM object_state
+    WHERE %s > %d
+    AND %s <= %d
+    ORDER BY %s;
+    """ % (column, low, column, high, column)
+
+
+def process_unit(connection, cursor, storage, extractor, unit):
+    """extract the references of the states of a unit and stage its edges,
+    committed together with the unit
+
+    returns False if the unit was taken over and finished by another worker.
+    """
+    unit_id, kind, low, high, snapshot = unit
+    if kind == UNIT_INIT:
+        table = 'object_inrefs_load'
+        columns = ('zoid', 'inref', 'tid')
+        prefix = ()
+    else:
+        table = 'packer_refs_shared'
+        columns = ('unit', 'zoid', 'inref', 'tid')
+        prefix = (unit_id,)
+    zoid_count = 0
+    refs_count = 0
+    rows = []
+    reader = StateReader(
+        storage,
+        _unit_stmt(kind, low, high),
+        snapshot=snapshot
+    )
+    try:
+        for source_zoid, tid, target_zoids in extractor.extract(reader.rows()):
+            zoid_count += 1
+            rows.append(prefix + (source_zoid, source_zoid, tid))
+            for target_zoid in target_zoids:
+                refs_count += 1
+                rows.append(prefix + (target_zoid, source_zoid, tid))
+            if len(rows) >= COPY_SIZE:
+                copy_rows(cursor, table, columns, rows)
+                rows = []
+        copy_rows(cursor, table, columns, rows)
+        stmt = """
+        UPDATE packer_units
+        SET done = now(), numzoids = %(numzoids)s, numrefs = %(numrefs)s
+        WHERE unit = %(unit)s
+        AND done IS NULL;
+        """
+        cursor.execute(stmt, {
+            'unit': unit_id,
+            'numzoids': zoid_count,
+            'numrefs': refs_count,
+        })
+        if not cursor.rowcount:
+            log.info('Unit %d was finished by another worker' % unit_id)
+            connection.rollback()
+            return False
+        timed_commit(connection)
+    except:
+        connection.rollback()
+        raise
+    finally:
+        reader.close()
+    log.info(
+        'Unit %d (%s %d-%d): %d zoids with %d refs' %
+        (unit_id, COLUMNS[kind], low, high, zoid_count, refs_count)
+    )
+    return True
+
+
+def work(connection, cursor, storage, extractor, wait=False):
+    """process units until none is left to claim
+
+    with wait return only once all units are done, units of dead workers
+    are taken over after CLAIM_TIMEOUT_SECS. returns the number of units
+    processed.
+    """
+    worker = worker_name()
+    processed = 0
+    while True:
+        unit = claim_unit(connection, cursor, worker)
+        if unit is not None:
+            if process_unit(connection, cursor, storage, extractor, unit):
+                processed += 1
+            continue
+        if not wait:
+            break
+        pending = pending_units(cursor)
+        connection.rollback()
+        if not pending:
+            break
+        log.info('Wait for %d units of other workers' % pending)
+        time.sleep(POLL_SECS)
+    return processed
+
+
+def coordinate(connection, cursor, storage, extractor, kind, low,
+               count=UNITS, fresh=False):
+    """split the states after low into units of kind (or resume existing
+    units), let the workers and the coordinator process them and wait for
+    all units
+
+    all read in a snapshot exported by the coordinator, it is held until all
+    units are done. returns the done units as in ``done_units``.
+    """
+    snapshot_connection, snapshot_cursor = get_conn_and_cursor(storage)
+    try:
+        snapshot = export_snapshot(snapshot_cursor)
+        if fresh or units_low(cursor, kind) != low:
+            numunits = create_units(
+                cursor, snapshot_cursor, kind, low, count
+            )
+            log.info('Split work into %d units of %s' % (numunits, kind))
+        else:
+            log.info('Resume units of %s' % kind)
+        # claims of a prior coordinator are void with its snapshot
+        stmt = """
+        UPDATE packer_units
+        SET snapshot = %(snapshot)s, worker = NULL, claimed = NULL
+        WHERE kind = %(kind)s
+        AND done IS NULL;
+        """
+        cursor.execute(stmt, {'snapshot': snapshot, 'kind': kind})
+        timed_commit(connection)
+        log.info(
+            'Workers can join now: relstorage_pack --worker <config>, '
+            'snapshot %s' % snapshot
+        )
+        processed = work(connection, cursor, storage, extractor, wait=True)
+        log.info('Processed %d units in the coordinator' % processed)
+    finally:
+        try:
+            snapshot_connection.rollback()
+            snapshot_connection.close()
+        except Exception:
+            log.exception('Failed to close snapshot connection')
+    units = done_units(cursor, kind)
+    connection.rollback()
+    return units
+
+
+def run_worker(storage, extractor):
+    """process units of a coordinator until none is left to claim"""
+    connection, cursor = get_conn_and_cursor(storage)
+    try:
+        if table_exists(cursor, 'packer_units'):
+            processed = work(connection, cursor, storage, extractor)
+        else:
+            processed = 0
+        log.info('Processed %d units' % processed)
+    finally:
+        connection.close()
+    return processed
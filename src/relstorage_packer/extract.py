@@ -0,0 +1,101 @@
+"""relstorage_packer - reference extraction in a pool of worker processes"""
+from .scanner import get_references
+from array import array
+from collections import deque
+import logging
+import multiprocessing
+import signal
+
+BATCH_SIZE = 1000
+
+log = logging.getLogger("pack.extract")
+
+
+def _init_worker():
+    # interrupts are handled by the main process, it terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _extract_batch(batch):
+    """extract the references of a batch of (zoid, tid, state)
+
+    returns compact arrays: zoids, tids, number of refs per zoid and all refs.
+    """
+    zoids = array('l')
+    tids = array('l')
+    counts = array('l')
+    refs = array('l')
+    for zoid, tid, state in batch:
+        target_zoids = get_references(state)
+        zoids.append(zoid)
+        tids.append(tid)
+        counts.append(len(target_zoids))
+        refs.extend(target_zoids)
+    return zoids, tids, counts, refs
+
+
+def _unpack_batch(result):
+    zoids, tids, counts, refs = result
+    offset = 0
+    for idx, zoid in enumerate(zoids):
+        count = counts[idx]
+        yield zoid, tids[idx], refs[offset:offset + count]
+        offset += count
+
+
+def _batches(rows, size):
+    """group an iterable of (zoid, tid, state) into lists of given size
+
+    states are converted to strings, so they can be sent to the workers.
+    """
+    batch = []
+    for zoid, tid, state in rows:
+        batch.append((zoid, tid, state and str(state)))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ReferenceExtractor(object):
+    """extracts references of object states, optional in worker processes
+
+    with less than 2 jobs all extraction happens inline. Otherwise batches of
+    states are sent to a pool of worker processes while the caller keeps on
+    reading from and writing to the database. At most ``2 * jobs`` batches are
+    in flight and results are returned in the order the batches were read.
+    """
+
+    def __init__(self, jobs=0, batch_size=BATCH_SIZE):
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.pool = None
+        if jobs > 1:
+            log.info('Start pool of %d reference extraction workers' % jobs)
+            self.pool = multiprocessing.Pool(jobs, _init_worker)
+
+    def extract(self, rows):
+        """iterate over (zoid, tid, refs) of an iterable of (zoid, tid, state)
+        """
+        if self.pool is None:
+            for zoid, tid, state in rows:
+                yield zoid, tid, get_references(state)
+            return
+        pending = deque()
+        for batch in _batches(rows, self.batch_size):
+            pending.append(self.pool.apply_async(_extract_batch, (batch,)))
+            if len(pending) < 2 * self.jobs:
+                continue
+            for item in _unpack_batch(pending.popleft().get()):
+                yield item
+        while pending:
+            for item in _unpack_batch(pending.popleft().get()):
+                yield item
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
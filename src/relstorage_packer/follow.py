@@ -0,0 +1,143 @@
+"""relstorage_packer - waiting for new transactions in follow mode
+
+With ``--follow`` the packer keeps ``object_inrefs`` current as transactions
+commit and leaves the removal to pack runs. It polls ``object_state`` for
+transactions after the last analyzed tid. With ``--follow-listen`` a
+statement level trigger on ``object_state`` notifies the channel
+``relstorage_packer`` on each commit, so the follower wakes up at once and
+polls only as fallback. ``--no-notify`` drops the trigger again.
+"""
+from .utils import dbcommit
+from .utils import get_conn_and_cursor
+import logging
+import psycopg2.extensions
+import select
+import signal
+import time
+
+FOLLOW_INTERVAL_SECS = 10
+CHANNEL = 'relstorage_packer'
+
+log = logging.getLogger("pack.follow")
+
+
+def committed_after(cursor, tid):
+    """whether a transaction after tid is committed, the transaction is
+    rolled back so no snapshot is held while waiting
+    """
+    stmt = """
+    SELECT EXISTS (
+        SELECT 1
+        FROM object_state
+        WHERE tid > %d
+    );
+    """ % tid
+    cursor.execute(stmt)
+    (found,) = cursor.fetchone()
+    cursor.connection.rollback()
+    return found
+
+
+def install_trigger(cursor):
+    """notify CHANNEL on every statement changing object_state, the
+    notification is sent on commit. needs the right to create triggers on
+    object_state.
+    """
+    stmt = """
+    SELECT 1
+    FROM pg_trigger
+    WHERE tgname = 'relstorage_packer_notify';
+    """
+    cursor.execute(stmt)
+    if cursor.rowcount:
+        return
+    log.info('Install trigger relstorage_packer_notify on object_state')
+    stmt = """
+    CREATE OR REPLACE FUNCTION relstorage_packer_notify()
+    RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('%s', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER relstorage_packer_notify
+    AFTER INSERT OR UPDATE ON object_state
+    FOR EACH STATEMENT EXECUTE PROCEDURE relstorage_packer_notify();
+    """ % CHANNEL
+    cursor.execute(stmt)
+
+
+@dbcommit
+def uninstall_trigger(cursor):
+    """drop the trigger of install_trigger and its function"""
+    log.info('Drop trigger relstorage_packer_notify on object_state')
+    stmt = """
+    DROP TRIGGER IF EXISTS relstorage_packer_notify ON object_state;
+    DROP FUNCTION IF EXISTS relstorage_packer_notify();
+    """
+    cursor.execute(stmt)
+
+
+class Follower(object):
+    """waits for transactions committed after a tid until SIGTERM or SIGINT
+
+    with listen a connection of its own listens on CHANNEL.
+    """
+
+    def __init__(self, storage, interval=FOLLOW_INTERVAL_SECS, listen=False):
+        self.interval = interval
+        self.stopped = False
+        self.connection = None
+        if listen:
+            self.connection, cursor = get_conn_and_cursor(storage)
+            self.connection.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+            )
+            install_trigger(cursor)
+            cursor.execute("LISTEN %s;" % CHANNEL)
+        self.handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.handlers[signum] = signal.signal(signum, self._stop)
+
+    def _stop(self, signum, frame):
+        log.info('Stop following after the current window')
+        self.stopped = True
+
+    def is_stopped(self):
+        return self.stopped
+
+    def _sleep(self):
+        if self.connection is None:
+            # returns early on a signal
+            time.sleep(self.interval)
+            return
+        try:
+            select.select([self.connection], [], [], self.interval)
+        except select.error:
+            # interrupted by a signal
+            return
+        self.connection.poll()
+        del self.connection.notifies[:]
+
+    def wait(self, cursor, tid):
+        """wait for a transaction after tid, returns False once stopped"""
+        while not self.stopped:
+            if committed_after(cursor, tid):
+                return True
+            self._sleep()
+        return False
+
+    def pause(self):
+        """wait one interval or for a notification"""
+        if not self.stopped:
+            self._sleep()
+
+    def close(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                log.exception('Failed to close listening connection')
@@ -0,0 +1,259 @@
+"""relstorage_packer - maintenance of the tables after a pack
+
+Removing many objects leaves dead tuples in ``object_state`` and the
+reference tables and bloats their indexes, later runs and the site slow down.
+With ``--maintain`` a final phase measures each table (and each partition of
+``object_inrefs``) and, above the thresholds, runs ``VACUUM (ANALYZE)`` or
+only ``ANALYZE``. Indexes of the reference tables are rebuilt with ``REINDEX
+CONCURRENTLY`` (PostgreSQL 12+) when bloated. The bloat of an index is read
+with ``pgstatindex`` if the extension pgstattuple is installed, else it is
+estimated from the number of its tuples. VACUUM and REINDEX CONCURRENTLY do
+not run in a transaction, the phase uses an autocommit connection of its own.
+Each action is timed and logged with the sizes before and after.
+"""
+from .utils import get_conn_and_cursor
+import logging
+import math
+import psycopg2
+import psycopg2.extensions
+import time
+
+MAX_DEAD_RATIO = 0.2
+MIN_DEAD_TUPLES = 10000
+MAX_INDEX_BLOAT = 0.3
+# smaller indexes are not worth a rebuild, 8 MB
+MIN_INDEX_PAGES = 1024
+TABLES = ('object_state', 'object_inrefs', 'object_refcount',
+          'object_outrefs')
+# tables of the packer, object_state and its indexes belong to RelStorage
+REINDEX_TABLES = ('object_inrefs', 'object_refcount', 'object_outrefs')
+# usable bytes of an index page and the default fillfactor of btree leaves
+PAGE_BYTES = 8152
+FILLFACTOR = 0.9
+
+log = logging.getLogger("pack.maintenance")
+
+
+def _size(num):
+    return '%.1f MB' % (float(num) / (1024 * 1024))
+
+
+def leaf_tables(cursor, table):
+    """names of the tables holding the rows of table, its partitions for a
+    partitioned table, empty if table does not exist
+    """
+    stmt = """
+    SELECT c.relname
+    FROM pg_class c
+    WHERE c.oid = to_regclass(%(table)s)
+    AND c.relkind = 'r'
+    UNION ALL
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%(table)s)
+    AND c.relkind = 'r'
+    ORDER BY 1;
+    """
+    cursor.execute(stmt, {'table': table})
+    return [name for (name,) in cursor]
+
+
+def table_stats(cursor, table):
+    """(live tuples, dead tuples, tuples modified since the last analyze,
+    total size in bytes) of table
+    """
+    stmt = """
+    SELECT
+        COALESCE(s.n_live_tup, 0),
+        COALESCE(s.n_dead_tup, 0),
+        COALESCE(s.n_mod_since_analyze, 0),
+        pg_total_relation_size(c.oid)
+    FROM pg_class c
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.oid = to_regclass(%(table)s);
+    """
+    cursor.execute(stmt, {'table': table})
+    return cursor.fetchone()
+
+
+def table_indexes(cursor, table):
+    """(name, number of key columns, pages, tuples, bytes) of the valid btree
+    indexes of table
+    """
+    stmt = """
+    SELECT c.relname, i.indnatts, c.relpages, c.reltuples,
+           pg_relation_size(c.oid)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_am a ON a.oid = c.relam
+    WHERE i.indrelid = to_regclass(%(table)s)
+    AND i.indisvalid
+    AND a.amname = 'btree'
+    ORDER BY c.relname;
+    """
+    cursor.execute(stmt, {'table': table})
+    return cursor.fetchall()
+
+
+def has_pgstatindex(cursor):
+    cursor.execute("SELECT to_regproc('pgstatindex') IS NOT NULL;")
+    return cursor.fetchone()[0]
+
+
+def index_bloat(cursor, index, use_pgstatindex=False):
+    """share of the index not used by its tuples, between 0 and 1
+
+    without pgstatindex it is estimated from pages and tuples in pg_class, for
+    indexes on bigint columns as all of the packer.
+    """
+    name, natts, pages, tuples, size = index
+    if use_pgstatindex:
+        stmt = """
+        SELECT avg_leaf_density
+        FROM pgstatindex(%(index)s);
+        """
+        cursor.execute(stmt, {'index': name})
+        density = cursor.fetchone()[0]
+        if density is None or math.isnan(density):
+            return 0.0
+        return max(0.0, 1.0 - density / 100.0 / FILLFACTOR)
+    if pages < 2:
+        return 0.0
+    # tuple header, bigint keys and line pointer
+    entry = 8 + 8 * natts + 4
+    expected = math.ceil(tuples * entry / (PAGE_BYTES * FILLFACTOR)) + 1
+    return max(0.0, 1.0 - expected / float(pages))
+
+
+def server_version(cursor):
+    cursor.execute("SHOW server_version_num;")
+    return int(cursor.fetchone()[0])
+
+
+def _timed(cursor, stmt):
+    start = time.time()
+    cursor.execute(stmt)
+    return time.time() - start
+
+
+def _drop_invalid(cursor, table):
+    """drop indexes left invalid by a failed REINDEX CONCURRENTLY"""
+    stmt = """
+    SELECT c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = to_regclass(%(table)s)
+    AND NOT i.indisvalid
+    AND c.relname LIKE '%%\\_ccnew%%';
+    """
+    cursor.execute(stmt, {'table': table})
+    for (name,) in cursor.fetchall():
+        log.info('Drop invalid index %s' % name)
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS %s;" % name)
+
+
+def vacuum_table(cursor, table, max_dead_ratio=MAX_DEAD_RATIO):
+    """VACUUM (ANALYZE) table with too many dead tuples, ANALYZE it if many
+    tuples changed since its last analyze. returns the seconds taken.
+    """
+    live, dead, modified, size = table_stats(cursor, table)
+    total = max(live + dead, 1)
+    if dead >= MIN_DEAD_TUPLES and float(dead) / total > max_dead_ratio:
+        action = 'VACUUM (ANALYZE)'
+    elif float(modified) / total > max_dead_ratio:
+        action = 'ANALYZE'
+    else:
+        log.debug(
+            '%s: %d live, %d dead tuples, %s, nothing to do' %
+            (table, live, dead, _size(size))
+        )
+        return 0.0
+    secs = _timed(cursor, '%s %s;' % (action, table))
+    after = table_stats(cursor, table)[3]
+    log.info(
+        '%s %s: %d live, %d dead tuples, %s -> %s, took %.2fs' %
+        (action, table, live, dead, _size(size), _size(after), secs)
+    )
+    return secs
+
+
+def reindex_table(cursor, table, max_bloat=MAX_INDEX_BLOAT,
+                  use_pgstatindex=False):
+    """rebuild the bloated indexes of table concurrently, returns the
+    seconds taken
+    """
+    secs = 0.0
+    for index in table_indexes(cursor, table):
+        name, natts, pages, tuples, size = index
+        if pages < MIN_INDEX_PAGES:
+            continue
+        bloat = index_bloat(cursor, index, use_pgstatindex)
+        if bloat <= max_bloat:
+            log.debug('%s: %.0f%% bloat, %s' % (name, bloat * 100,
+                                                _size(size)))
+            continue
+        try:
+            took = _timed(cursor, 'REINDEX INDEX CONCURRENTLY %s;' % name)
+        except psycopg2.Error, e:
+            log.error('Failed to reindex %s: %s' % (name, e))
+            _drop_invalid(cursor, table)
+            continue
+        secs += took
+        cursor.execute("SELECT pg_relation_size(to_regclass(%(index)s));",
+                       {'index': name})
+        after = cursor.fetchone()[0]
+        log.info(
+            'REINDEX %s: %.0f%% bloat, %s -> %s, took %.2fs' %
+            (name, bloat * 100, _size(size), _size(after), took)
+        )
+    return secs
+
+
+def maintain(storage, max_dead_ratio=MAX_DEAD_RATIO,
+             max_bloat=MAX_INDEX_BLOAT, tables=TABLES):
+    """vacuum, analyze and reindex the tables above the thresholds
+
+    returns a dict with the seconds of vacuum and reindex and the total size
+    of the tables before and after.
+    """
+    connection, cursor = get_conn_and_cursor(storage)
+    connection.set_isolation_level(
+        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+    )
+    result = {'vacuum_secs': 0.0, 'reindex_secs': 0.0,
+              'size_before': 0, 'size_after': 0}
+    try:
+        reindex = server_version(cursor) >= 120000
+        if not reindex:
+            log.info('REINDEX CONCURRENTLY needs PostgreSQL 12, skip indexes')
+        use_pgstatindex = has_pgstatindex(cursor)
+        leaves = []
+        for table in tables:
+            for leaf in leaf_tables(cursor, table):
+                leaves.append((table, leaf))
+        for table, leaf in leaves:
+            result['size_before'] += table_stats(cursor, leaf)[3]
+        for table, leaf in leaves:
+            result['vacuum_secs'] += vacuum_table(
+                cursor, leaf, max_dead_ratio
+            )
+            # statistics of the indexes are current after the vacuum
+            if reindex and table in REINDEX_TABLES:
+                result['reindex_secs'] += reindex_table(
+                    cursor, leaf, max_bloat, use_pgstatindex
+                )
+        for table, leaf in leaves:
+            result['size_after'] += table_stats(cursor, leaf)[3]
+    finally:
+        connection.close()
+    log.info(
+        'Finished maintenance: %s -> %s, vacuum %.2fs, reindex %.2fs' %
+        (
+            _size(result['size_before']),
+            _size(result['size_after']),
+            result['vacuum_secs'],
+            result['reindex_secs'],
+        )
+    )
+    return result
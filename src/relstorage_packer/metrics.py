@@ -0,0 +1,274 @@
+"""relstorage_packer - metrics of a run
+
+All modules count into the module level registry ``metrics``. It is exported
+in the Prometheus text format to a file (for the textfile collector of the
+node exporter) and/or on a local HTTP endpoint. With the JSON log format the
+progress log lines carry a snapshot of the metrics.
+"""
+import BaseHTTPServer
+import json
+import logging
+import os
+import psycopg2.extensions
+import threading
+import time
+
+PREFIX = 'relstorage_packer_'
+EXPORT_INTERVAL_SECS = 15
+COMMIT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+
+# name, type, help text
+DEFINITIONS = (
+    ('processed_tids_total', 'counter', 'Transactions analyzed.'),
+    ('processed_zoids_total', 'counter', 'Object states analyzed.'),
+    ('processed_refs_total', 'counter', 'References analyzed.'),
+    ('removed_objects_total', 'counter', 'Objects removed.'),
+    ('removed_blobs_total', 'counter', 'Blob directories removed.'),
+    ('blob_bytes_freed_total', 'counter', 'Bytes of removed blobs.'),
+    ('db_roundtrips_total', 'counter',
+     'Statements, copies, fetches and commits sent to the database.'),
+    ('reconnects_total', 'counter', 'Database connections refreshed.'),
+    ('commit_seconds', 'histogram', 'Duration of commits.'),
+    ('eta_seconds', 'gauge', 'Estimated time left for the analysis.'),
+    ('start_time_seconds', 'gauge', 'Start of the run as unix time.'),
+    ('last_progress_time_seconds', 'gauge',
+     'Last analyzed or removed object as unix time.'),
+    ('phase', 'gauge', 'Current phase of the run.'),
+)
+
+# counters not showing progress of the run
+NO_PROGRESS = ('db_roundtrips_total', 'reconnects_total')
+
+log = logging.getLogger("pack.metrics")
+
+
+def _number(value):
+    """value in the exposition format, repr of a long has a trailing L on
+    Python 2
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return '%d' % value
+
+
+class Metrics(object):
+    """thread safe registry of counters, gauges and histograms"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.phase = None
+        for name, kind, doc in DEFINITIONS:
+            if kind == 'histogram':
+                self.histograms[name] = [[0] * len(COMMIT_BUCKETS), 0.0, 0]
+            else:
+                self.values[name] = 0
+        self.values['start_time_seconds'] = time.time()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.values[name] += amount
+            if name not in NO_PROGRESS:
+                self.values['last_progress_time_seconds'] = time.time()
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+            if name.endswith('_total') and name not in NO_PROGRESS:
+                self.values['last_progress_time_seconds'] = time.time()
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def observe(self, name, value):
+        with self.lock:
+            buckets, total, count = self.histograms[name]
+            for idx, bound in enumerate(COMMIT_BUCKETS):
+                if value <= bound:
+                    buckets[idx] += 1
+            self.histograms[name] = [buckets, total + value, count + 1]
+
+    def snapshot(self):
+        """metrics as dict, histograms as sum and count"""
+        with self.lock:
+            result = dict(self.values)
+            for name, (buckets, total, count) in self.histograms.items():
+                result[name + '_sum'] = total
+                result[name + '_count'] = count
+        result['phase'] = self.phase
+        return result
+
+    def prometheus(self):
+        """metrics in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            for name, kind, doc in DEFINITIONS:
+                full = PREFIX + name
+                lines.append('# HELP %s %s' % (full, doc))
+                lines.append('# TYPE %s %s' % (full, kind))
+                if kind == 'histogram':
+                    buckets, total, count = self.histograms[name]
+                    for bound, num in zip(COMMIT_BUCKETS, buckets):
+                        lines.append('%s_bucket{le="%s"} %d' %
+                                     (full, bound, num))
+                    lines.append('%s_bucket{le="+Inf"} %d' % (full, count))
+                    lines.append('%s_sum %s' % (full, _number(total)))
+                    lines.append('%s_count %d' % (full, count))
+                elif name == 'phase':
+                    if self.phase is not None:
+                        lines.append('%s{phase="%s"} 1' % (full, self.phase))
+                else:
+                    lines.append('%s %s' % (full, _number(self.values[name])))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """cursor counting its round-trips to the database, in the metrics and
+    in ``statements``
+    """
+
+    statements = 0
+
+    def _count(self):
+        self.statements += 1
+        metrics.inc('db_roundtrips_total')
+
+    def execute(self, query, vars=None):
+        self._count()
+        return super(CountingCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self._count()
+        return super(CountingCursor, self).executemany(query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        self._count()
+        return super(CountingCursor, self).callproc(procname, parameters)
+
+    def copy_from(self, *args, **kw):
+        self._count()
+        return super(CountingCursor, self).copy_from(*args, **kw)
+
+    def copy_expert(self, *args, **kw):
+        self._count()
+        return super(CountingCursor, self).copy_expert(*args, **kw)
+
+    def fetchmany(self, size=None):
+        # only a server side cursor fetches from the database
+        if self.name:
+            self._count()
+        if size is None:
+            return super(CountingCursor, self).fetchmany()
+        return super(CountingCursor, self).fetchmany(size)
+
+
+################################################################################
+# Export
+
+class JsonFormatter(logging.Formatter):
+    """formats log records as one JSON object per line
+
+    records logged with ``extra={'metrics': ...}`` carry these metrics.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'metrics', None) is not None:
+            entry['metrics'] = record.metrics
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True)
+
+
+def use_json_logging():
+    """switch all handlers of the root logger to the JSON format
+
+    without handlers (logging was configured elsewhere without any) a stream
+    handler on stderr is added at level INFO, like the package does.
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        root.addHandler(logging.StreamHandler())
+        root.setLevel(logging.INFO)
+    for handler in root.handlers:
+        handler.setFormatter(JsonFormatter())
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s %s' % (self.address_string(), format % args))
+
+
+def write_textfile(path):
+    """write the metrics atomically to path"""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as textfile:
+        textfile.write(metrics.prometheus())
+    os.rename(tmp_path, path)
+
+
+class MetricsExporter(object):
+    """writes the metrics to a textfile every interval seconds and/or serves
+    them over HTTP on localhost in background threads
+    """
+
+    def __init__(self, path=None, port=None, interval=EXPORT_INTERVAL_SECS):
+        self.path = path
+        self.interval = interval
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+        if port:
+            self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', port),
+                                                    _Handler)
+            log.info('Serve metrics on http://127.0.0.1:%d/metrics' % port)
+            self._start(self.server.serve_forever, 'metrics-http')
+        if path:
+            self._start(self._write, 'metrics-file')
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _write(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                write_textfile(self.path)
+            except Exception:
+                log.exception('Failed to write metrics to %s' % self.path)
+
+    def close(self):
+        """stop exporting, the textfile gets the final values"""
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.path:
+            write_textfile(self.path)
@@ -0,0 +1,235 @@
+"""relstorage_packer - profiling of statements and phases
+
+With ``--profile`` every statement is timed per template (numbers and string
+literals replaced), each phase of the run is profiled with cProfile and a
+report is written at the end. Optionally each hot statement is sampled once
+with ``EXPLAIN (ANALYZE, BUFFERS)`` inside a savepoint which is rolled back,
+so the sample changes nothing. Only single statements in a transaction are
+sampled, without calls of functions with effects beyond the transaction
+such as advisory locks.
+"""
+from .metrics import CountingCursor
+from StringIO import StringIO
+import cProfile
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+
+EXPLAIN_AFTER = 10
+TOP_STATEMENTS = 30
+TOP_FUNCTIONS = 25
+REPORT_NAME = 'report.txt'
+
+LITERALS = re.compile(r"'[^']*'")
+NUMBERS = re.compile(r"\b\d+\b")
+WHITESPACE = re.compile(r"\s+")
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'EXECUTE')
+# effects a rollback to a savepoint does not undo
+SIDE_EFFECTS = re.compile(
+    r"\b(pg_\w*lock\w*|pg_notify|pg_export_snapshot|nextval|setval)\s*\(",
+    re.IGNORECASE
+)
+
+log = logging.getLogger("pack.profiling")
+
+
+def template(query):
+    """the query with literals and numbers replaced, whitespace collapsed"""
+    query = LITERALS.sub("'?'", query)
+    query = NUMBERS.sub('?', query)
+    return WHITESPACE.sub(' ', query).strip()
+
+
+class Profiler(object):
+    """collects statement timings, query plans and cProfile dumps per phase
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.explain = False
+        self.directory = None
+        self.lock = threading.Lock()
+        # (phase, template) -> [count, total secs, max secs]
+        self.statements = {}
+        self.counts = {}
+        self.plans = {}
+        self.phases = []
+        self.current = None
+
+    def enable(self, directory, explain=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.explain = explain
+        self.enabled = True
+
+    def record(self, query, secs):
+        tpl = template(query)
+        key = (self.current and self.current[0], tpl)
+        with self.lock:
+            entry = self.statements.setdefault(key, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += secs
+            entry[2] = max(entry[2], secs)
+            self.counts[tpl] = self.counts.get(tpl, 0) + 1
+
+    def wants_plan(self, query):
+        """True once for each template executed EXPLAIN_AFTER times"""
+        tpl = template(query)
+        with self.lock:
+            if tpl in self.plans or self.counts.get(tpl, 0) < EXPLAIN_AFTER:
+                return False
+            self.plans[tpl] = None
+        return True
+
+    def add_plan(self, query, plan):
+        with self.lock:
+            self.plans[template(query)] = plan
+
+    def start_phase(self, name):
+        """profile the phase name until the next one starts"""
+        if not self.enabled:
+            return
+        self.stop_phase()
+        profile = cProfile.Profile()
+        self.current = (name, time.time(), profile)
+        profile.enable()
+
+    def stop_phase(self):
+        if self.current is None:
+            return
+        name, start, profile = self.current
+        profile.disable()
+        path = os.path.join(self.directory, '%s.prof' % name)
+        profile.dump_stats(path)
+        self.phases.append((name, time.time() - start, path))
+        self.current = None
+
+    def _format(self):
+        out = StringIO()
+        out.write('relstorage_packer profile\n\nPhases\n')
+        for name, secs, path in self.phases:
+            out.write('  %-10s %10.2fs  %s\n' % (name, secs, path))
+
+        out.write('\nStatements by total time\n')
+        out.write('  %-10s %8s %10s %10s %10s  %s\n' % (
+            'phase', 'count', 'total s', 'mean ms', 'max ms', 'statement'
+        ))
+        entries = sorted(
+            self.statements.items(),
+            key=lambda item: item[1][1],
+            reverse=True
+        )
+        for (phase, tpl), (count, total, peak) in entries[:TOP_STATEMENTS]:
+            out.write('  %-10s %8d %10.2f %10.2f %10.2f  %s\n' % (
+                phase, count, total, total * 1000 / count, peak * 1000,
+                tpl[:200]
+            ))
+
+        plans = [(tpl, plan) for tpl, plan in self.plans.items() if plan]
+        if plans:
+            out.write('\nQuery plans\n')
+        for tpl, plan in sorted(plans):
+            out.write('\n== %s\n%s\n' % (tpl[:200], plan))
+
+        for name, secs, path in self.phases:
+            out.write('\nFunctions of phase %s by cumulative time\n' % name)
+            stats = pstats.Stats(path, stream=out)
+            stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        return out.getvalue()
+
+    def report(self):
+        """stop profiling and write the report"""
+        if not self.enabled:
+            return
+        self.stop_phase()
+        path = os.path.join(self.directory, REPORT_NAME)
+        with open(path, 'w') as report:
+            report.write(self._format())
+        log.info('Wrote profile report to %s' % path)
+
+
+profiler = Profiler()
+
+
+class ProfilingCursor(CountingCursor):
+    """cursor timing its statements per template for the profiler"""
+
+    def _timed(self, label, method, *args, **kw):
+        start = time.time()
+        try:
+            return method(*args, **kw)
+        finally:
+            profiler.record(label, time.time() - start)
+
+    def _explainable(self, query):
+        """whether query is a single statement without effects beyond a
+        savepoint, executed in a transaction
+        """
+        if self.connection.autocommit:
+            return False
+        parts = [part for part in query.split(';') if part.strip()]
+        if len(parts) != 1:
+            return False
+        if not parts[0].strip().upper().startswith(EXPLAINABLE):
+            return False
+        return SIDE_EFFECTS.search(query) is None
+
+    def _explain(self, query, vars):
+        """run query with EXPLAIN (ANALYZE, BUFFERS) in a savepoint and roll
+        back
+        """
+        execute = super(ProfilingCursor, self).execute
+        try:
+            execute('SAVEPOINT packer_explain')
+            try:
+                execute('EXPLAIN (ANALYZE, BUFFERS) ' + query.strip(), vars)
+                plan = '\n'.join([row[0] for row in self])
+            finally:
+                execute('ROLLBACK TO SAVEPOINT packer_explain')
+                execute('RELEASE SAVEPOINT packer_explain')
+        except Exception:
+            log.exception('Failed to explain %s' % template(query)[:200])
+            return
+        profiler.add_plan(query, plan)
+
+    def execute(self, query, vars=None):
+        if profiler.explain and not self.name \
+           and self._explainable(query) and profiler.wants_plan(query):
+            self._explain(query, vars)
+        return self._timed(
+            query, super(ProfilingCursor, self).execute, query, vars
+        )
+
+    def executemany(self, query, vars_list):
+        return self._timed(
+            query, super(ProfilingCursor, self).executemany, query, vars_list
+        )
+
+    def callproc(self, procname, parameters=None):
+        return self._timed(
+            'CALL %s' % procname,
+            super(ProfilingCursor, self).callproc, procname, parameters
+        )
+
+    def copy_from(self, file, table, *args, **kw):
+        return self._timed(
+            'COPY %s FROM STDIN' % table,
+            super(ProfilingCursor, self).copy_from, file, table, *args, **kw
+        )
+
+    def copy_expert(self, sql, *args, **kw):
+        return self._timed(
+            sql, super(ProfilingCursor, self).copy_expert, sql, *args, **kw
+        )
+
+    def fetchmany(self, size=None):
+        if not self.name:
+            return super(ProfilingCursor, self).fetchmany(size)
+        return self._timed(
+            'FETCH %s' % self.name,
+            super(ProfilingCursor, self).fetchmany, size
+        )
@@ -0,0 +1,115 @@
+"""relstorage_packer - streaming reader of object states"""
+from .utils import get_conn_and_cursor
+from .utils import get_read_conn_and_cursor
+import Queue
+import logging
+import threading
+
+CHUNK_SIZE = 10000
+PREFETCH_CHUNKS = 4
+
+log = logging.getLogger("pack.reader")
+
+
+def tid_range(lasttid, maxtid=None):
+    """condition on tid for the transactions after lasttid up to maxtid"""
+    if maxtid is None:
+        return 'tid > %d' % lasttid
+    return 'tid > %d AND tid <= %d' % (lasttid, maxtid)
+
+
+def states_after(lasttid, maxtid=None):
+    """statement selecting (zoid, tid, state) of all transactions after
+    lasttid (up to maxtid) ordered by tid
+    """
+    return """
+    SELECT zoid, tid, state
+    FROM object_state
+    WHERE %s
+    ORDER BY tid;
+    """ % tid_range(lasttid, maxtid)
+
+
+class StateReader(object):
+    """streams the result of a statement in chunks through a server side
+    cursor
+
+    the cursor lives on its own connection and in its own thread, up to
+    ``PREFETCH_CHUNKS`` chunks are fetched ahead while the caller works.
+    memory usage is bound by the chunk size, not by the size of a transaction.
+    with snapshot the statement reads in this exported snapshot. with dsn
+    the statement reads from that database, e.g. a streaming replica.
+    """
+
+    def __init__(self, storage, stmt, chunk_size=CHUNK_SIZE, snapshot=None,
+                 dsn=None):
+        self.stmt = stmt
+        self.chunk_size = chunk_size
+        self.snapshot = snapshot
+        if dsn is None:
+            self.connection, cursor = get_conn_and_cursor(storage)
+        else:
+            self.connection, cursor = get_read_conn_and_cursor(dsn)
+        cursor.close()
+        self.queue = Queue.Queue(maxsize=PREFETCH_CHUNKS)
+        self.stopped = False
+        self.thread = threading.Thread(target=self._read, name='reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                continue
+
+    def _read(self):
+        try:
+            if self.snapshot is not None:
+                cursor = self.connection.cursor()
+                cursor.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;"
+                )
+                cursor.execute(
+                    "SET TRANSACTION SNAPSHOT %(snapshot)s;",
+                    {'snapshot': self.snapshot}
+                )
+                cursor.close()
+            reader = self.connection.cursor('packer_reader')
+            reader.itersize = self.chunk_size
+            reader.execute(self.stmt)
+            while not self.stopped:
+                result = reader.fetchmany(self.chunk_size)
+                self._put(result)
+                if not result:
+                    break
+            reader.close()
+        except Exception, e:
+            self._put(e)
+
+    def chunks(self):
+        """iterate over lists of fetched rows"""
+        while True:
+            result = self.queue.get()
+            if isinstance(result, Exception):
+                raise result
+            if not result:
+                return
+            yield result
+
+    def rows(self):
+        """iterate over fetched rows"""
+        for result in self.chunks():
+            for row in result:
+                yield row
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        try:
+            self.connection.rollback()
+            self.connection.close()
+        except Exception:
+            log.exception('Failed to close reader connection')
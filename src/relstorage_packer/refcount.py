@@ -1,20 +1,72 @@
 """relstorage_packer - reference numinrefs process"""
+from .blobs import BlobRemover
+from .blobs import THREADS
+from .bulkinit import bulk_init
+from .connmanager import ConnectionManager
+from .connmanager import MAX_BACKEND_MEMORY
+from .connmanager import MAX_STATEMENTS
+from .cycles import SUBGRAPH_LIMIT
+from .cycles import collect_cycles
+from .cycles import init_candidates
+from .distributed import UNITS
+from .distributed import UNIT_UPDATE
+from .distributed import coordinate
+from .distributed import drop_unit
+from .distributed import init_units
+from .distributed import run_worker
+from .extract import ReferenceExtractor
+from .follow import FOLLOW_INTERVAL_SECS
+from .follow import Follower
+from .follow import uninstall_trigger
+from .maintenance import MAX_DEAD_RATIO
+from .maintenance import MAX_INDEX_BLOAT
+from .maintenance import maintain
+from .reader import StateReader
+from .reader import states_after
+from .metrics import EXPORT_INTERVAL_SECS
+from .metrics import MetricsExporter
+from .metrics import metrics
+from .metrics import use_json_logging
+from .profiling import profiler
+from .removal import BATCH_SIZE
+from .removal import COMMIT_SIZE
+from .removal import delete_refs_stmt
+from .removal import record_candidates
+from .removal import WORKERS
+from .removal import remove_orphans
+from .removal import remove_orphans_parallel
+from .schema import SCHEMA_VERSION
+from .schema import has_outrefs
+from .schema import migrate
+from .schema import schema_version
+from .serverrefs import LANGUAGES
+from .serverrefs import install
+from .serverrefs import refs_after
+from .serverrefs import server_references
+from .state import INIT_PHASES
+from .state import PHASE_ANALYZE
+from .state import PHASE_DONE
+from .state import PHASE_REMOVE
+from .state import get_state
+from .state import init_state
+from .state import save_state
+from .state import set_state
+from .throttle import Throttle
+from .trace import HAS_NUMPY
+from .trace import trace_and_sweep
+from .utils import copy_rows
 from .utils import dbcommit
-from .utils import get_conn_and_cursor
-from .utils import get_references
+from .utils import get_read_conn_and_cursor
 from .utils import get_storage
-from ZODB.utils import p64
-from psycopg2 import InterfaceError
 import datetime
 import logging
 import optparse
-import os
-import shutil
 import sys
 import time
 
 WAIT_DELAY = 1
-CYCLES_TO_RECONNECT = 5000
+WINDOW_SIZE = 100
+CHUNK_SIZE = 10000
 LOG_INTERVAL_SECS = 1
 
 log = logging.getLogger("pack")
@@ -23,324 +75,450 @@ log.setLevel(logging.INFO)
 ################################################################################
 # Locking
 
-@dbcommit
-def aquire_lock(cursor):
+def aquire_lock(conns):
     """
     try to acquire a relstorage_packer lock, if not possible log error and exit
     with 1
     """
     log.info("Acquiring relstorage_packer lock")
-    cursor.execute("SELECT pg_try_advisory_lock(23)")
-    locked = cursor.fetchone()[0]
-    if not locked:
+    if not conns.lock():
         log.error("Impossible to get relstorage_packer Lock. Exit.")
         exit(1)
 
-@dbcommit
-def release_lock(cursor):
+def release_lock(conns):
     """release relstorage_packer lock
     """
     log.info("Releasing relstorage_packer lock")
-    cursor.execute("SELECT pg_advisory_unlock(23)")
-
-
-################################################################################
-# Initialization
-
-@dbcommit
-def init_table(cursor):
-    log.info("Create table object_inrefs (drop existing).")
-    stmt = """
-    DROP TABLE IF EXISTS object_inrefs;
-    CREATE TABLE object_inrefs (
-        zoid       BIGINT NOT NULL,
-        tid        BIGINT NOT NULL CHECK (tid > 0),
-        inref      BIGINT,
-        numinrefs    BIGINT NOT NULL DEFAULT 0,
-        PRIMARY KEY(zoid, inref)
-    );
-    CREATE INDEX object_inrefs_tid  ON object_inrefs (tid);
-    CREATE INDEX object_inrefs_refs ON object_inrefs (inref);
-    CREATE INDEX object_inrefs_numinrefs ON object_inrefs (numinrefs);
-    """
-    cursor.execute(stmt)
-
-    stmt = """
-    CREATE OR REPLACE
-        FUNCTION add_inref(
-            vfrom BIGINT, vto BIGINT, vtid BIGINT
-        )
-    RETURNS void
-    AS $$
-    DECLARE
-        existing_ref boolean;
-    BEGIN
-        SELECT true
-            INTO existing_ref
-                FROM object_inrefs
-                WHERE zoid = vto AND inref = vfrom;
-        IF existing_ref THEN
-            UPDATE object_inrefs
-                SET tid = vtid
-                WHERE zoid = vto AND inref = vto;
-        ELSE
-            INSERT INTO object_inrefs VALUES(vto, vtid, vfrom, 0);
-            UPDATE object_inrefs
-                SET numinrefs = numinrefs + 1
-                WHERE zoid = vto AND inref = vto;
-        END IF;
-        RETURN;
-    END;
-    $$ LANGUAGE plpgsql;
-    """
-    cursor.execute(stmt)
-    _add_ref(cursor, 0, 0, 1)
-    _add_ref(cursor, -1, 0, 1)
+    conns.unlock()
 
 
 ################################################################################
 # Fetching of Transaction Ids to be processed
 
 def tid_boundary(cursor):
-    """get the latest handled tid from object_inrefs or 0 if table is empty
-    """
-    stmt = """
-    SELECT DISTINCT tid FROM object_inrefs ORDER BY tid DESC LIMIT 1;
+    """get the latest handled tid from packer_state
+
+    for tables created by older versions fall back to the latest tid in
+    object_refcount or 0 if table is empty
     """
-    cursor.execute(stmt)
-    if not cursor.rowcount:
-        return 0
-    (tid,) = cursor.fetchone()
+    tid = get_state(cursor)['last_tid']
+    if tid is None:
+        cursor.execute("SELECT max(tid) FROM object_refcount;")
+        (tid,) = cursor.fetchone()
+        if tid is None:
+            return 0
     log.debug("boundary transaction id to start with is: tid=%d" % tid)
     return tid
 
 
-def next_tid(cursor, lasttid):
-    """get next higher tid after given lasttid
+def changed_tids(cursor, tid):
+    """the highest tid (at least tid) and the number of transactions after
+    tid
+
+    the analysis is capped at this tid, so the number stays exact when
+    transactions are committed meanwhile. they are left to the next run.
     """
     stmt = """
-    SELECT DISTINCT tid
+    SELECT max(tid), count(DISTINCT tid)
     FROM object_state
-    WHERE tid > %d
-    ORDER BY tid ASC
-    LIMIT 1
-    """ % lasttid
+    WHERE tid > %d;
+    """ % tid
     cursor.execute(stmt)
-    if not cursor.rowcount:
-        return None
-    (tid,) = cursor.fetchone()
-    log.debug("next transaction id to process is: tid=%d" % tid)
-    return tid
+    maxtid, count = cursor.fetchone()
+    return max(maxtid or 0, tid), count or 0
 
-def changed_tids_len(cursor, tid):
-    stmt = "SELECT COUNT(distinct tid) FROM object_state WHERE tid >=%d;" % tid
-    cursor.execute(stmt)
-    (count,) = cursor.next()
-    return count or 0
+
+def read_horizon(dsn, tid):
+    """``changed_tids`` on the read database dsn, the highest tid is the
+    last one replayed there
+    """
+    connection, cursor = get_read_conn_and_cursor(dsn)
+    try:
+        return changed_tids(cursor, tid)
+    finally:
+        connection.close()
 
 
 ################################################################################
 # Creation/ update of inverse references table and counters
 
-def _add_ref(cursor, source_zoid, target_zoid, tid):
-    """insert an entry to the refcount table or update tid on existing
+def _check_removed_refs(cursor, source_zoids, collect=False,
+                        outrefs=False):
+    """remove references of the source_zoids not valid anymore
 
-    - on source_zoid there is reference to target_zoid
-    - so we have source_zoid as incoming reference on target_zoid
+    the current references of the source_zoids are staged in packer_chunk.
+    stored edges of ``object_inrefs`` with an inref of source_zoids but not in
+    the chunk are found with one anti-join, deleted and the counters of their
+    zoids decremented aggregated. with outrefs the stored edges are taken
+    from the reference arrays. if collect is set, decremented zoids are
+    recorded as cycle candidates.
     """
-    stmt = """
-    SELECT add_inref(%(source_zoid)d, %(target_zoid)d, %(tid)d);
-    """ % {'source_zoid': source_zoid, 'target_zoid': target_zoid, 'tid': tid}
-    cursor.execute(stmt)
-
-
-def _check_removed_refs(cursor, source_zoid, target_zoids):
-    """get all prior filed references of current source_zoid
-       and remove any not valid anymore, in other words if there is an entry in
-       ``object_inrefs`` with inref=source_zoid but its zoid is not in
-       target_zoids, remove it and decrement the counter for zoid.
+    not_staged = """
+        AND NOT EXISTS (
+            SELECT 1
+            FROM packer_chunk s
+            WHERE s.zoid = o.zoid
+            AND s.inref = o.inref
+        )
     """
     stmt = """
-    SELECT zoid
-    FROM object_inrefs
-    WHERE inref = %(source_zoid)s
-    AND zoid <> %(source_zoid)s;
-    """ % {'source_zoid': source_zoid}
-    cursor.execute(stmt)
-    stmt = ""
-    for zoid in cursor:
-        zoid = zoid[0]
-        if zoid in target_zoids:
-            continue
+    ANALYZE packer_chunk;
+
+    WITH gone AS (""" + delete_refs_stmt(outrefs, not_staged) + """)
+    UPDATE object_refcount o
+    SET numinrefs = o.numinrefs - g.num
+    FROM (
+        SELECT zoid, count(*) AS num
+        FROM gone
+        GROUP BY zoid
+    ) g
+    WHERE o.zoid = g.zoid
+    RETURNING o.zoid;
+    """
+    cursor.execute(stmt, {'zoids': source_zoids})
+    decremented = [zoid for (zoid,) in cursor]
+    if decremented:
         log.debug(
-            '    -> remove zoid=%d, inref=%d from object_inrefs' %
-            (zoid, source_zoid)
+            '   -> decremented counters of %d zoids' % len(decremented)
         )
-        stmt += """
-        DELETE FROM object_inrefs
-        WHERE zoid = %(zoid)s
-        AND inref = %(source_zoid)s;
-
-        UPDATE object_inrefs
-        SET numinrefs = numinrefs - 1
-        WHERE zoid = %(zoid)s
-        AND inref = %(zoid)s;
-        """ % {'source_zoid': source_zoid,
-               'zoid': zoid}
-    if stmt:
-        cursor.execute(stmt)
+    if collect and decremented:
+        record_candidates(cursor, decremented)
 
-@dbcommit
-def handle_transaction(cursor, tid, initialize):
-    """analyze a given transaction and fill inverse references
+def _create_staging(cursor):
+    """temporary tables to stage the references of a window of transactions
+    (packer_refs) and of its current chunk (packer_chunk).
+
+    rows are (zoid, inref, tid): either an edge with inref as incoming
+    reference on zoid or zoid == inref for each analyzed source zoid.
     """
-    log.debug('handle transaction %d' % tid)
-#    SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;
     stmt = """
-    BEGIN;
-    SELECT zoid, state
-    FROM object_state
-    WHERE tid = %d
-    ORDER BY zoid;
-    """ % tid
+    CREATE TEMPORARY TABLE IF NOT EXISTS packer_refs (
+        zoid       BIGINT NOT NULL,
+        inref      BIGINT NOT NULL,
+        tid        BIGINT NOT NULL
+    ) ON COMMIT DELETE ROWS;
+    CREATE TEMPORARY TABLE IF NOT EXISTS packer_chunk (
+        zoid       BIGINT NOT NULL,
+        inref      BIGINT NOT NULL,
+        tid        BIGINT NOT NULL
+    ) ON COMMIT DELETE ROWS;
+    """
     cursor.execute(stmt)
-    zoid_count = 0
-    refs_count = 0
-    # cursor is needed, so store in array
-    result = [(zoid, get_references(state)) for zoid, state in cursor]
-    for source_zoid, target_zoids in result:
-        log.debug('-> processing zoid=%d' % (source_zoid))
-        log.debug('   found %d refs' % len(target_zoids))
-        zoid_count += 1
-        _add_ref(cursor, source_zoid, source_zoid, tid)
-        for target_zoid in target_zoids:
-            refs_count += 1
-            log.debug('   -> process reference to %s' % target_zoid)
-            _add_ref(cursor, target_zoid, target_zoid, tid)
-            _add_ref(cursor, source_zoid, target_zoid, tid)
 
-        if not initialize:
-            _check_removed_refs(cursor, source_zoid, target_zoids)
 
-    # commit whole handled tid, so we are sure to have it complete in numinrefs
-    # funny part: this is multiple times faster than commit per source_zoid!
-    return {'numzoids': zoid_count, 'numrefs': refs_count}
+def _stage_refs(cursor, rows):
+    """bulk load (zoid, inref, tid) rows into the chunk table using COPY
+    """
+    copy_rows(cursor, 'packer_chunk', ('zoid', 'inref', 'tid'), rows)
 
-################################################################################
-# Removal of orphaned objects
 
-def _get_orphaned_zoid(cursor):
+def _keep_chunk(cursor):
+    """move the checked references of the chunk to the window
+
+    truncated, so the chunk table does not grow with dead rows over a window.
+    """
     stmt = """
-    SELECT zoid
-    FROM object_inrefs
-    WHERE numinrefs = 1
-    LIMIT 1;
+    INSERT INTO packer_refs (zoid, inref, tid)
+    SELECT zoid, inref, tid
+    FROM packer_chunk;
+
+    TRUNCATE packer_chunk;
     """
     cursor.execute(stmt)
-    if not cursor.rowcount:
-        return None
-    (zoid,) = cursor.fetchone()
-    log.debug("selected orphaned object: zoid=%d" % zoid)
-    return zoid
 
 
-def _remove_blob(storage, zoid):
-    if storage.blobhelper is None:
-        log.debug('-> No blobstorage available')
-        return
-    fshelper = storage.blobhelper.fshelper
-    blobpath = fshelper.getPathForOID(p64(zoid))
-    log.debug('-> Blobs for zoid=%s are at %s' % (zoid, blobpath))
-    if not os.path.exists(blobpath):
-        log.debug('-> No Blobs to remove')
-        return
-    log.debug('-> Remove Blobs')
-    shutil.rmtree(blobpath)
-    # here traversal up and removal of empty directories makes sense.
-    # otherwise there are many empty directories left.
-    # need to check side effects first!
+def _merge_refs(cursor, outrefs=False):
+    """merge staged references set-based into ``object_inrefs`` and
+    ``object_refcount``
 
-
-def _remove_zoid(cursor, zoid):
+    per window:
+    - counter rows get the latest tid they were touched by,
+    - missing counter rows are inserted with a count of 1 (self),
+    - new edges are inserted and their counters incremented aggregated,
+    - with outrefs the reference arrays of the staged zoids are replaced.
     """
-    remove a zoid completly.
-    - remove all references in object_inrefs (this includes self reference)
-    - remove entry in object_state
+    stmt = """
+    ANALYZE packer_refs;
+
+    UPDATE object_refcount o
+    SET tid = s.tid
+    FROM (
+        SELECT zoid, max(tid) AS tid
+        FROM packer_refs
+        GROUP BY zoid
+    ) s
+    WHERE o.zoid = s.zoid
+    AND o.tid <> s.tid;
+
+    INSERT INTO object_refcount (zoid, tid, numinrefs)
+    SELECT s.zoid, max(s.tid), 1
+    FROM packer_refs s
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM object_refcount o
+        WHERE o.zoid = s.zoid
+    )
+    GROUP BY s.zoid;
+
+    WITH new_edges AS (
+        INSERT INTO object_inrefs (zoid, inref, tid)
+        SELECT s.zoid, s.inref, max(s.tid)
+        FROM packer_refs s
+        WHERE s.zoid <> s.inref
+        AND NOT EXISTS (
+            SELECT 1
+            FROM object_inrefs o
+            WHERE o.zoid = s.zoid
+            AND o.inref = s.inref
+        )
+        GROUP BY s.zoid, s.inref
+        RETURNING zoid
+    )
+    UPDATE object_refcount o
+    SET numinrefs = o.numinrefs + n.num
+    FROM (
+        SELECT zoid, count(*) AS num
+        FROM new_edges
+        GROUP BY zoid
+    ) n
+    WHERE o.zoid = n.zoid;
     """
-    # handle references (remove, decrement)
+    cursor.execute(stmt)
+    if not outrefs:
+        return
     stmt = """
-    SELECT zoid, state
-    FROM object_state
-    WHERE zoid = %d;
-    """ % zoid
+    INSERT INTO object_outrefs (zoid, refs)
+    SELECT inref, COALESCE(
+        array_agg(DISTINCT zoid) FILTER (WHERE zoid <> inref),
+        '{}'
+    )
+    FROM packer_refs
+    GROUP BY inref
+    ON CONFLICT (zoid) DO UPDATE
+    SET refs = EXCLUDED.refs;
+    """
     cursor.execute(stmt)
 
-    source_zoid, state = cursor.fetchone()
-    target_zoids = get_references(state)
-    stmt = ""
-    for target_zoid in target_zoids:
-        stmt += """
-        DELETE FROM object_inrefs
-        WHERE zoid = %(target_zoid)s
-        AND inref = %(source_zoid)s;
-
-        UPDATE object_inrefs
-        SET numinrefs = numinrefs - 1
-        WHERE zoid = %(target_zoid)s
-        AND inref = %(target_zoid)s;
-        """ % {'source_zoid': source_zoid,
-               'target_zoid': target_zoid}
-
-    # finally delete data
-    stmt += """
-    DELETE FROM object_inrefs
-    WHERE zoid =  %(zoid)s;
-
-    DELETE FROM object_state
-    WHERE zoid =  %(zoid)s;
-    """ % {'zoid': zoid}
-    cursor.execute(stmt)
+
+def windows(items, window_size, chunk_size=CHUNK_SIZE):
+    """group a stream of (zoid, tid, refs) ordered by tid into windows
+
+    yields (chunk, tid, numtids): chunks of at most chunk_size items. the last
+    chunk of a window of window_size transactions comes with the last tid of
+    the window and the number of transactions in it, else these are None.
+    """
+    chunk = []
+    numtids = 0
+    last_tid = None
+    for item in items:
+        tid = item[1]
+        if tid != last_tid:
+            if numtids == window_size:
+                yield chunk, last_tid, numtids
+                chunk = []
+                numtids = 0
+            numtids += 1
+            last_tid = tid
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk, None, None
+            chunk = []
+    if numtids:
+        yield chunk, last_tid, numtids
+
+
+def handle_chunk(cursor, chunk, collect=False, outrefs=False):
+    """analyze a chunk of (zoid, tid, refs) of a window of transactions
+
+    the references are staged in bulk, they are merged set-based into
+    ``object_inrefs`` at the end of the window. references gone since the
+    prior analysis are removed immediately by one anti-join over the chunk.
+    a history free storage has one state per zoid, so a zoid is in one chunk
+    only.
+    """
+    _create_staging(cursor)
+    zoid_count = 0
+    refs_count = 0
+    rows = []
+    source_zoids = []
+    for source_zoid, tid, target_zoids in chunk:
+        log.debug('-> processing zoid=%d' % (source_zoid))
+        log.debug('   found %d refs' % len(target_zoids))
+        zoid_count += 1
+        refs_count += len(target_zoids)
+        source_zoids.append(source_zoid)
+        rows.append((source_zoid, source_zoid, tid))
+        for target_zoid in target_zoids:
+            rows.append((target_zoid, source_zoid, tid))
+    source_zoids.sort()
+    _stage_refs(cursor, rows)
+    _check_removed_refs(cursor, source_zoids, collect, outrefs)
+    _keep_chunk(cursor)
+    return {'numzoids': zoid_count, 'numrefs': refs_count}
 
 
-def remove_orphans(connection, cursor, storage):
-    """remove orphans with blobs
+@dbcommit
+def finish_window(cursor, tid, outrefs=False):
+    """merge all staged references of a window and commit.
+
+    commit whole window, so we are sure to have all its tids complete in
+    numinrefs, the boundary tid never points into a half processed window.
+    """
+    log.debug('finish window of transactions up to %d' % tid)
+    _create_staging(cursor)
+    _merge_refs(cursor, outrefs)
+    set_state(cursor, phase=PHASE_ANALYZE, last_tid=tid)
+
+def merge_units(connection, cursor, units, collect=False, outrefs=False):
+    """merge the edges staged by the units of a distributed update
 
-    do transactions in here manually, because of blobs
+    units are merged in tid order, each like a window. yields (tid, numtids,
+    numzoids, numrefs) per merged unit after its commit.
     """
-    tick = time.time()
-    count = 0
-    while True:
-        zoid = _get_orphaned_zoid(cursor)
-        if zoid is None:
-            break
-        log.debug('-> Remove orphaned with zoid=%s' % zoid)
+    for unit, high, numzoids, numrefs in units:
         try:
-            _remove_zoid(cursor, zoid)
-            cursor.close()
-            connection.commit()
+            _create_staging(cursor)
+            stmt = """
+            INSERT INTO packer_chunk (zoid, inref, tid)
+            SELECT zoid, inref, tid
+            FROM packer_refs_shared
+            WHERE unit = %(unit)s;
+            """
+            cursor.execute(stmt, {'unit': unit})
+            stmt = """
+            SELECT zoid, tid
+            FROM packer_refs_shared
+            WHERE unit = %(unit)s
+            AND zoid = inref
+            ORDER BY zoid;
+            """
+            cursor.execute(stmt, {'unit': unit})
+            sources = cursor.fetchall()
+            _check_removed_refs(
+                cursor,
+                [zoid for zoid, tid in sources],
+                collect,
+                outrefs
+            )
+            _keep_chunk(cursor)
+            drop_unit(cursor, unit)
         except:
             connection.rollback()
             raise
-        _remove_blob(storage, zoid)
-        count += 1
-
-        if (count % CYCLES_TO_RECONNECT) == 0:
-            # get a fresh connection, else postgres server may consume too
-            # much RAM .oO( sigh )
-            log.info('Refresh connection after {0} zoid cycles'.format(count))
-            connection.close()
-            connection, cursor = get_conn_and_cursor(storage)
-        else:
-            # only refresh closed cursor
-            cursor = connection.cursor()
+        finish_window(connection, cursor, high, outrefs)
+        log.debug('merged unit %d up to tid %d' % (unit, high))
+        numtids = len(set([tid for zoid, tid in sources]))
+        yield high, numtids, numzoids, numrefs
+
+def analyze(conns, storage, extractor, tid, stats, window=WINDOW_SIZE,
+            collect=False, outrefs=False, throttle=None, server_refs=False,
+            read_dsn=None, maxtid=None, stopped=None):
+    """analyze all transactions after tid (up to maxtid) window by window
+
+    with read_dsn the states are read from that database, the reference
+    tables are written on the main connection. returns the last analyzed
+    tid. stops after a window once the time budget of the throttle is used
+    up or the callable stopped returns True.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    cursor = conns.cursor
+    if server_refs:
+        reader = StateReader(
+            storage, refs_after(tid, maxtid), CHUNK_SIZE, dsn=read_dsn
+        )
+        items = server_references(reader.rows())
+    else:
+        reader = StateReader(
+            storage, states_after(tid, maxtid), CHUNK_SIZE, dsn=read_dsn
+        )
+        items = extractor.extract(reader.rows())
+    try:
+        for chunk, window_tid, numtids in windows(items, window):
+            try:
+                handle_stats = handle_chunk(cursor, chunk, collect, outrefs)
+            except:
+                conns.rollback()
+                raise
+            stats['processed_zoids'] += handle_stats['numzoids']
+            stats['processed_refs'] += handle_stats['numrefs']
+            metrics.inc('processed_zoids_total', handle_stats['numzoids'])
+            metrics.inc('processed_refs_total', handle_stats['numrefs'])
+            if window_tid is None:
+                continue
+
+            # COMMIT WINDOW OF TIDS
+            finish_window(conns.connection, cursor, window_tid, outrefs)
+            tid = window_tid
+            stats['processed_tids'] += numtids
+            metrics.inc('processed_tids_total', numtids)
+            conns.maybe_recycle()
+            cursor = conns.cursor
+
+            # Statistics
+            process_statistics(stats)
+            if throttle.expired():
+                break
+            if stopped is not None and stopped():
+                log.info('Stopped after the window up to tid %d' % tid)
+                break
+    finally:
+        reader.close()
+    return tid
+
 
+def follow(conns, storage, extractor, stats, follower, window=WINDOW_SIZE,
+           collect=False, outrefs=False, throttle=None, server_refs=False,
+           read_dsn=None):
+    """keep analyzing new transactions until the follower is stopped or the
+    time budget is used up
 
-        cursor = connection.cursor()
-        if (time.time() - tick) > 5:
-            log.info('Removed %s orphaned objects' % count)
-            tick = time.time()
-    log.info('finished removal of %s orphaned objects' % count)
-    return count
+    the packer lock is only held while analyzing, so pack runs remove
+    objects in between. with read_dsn new transactions are analyzed once
+    replayed there. returns the last analyzed tid.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    release_lock(conns)
+    tid = tid_boundary(conns.cursor)
+    log.info('Follow transactions after tid %d' % tid)
+    while not throttle.expired() and follower.wait(conns.cursor, tid):
+        if not conns.lock():
+            log.debug('Packer lock is taken, wait')
+            follower.pause()
+            continue
+        try:
+            # a pack run may have analyzed meanwhile
+            tid = tid_boundary(conns.cursor)
+            if read_dsn is None:
+                maxtid, numtids = changed_tids(conns.cursor, tid)
+            else:
+                maxtid, numtids = read_horizon(read_dsn, tid)
+            if numtids:
+                stats['overall_tids'] = stats['processed_tids'] + numtids
+                tid = analyze(
+                    conns,
+                    storage,
+                    extractor,
+                    tid,
+                    stats,
+                    window,
+                    collect,
+                    outrefs,
+                    throttle,
+                    server_refs,
+                    read_dsn,
+                    maxtid,
+                    follower.is_stopped
+                )
+        finally:
+            conns.unlock()
+        if not numtids:
+            # analyzed by a pack run meanwhile or not replayed on the read
+            # database yet
+            follower.pause()
+    log.info('Stopped following at tid %d' % tid)
+    return tid
 
 ################################################################################
 # Statistics
@@ -368,22 +546,31 @@ def process_statistics(stats, force=False):
 
     stats['tid_rate_period'] = stats['tid_delta_period'] / period
 
-    stats['tid_ratio'] = \
-        stats['processed_tids'] / float(stats['overall_tids']) * 100
+    # units of a distributed update may reach beyond the counted tids
+    stats['tid_ratio'] = 100.0
+    if stats['overall_tids'] > stats['processed_tids']:
+        stats['tid_ratio'] = \
+            stats['processed_tids'] / float(stats['overall_tids']) * 100
 
-    stats['tid_todo'] = stats['overall_tids'] - stats['processed_tids']
+    stats['tid_todo'] = max(stats['overall_tids'] - stats['processed_tids'], 0)
     stats['tid_rate'] = stats['processed_tids'] / (now - stats['start'])
 
-    stats['left'] = \
-        ((now - stats['start']) / stats['processed_tids']) * stats['tid_todo']
+    stats['left'] = 0.0
+    if stats['processed_tids']:
+        stats['left'] = ((now - stats['start']) / stats['processed_tids']) \
+            * stats['tid_todo']
 
+    metrics.set('eta_seconds', stats['left'])
     stats['left'] = datetime.timedelta(seconds=stats['left'])
 
     stats['eta'] = \
         (datetime.datetime.now() + stats['left']).strftime('%Y-%m-%d %H:%M')
     stats['etadelta'] = str(stats['left']).rsplit('.', 1)[0]
 
-    log.info(LOGLINE_TPL.format(**stats))
+    log.info(
+        LOGLINE_TPL.format(**stats),
+        extra={'metrics': metrics.snapshot()}
+    )
 
     stats['logtime'] = now
     stats['processed_tids_offset'] = stats['processed_tids']
@@ -402,6 +589,251 @@ def run(argv=sys.argv):
         action="store_true",
         help="Removes all reference counts and starts from scratch.",
     )
+    parser.add_option(
+        "--restart", dest="restart", default=False,
+        action="store_true",
+        help="With --init: start from scratch even if an interrupted "
+             "initialization could be resumed.",
+    )
+    parser.add_option(
+        "--partitions", dest="partitions", default=0, type="int",
+        help="With --init: hash partition object_inrefs into this number of "
+             "partitions, needs PostgreSQL 11 (default: 0, no partitions).",
+    )
+    parser.add_option(
+        "--outrefs", dest="outrefs", default=False,
+        action="store_true",
+        help="With --init: keep the outgoing references of each object in "
+             "the table object_outrefs, makes updates and removal cheaper, "
+             "needs PostgreSQL 9.5.",
+    )
+    parser.add_option(
+        "--migrate", dest="migrate", default=False,
+        action="store_true",
+        help="Convert reference tables of an older version in place before "
+             "packing.",
+    )
+    parser.add_option(
+        "-m", "--mode", dest="mode", default="refcount",
+        type="choice", choices=["refcount", "trace"],
+        help="Removal mode: 'refcount' removes objects without incoming "
+             "references, 'trace' removes all objects not reachable from the "
+             "root, including reference cycles, needs numpy "
+             "(default: refcount).",
+    )
+    parser.add_option(
+        "-w", "--window", dest="window", default=WINDOW_SIZE, type="int",
+        help="Number of transactions analyzed and committed at once "
+             "(default: %d)." % WINDOW_SIZE,
+    )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", default=0, type="int",
+        help="Number of worker processes extracting references from object "
+             "states (default: 0, extract in main process).",
+    )
+    parser.add_option(
+        "--server-refs", dest="server_refs", default=False,
+        action="store_true",
+        help="Extract references inside PostgreSQL with a PL/Python "
+             "function instead of fetching the object states, installs the "
+             "language and the function (needs a superuser).",
+    )
+    parser.add_option(
+        "--server-language", dest="server_language",
+        default=LANGUAGES[0], choices=LANGUAGES,
+        help="PL/Python language of --server-refs, one of %s "
+             "(default: %s)." % (', '.join(LANGUAGES), LANGUAGES[0]),
+    )
+    parser.add_option(
+        "--read-dsn", dest="read_dsn", default=None, metavar="DSN",
+        help="Read the object states of the analysis from DSN, e.g. a "
+             "streaming replica, up to its last replayed transaction. The "
+             "initialization, the reference tables and the removal stay on "
+             "the primary.",
+    )
+    parser.add_option(
+        "-b", "--batch-size", dest="batch_size", default=BATCH_SIZE,
+        type="int",
+        help="Number of orphaned objects removed by one statement "
+             "(default: %d)." % BATCH_SIZE,
+    )
+    parser.add_option(
+        "-c", "--commit-size", dest="commit_size", default=COMMIT_SIZE,
+        type="int",
+        help="Number of orphaned objects removed before a commit "
+             "(default: %d)." % COMMIT_SIZE,
+    )
+    parser.add_option(
+        "--workers", dest="workers", default=WORKERS, type="int",
+        help="Refcount mode only: number of connections removing orphans "
+             "in parallel, each claims its batches with FOR UPDATE SKIP "
+             "LOCKED (default: %d)." % WORKERS,
+    )
+    parser.add_option(
+        "--follow", dest="follow", default=False, action="store_true",
+        help="Keep running and analyze new transactions as they are "
+             "committed, no removal. The packer lock is only held while "
+             "analyzing, so pack runs remove objects in between. Stops on "
+             "SIGTERM, SIGINT or at the end of --time-budget.",
+    )
+    parser.add_option(
+        "--follow-interval", dest="follow_interval",
+        default=FOLLOW_INTERVAL_SECS, type="float", metavar="SECS",
+        help="With --follow: seconds between polls for new transactions "
+             "(default: %d)." % FOLLOW_INTERVAL_SECS,
+    )
+    parser.add_option(
+        "--follow-listen", dest="follow_listen", default=False,
+        action="store_true",
+        help="With --follow: install a trigger on object_state notifying "
+             "the packer on each commit and LISTEN for it, polls are only "
+             "the fallback.",
+    )
+    parser.add_option(
+        "--no-notify", dest="no_notify", default=False,
+        action="store_true",
+        help="Drop the trigger installed by --follow-listen from "
+             "object_state.",
+    )
+    parser.add_option(
+        "--coordinator", dest="coordinator", default=False,
+        action="store_true",
+        help="Split the analysis into units processed by this and any "
+             "number of --worker processes, merge their results.",
+    )
+    parser.add_option(
+        "--units", dest="units", default=UNITS, type="int",
+        help="With --coordinator: number of units to split the work into "
+             "(default: %d)." % UNITS,
+    )
+    parser.add_option(
+        "--worker", dest="worker", default=False, action="store_true",
+        help="Process units of a running --coordinator and exit once none "
+             "are left.",
+    )
+    parser.add_option(
+        "--max-statements", dest="max_statements", default=MAX_STATEMENTS,
+        type="int", metavar="NUM",
+        help="Recycle the database connection after NUM statements "
+             "(default: %d, 0 disables)." % MAX_STATEMENTS,
+    )
+    parser.add_option(
+        "--max-backend-memory", dest="max_backend_memory",
+        default=MAX_BACKEND_MEMORY, type="int", metavar="MB",
+        help="Recycle the database connection when its backend uses more "
+             "than MB megabytes, needs PostgreSQL 14+ and the right to read "
+             "pg_backend_memory_contexts (default: %d, 0 disables)."
+             % MAX_BACKEND_MEMORY,
+    )
+    parser.add_option(
+        "--blob-threads", dest="blob_threads", default=THREADS, type="int",
+        help="Number of threads removing blobs of removed objects "
+             "(default: %d)." % THREADS,
+    )
+    parser.add_option(
+        "--prune-blob-dirs", dest="prune_blob_dirs", default=False,
+        action="store_true",
+        help="Remove empty parent directories of removed blobs. Only safe "
+             "while no client stores blobs.",
+    )
+    parser.add_option(
+        "--collect-cycles", dest="collect_cycles", default=0, type="int",
+        metavar="NUM",
+        help="Refcount mode only: record objects which may be part of an "
+             "unreachable reference cycle and check up to NUM of them per "
+             "run (default: 0, disabled).",
+    )
+    parser.add_option(
+        "--cycle-limit", dest="cycle_limit", default=SUBGRAPH_LIMIT,
+        type="int",
+        help="Maximum number of objects explored when checking a cycle "
+             "candidate (default: %d)." % SUBGRAPH_LIMIT,
+    )
+    parser.add_option(
+        "--maintain", dest="maintain", default=False,
+        action="store_true",
+        help="Vacuum, analyze and reindex bloated tables and indexes after "
+             "the cleanup.",
+    )
+    parser.add_option(
+        "--max-dead-ratio", dest="max_dead_ratio", default=MAX_DEAD_RATIO,
+        type="float", metavar="RATIO",
+        help="With --maintain: vacuum tables with a higher share of dead "
+             "tuples, analyze tables with a higher share of changed tuples "
+             "(default: %s)." % MAX_DEAD_RATIO,
+    )
+    parser.add_option(
+        "--max-index-bloat", dest="max_index_bloat",
+        default=MAX_INDEX_BLOAT, type="float", metavar="RATIO",
+        help="With --maintain: rebuild indexes of the reference tables with "
+             "a higher share of unused space concurrently, needs PostgreSQL "
+             "12 (default: %s)." % MAX_INDEX_BLOAT,
+    )
+    parser.add_option(
+        "--time-budget", dest="time_budget", default=0, type="int",
+        metavar="SECS",
+        help="Stop cleanly after SECS seconds, the next run continues "
+             "(default: 0, unlimited).",
+    )
+    parser.add_option(
+        "--max-rate", dest="max_rate", default=0, type="int",
+        metavar="NUM",
+        help="Remove at most NUM objects per second (default: 0, "
+             "unlimited).",
+    )
+    parser.add_option(
+        "--max-blob-rate", dest="max_blob_rate", default=0, type="int",
+        metavar="BYTES",
+        help="Remove at most BYTES bytes of blobs per second (default: 0, "
+             "unlimited).",
+    )
+    parser.add_option(
+        "--max-lag", dest="max_lag", default=0, type="float",
+        metavar="SECS",
+        help="Back off while the replay lag of a replica exceeds SECS "
+             "seconds, needs PostgreSQL 10 (default: 0, disabled).",
+    )
+    parser.add_option(
+        "--max-commit-secs", dest="max_commit_secs", default=0,
+        type="float", metavar="SECS",
+        help="Back off while commits of removals take longer than SECS "
+             "seconds (default: 0, disabled).",
+    )
+    parser.add_option(
+        "--metrics-file", dest="metrics_file", default=None,
+        metavar="PATH",
+        help="Write metrics in the Prometheus text format to PATH, e.g. for "
+             "the textfile collector of the node exporter.",
+    )
+    parser.add_option(
+        "--metrics-port", dest="metrics_port", default=0, type="int",
+        metavar="PORT",
+        help="Serve metrics in the Prometheus text format on "
+             "http://127.0.0.1:PORT/metrics.",
+    )
+    parser.add_option(
+        "--metrics-interval", dest="metrics_interval",
+        default=EXPORT_INTERVAL_SECS, type="int", metavar="SECS",
+        help="Seconds between writes of the metrics file "
+             "(default: %d)." % EXPORT_INTERVAL_SECS,
+    )
+    parser.add_option(
+        "--log-format", dest="log_format", default="text",
+        type="choice", choices=["text", "json"],
+        help="Format of log lines: text or json, progress lines in json "
+             "carry all metrics (default: text).",
+    )
+    parser.add_option(
+        "--profile", dest="profile", default=None, metavar="DIR",
+        help="Time all statements per template, profile each phase with "
+             "cProfile and write a report and the profiles to DIR.",
+    )
+    parser.add_option(
+        "--profile-explain", dest="profile_explain", default=False,
+        action="store_true",
+        help="With --profile: sample each hot statement once with EXPLAIN "
+             "(ANALYZE, BUFFERS) in a savepoint which is rolled back.",
+    )
     parser.add_option(
         "-v", "--verbose", dest="verbose", default=False,
         action="store_true",
@@ -410,81 +842,251 @@ def run(argv=sys.argv):
     options, args = parser.parse_args(argv[1:])
     if len(args) != 1:
         parser.error("The name of one configuration file is required.")
+    if options.window < 1:
+        parser.error("The window size must be at least 1.")
+    if options.batch_size < 1 or options.commit_size < 1:
+        parser.error("Batch and commit size must be at least 1.")
+    if options.partitions < 0:
+        parser.error("The number of partitions must not be negative.")
+    if options.max_statements < 0 or options.max_backend_memory < 0:
+        parser.error("Connection limits must not be negative.")
+    if options.follow and options.worker:
+        parser.error("--follow and --worker exclude each other.")
+    if options.follow_interval <= 0:
+        parser.error("The follow interval must be positive.")
+    if options.no_notify and options.follow_listen:
+        parser.error("--no-notify and --follow-listen exclude each other.")
+    if options.coordinator and options.worker:
+        parser.error("--coordinator and --worker exclude each other.")
+    if not 0 < options.max_dead_ratio < 1 \
+       or not 0 < options.max_index_bloat < 1:
+        parser.error("Maintenance thresholds must be between 0 and 1.")
+    if options.units < 1:
+        parser.error("At least one unit is required.")
+    if options.server_refs and (options.coordinator or options.worker):
+        parser.error("--server-refs is not distributed.")
+    if options.read_dsn and (options.coordinator or options.worker):
+        parser.error("--read-dsn is not distributed.")
+    if options.workers < 1:
+        parser.error("At least one removal worker is required.")
+    if options.blob_threads < 1:
+        parser.error("At least one blob thread is needed.")
+    if min(options.time_budget, options.max_rate, options.max_blob_rate,
+           options.max_lag, options.max_commit_secs) < 0:
+        parser.error("Time budget, rates and back-off limits must not be "
+                     "negative.")
+    if options.mode == 'trace' and not HAS_NUMPY:
+        parser.error("Trace mode needs numpy installed.")
+    if options.metrics_interval < 1:
+        parser.error("The metrics interval must be at least 1.")
+    if options.log_format == 'json':
+        use_json_logging()
+    if options.profile_explain and not options.profile:
+        parser.error("--profile-explain needs --profile.")
+    if options.profile:
+        profiler.enable(options.profile, options.profile_explain)
     if options.verbose:
         log.setLevel(logging.DEBUG)
         log.debug("Logging in verbose mode.")
 
     log.info("Initiating packing.")
+    # the pool is forked before any connection or thread exists, children
+    # must not inherit their sockets or held locks
+    extractor = ReferenceExtractor(options.jobs)
+    exporter = MetricsExporter(
+        options.metrics_file,
+        options.metrics_port,
+        options.metrics_interval
+    )
 
     storage = get_storage(args[0])
-    connection, cursor = get_conn_and_cursor(storage)
-    aquire_lock(connection, cursor)
-    cursor = connection.cursor()
-
-    if options.initialize:
+    if options.worker:
+        # no lock, the coordinator holds it
         try:
-            init_table(connection, cursor)
-            cursor = connection.cursor()
-        except:
-            release_lock(connection, cursor)
+            run_worker(storage, extractor)
+        finally:
+            extractor.close()
             storage.close()
-            raise
+            exporter.close()
+            profiler.report()
+        return
+    conns = ConnectionManager(
+        storage,
+        options.max_statements,
+        options.max_backend_memory
+    )
+    connection, cursor = conns.connection, conns.cursor
+    aquire_lock(conns)
+
     stats = {
         'processed_tids': 0,
         'processed_zoids': 0,
         'processed_refs': 0,
     }
     stats['start'] = stats['logtime'] = time.time()
+    throttle = Throttle(
+        time_budget=options.time_budget,
+        max_rate=options.max_rate,
+        max_blob_rate=options.max_blob_rate,
+        max_lag=options.max_lag,
+        max_commit_secs=options.max_commit_secs
+    )
+    blobs = BlobRemover(
+        storage,
+        options.blob_threads,
+        throttle,
+        options.prune_blob_dirs
+    )
+    follower = None
     try:
+        init_state(connection, cursor)
+        if options.no_notify:
+            uninstall_trigger(connection, cursor)
+        if options.coordinator:
+            init_units(connection, cursor)
+        if options.server_refs:
+            install(connection, cursor, options.server_language)
         initialize = options.initialize
-        init_tid = tid = tid_boundary(cursor)
-        stats['processed_tids_offset'] = 0
+        if not initialize and get_state(cursor)['phase'] in INIT_PHASES:
+            log.info('Resume interrupted initialization.')
+            initialize = True
+        if not initialize:
+            if options.migrate:
+                migrate(connection, cursor)
+            version = schema_version(cursor)
+            if version is None:
+                raise RuntimeError(
+                    'No reference tables found, run with --init'
+                )
+            if version != SCHEMA_VERSION:
+                raise RuntimeError(
+                    'Reference tables have schema version %d, run with '
+                    '--migrate' % version
+                )
         if initialize:
-            log.info('Fetching number of all transactions from DB ...')
-        else:
+            # BULK LOAD INVERSE REFERENCES
+            profiler.start_phase('init')
+            init_stats = bulk_init(
+                connection,
+                cursor,
+                storage,
+                extractor,
+                restart=options.restart,
+                partitions=options.partitions,
+                outrefs=options.outrefs,
+                server_refs=options.server_refs,
+                units=options.units if options.coordinator else 0
+            )
+            stats['processed_zoids'] += init_stats['numzoids']
+            stats['processed_refs'] += init_stats['numrefs']
+            processing_time = time.time() - stats['start']
             log.info(
-                "Fetching number of new transactions since tid {0} "
-                "from DB ...".format(init_tid)
+                'Finished bulk load after %s (%.2fs)' %
+                (
+                    str(datetime.timedelta(seconds=processing_time)),
+                    processing_time
+                )
             )
-        stats['overall_tids'] = changed_tids_len(cursor, init_tid)
-        if initialize:
-            log.info('-> {overall_tids} transactions in DB'.format(**stats))
-        else:
-            log.info('-> {overall_tids} new transactions in DB'.format(**stats))
 
-        # BUILD/ UPDATE INVERSE REFERENCES
-        while True:
-            tid = next_tid(cursor, tid)
-            if not tid:
-                break
+        outrefs = has_outrefs(cursor)
+        collect = options.mode == 'refcount' and options.collect_cycles > 0
+        if collect:
+            init_candidates(connection, cursor)
+
+        # transactions committed meanwhile are handled in update mode
+        profiler.start_phase('analyze')
+        init_tid = tid = tid_boundary(cursor)
+        stats['processed_tids_offset'] = 0
+        log.info(
+            "Fetching number of new transactions since tid {0} "
+            "from DB ...".format(init_tid)
+        )
+        if options.read_dsn:
+            maxtid, stats['overall_tids'] = read_horizon(
+                options.read_dsn, init_tid
+            )
+            log.info('-> Read states up to tid %d replayed on the read '
+                     'database' % maxtid)
+        else:
+            maxtid, stats['overall_tids'] = changed_tids(cursor, init_tid)
+        log.info('-> {overall_tids} new transactions in DB'.format(**stats))
 
-            # BUILD/UPDATE FOR TID
-            handle_stats = handle_transaction(
+        if options.coordinator:
+            # DISTRIBUTED UPDATE OF INVERSE REFERENCES
+            units = coordinate(
                 connection,
                 cursor,
+                storage,
+                extractor,
+                UNIT_UPDATE,
                 tid,
-                initialize=initialize
+                options.units
             )
-            stats['processed_tids'] += 1
-            stats['processed_zoids'] += handle_stats['numzoids']
-            stats['processed_refs'] += handle_stats['numrefs']
-            if (stats['processed_tids'] % CYCLES_TO_RECONNECT) == 0:
-                # get a fresh connection, else postgres server may consume too
-                # much RAM .oO( sigh )
-                connection.close()
-                log.info(
-                    'Refresh connection after {processed_tids} tid '
-                    'cycles'.format(
-                        **stats
-                    )
-                )
-                connection, cursor = get_conn_and_cursor(storage)
-            else:
-                # only refresh closed cursor
-                cursor = connection.cursor()
+            for window_tid, numtids, numzoids, numrefs in merge_units(
+                connection,
+                cursor,
+                units,
+                collect,
+                outrefs
+            ):
+                tid = window_tid
+                stats['processed_tids'] += numtids
+                stats['processed_zoids'] += numzoids
+                stats['processed_refs'] += numrefs
+                metrics.inc('processed_tids_total', numtids)
+                metrics.inc('processed_zoids_total', numzoids)
+                metrics.inc('processed_refs_total', numrefs)
+                process_statistics(stats)
+                if throttle.expired():
+                    break
+
+        stopped = None
+        if options.follow:
+            # stops the catch-up below as well
+            follower = Follower(
+                storage,
+                options.follow_interval,
+                options.follow_listen
+            )
+            stopped = follower.is_stopped
 
-            # Statistics
-            process_statistics(stats)
+        # BUILD/ UPDATE INVERSE REFERENCES
+        tid = analyze(
+            conns,
+            storage,
+            extractor,
+            tid,
+            stats,
+            options.window,
+            collect,
+            outrefs,
+            throttle,
+            options.server_refs,
+            options.read_dsn,
+            maxtid,
+            stopped
+        )
+        connection, cursor = conns.connection, conns.cursor
+        if options.follow:
+            # FOLLOW NEW TRANSACTIONS, removal is left to pack runs
+            follow(
+                conns,
+                storage,
+                extractor,
+                stats,
+                follower,
+                options.window,
+                collect,
+                outrefs,
+                throttle,
+                options.server_refs,
+                options.read_dsn
+            )
+            log.info(
+                'Follow mode stopped after {processed_tids} tids, '
+                '{processed_zoids} zoids'.format(**stats)
+            )
+            return
         if stats['processed_tids']:
             process_statistics(stats, True)
         processing_time = time.time() - stats['start']
@@ -493,37 +1095,123 @@ def run(argv=sys.argv):
             (str(datetime.timedelta(seconds=processing_time)), processing_time)
         )
         cleanup_start = time.time()
+        save_state(connection, cursor, phase=PHASE_REMOVE)
 
         # REMOVE
-        removed_count = remove_orphans(connection, cursor, storage)
+        profiler.start_phase('remove')
+        removed_count = 0
+        if throttle.expired():
+            log.info('Skip cleanup phase, the time budget is used up.')
+        elif options.mode == 'trace':
+            removed_count = trace_and_sweep(
+                conns,
+                blobs,
+                tid,
+                batch_size=options.batch_size,
+                commit_size=options.commit_size,
+                throttle=throttle,
+                outrefs=outrefs
+            )
+        else:
+            if collect:
+                removed_count += collect_cycles(
+                    conns,
+                    blobs,
+                    options.collect_cycles,
+                    limit=options.cycle_limit,
+                    batch_size=options.batch_size,
+                    throttle=throttle,
+                    outrefs=outrefs
+                )
+            if options.workers > 1:
+                removed_count += remove_orphans_parallel(
+                    conns,
+                    blobs,
+                    options.workers,
+                    batch_size=options.batch_size,
+                    commit_size=options.commit_size,
+                    collect=collect,
+                    throttle=throttle,
+                    outrefs=outrefs
+                )
+            else:
+                removed_count += remove_orphans(
+                    conns,
+                    blobs,
+                    batch_size=options.batch_size,
+                    commit_size=options.commit_size,
+                    collect=collect,
+                    throttle=throttle,
+                    outrefs=outrefs
+                )
 
         processing_time = time.time() - cleanup_start
         log.info(
             'Finished cleanup phase after %s (%.2fs)' %
             (str(datetime.timedelta(seconds=processing_time)), processing_time)
         )
+
+        # MAINTAIN
+        maintenance_time = 0
+        if options.maintain and throttle.expired():
+            log.info('Skip maintenance phase, the time budget is used up.')
+        elif options.maintain:
+            profiler.start_phase('maintain')
+            maintenance_start = time.time()
+            # an open transaction of the main connection keeps VACUUM from
+            # removing the dead tuples
+            conns.reopen_if_closed()
+            conns.rollback()
+            maintain(
+                storage,
+                options.max_dead_ratio,
+                options.max_index_bloat
+            )
+            maintenance_time = time.time() - maintenance_start
+        conns.reopen_if_closed()
+        connection, cursor = conns.connection, conns.cursor
+        save_state(
+            connection,
+            cursor,
+            phase=PHASE_DONE,
+            stats={
+                'mode': 'init' if initialize else 'update',
+                'processed_tids': stats['processed_tids'],
+                'processed_zoids': stats['processed_zoids'],
+                'processed_refs': stats['processed_refs'],
+                'removed': removed_count,
+                'stopped': throttle.stopped,
+                'analysis_secs': cleanup_start - stats['start'],
+                'cleanup_secs': processing_time,
+                'maintenance_secs': maintenance_time,
+            }
+        )
     except Exception, e:
         log.error(e.message)
         raise
         exit(1)
     finally:
+        if follower is not None:
+            follower.close()
+        extractor.close()
         # check if connection is closed!
-        try:
-            cursor = connection.cursor()
-        except InterfaceError:
-            connection, cursor = get_conn_and_cursor(storage)
-        release_lock(connection, cursor)
-        connection.close()
+        conns.reopen_if_closed()
+        # a follower released the lock, a pack run may own the journal now
+        blobs.close(remove_journal=conns.locked or conns.lock())
+        release_lock(conns)
+        conns.close()
         storage.close()
+        exporter.close()
+        profiler.report()
 
-    if stats['processed_tids']:
+    if stats['processed_tids'] or stats['processed_zoids']:
         processing_time = time.time() - stats['start']
         log.info(
             "Completed in {mode}-mode: processed {processed_tids} tids, "
             "{processed_zoids} zoids, {processed_refs} refs, "
             "removed {remove_count} objects, "
             "took {processing_time} ({processing_time_secs:.2f}s) ".format(
-                mode='init' if options.initialize else 'update',
+                mode='init' if initialize else 'update',
                 remove_count=removed_count,
                 processing_time_secs=processing_time,
                 processing_time=str(
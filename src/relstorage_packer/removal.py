@@ -0,0 +1,355 @@
+"""relstorage_packer - removal of orphaned objects and their blobs"""
+from .connmanager import prepared
+from .metrics import metrics
+from .throttle import Throttle
+from psycopg2.extensions import TransactionRollbackError
+import logging
+import random
+import threading
+import time
+
+BATCH_SIZE = 1000
+COMMIT_SIZE = 10000
+WORKERS = 1
+DEADLOCK_RETRIES = 10
+RETRY_DELAY_SECS = 0.5
+IDLE_SECS = 0.2
+
+log = logging.getLogger("pack.removal")
+
+################################################################################
+# Removal of orphaned objects
+
+def get_orphaned_zoids(cursor, limit):
+    stmt = """
+    SELECT zoid
+    FROM object_refcount
+    WHERE numinrefs = 1
+    LIMIT %d;
+    """ % limit
+    cursor.execute(stmt)
+    zoids = [zoid for (zoid,) in cursor]
+    log.debug("selected %d orphaned objects" % len(zoids))
+    return zoids
+
+
+def record_candidates(cursor, zoids):
+    """record zoids with decremented counters not dropped to 1
+
+    they may be part of an unreachable reference cycle now.
+    """
+    stmt = """
+    INSERT INTO object_inrefs_candidates (zoid)
+    SELECT o.zoid
+    FROM object_refcount o
+    WHERE o.zoid = ANY(%(zoids)s::bigint[])
+    AND o.numinrefs > 1
+    ON CONFLICT (zoid) DO NOTHING;
+    """
+    cursor.execute(stmt, {'zoids': list(zoids)})
+
+
+def delete_refs_stmt(outrefs=False, condition=''):
+    """DELETE of the stored references of the zoids in parameter zoids,
+    returning the referenced zoid of each deleted edge ``o``
+
+    with outrefs the references are looked up by the primary keys of
+    object_outrefs and object_inrefs. condition restricts the edges further.
+    """
+    if outrefs:
+        return """
+        DELETE FROM object_inrefs o
+        USING (
+            SELECT unnest(refs) AS zoid, zoid AS inref
+            FROM object_outrefs
+            WHERE zoid = ANY(%(zoids)s::bigint[])
+        ) r
+        WHERE o.zoid = r.zoid
+        AND o.inref = r.inref
+        """ + condition + """
+        RETURNING o.zoid
+        """
+    return """
+        DELETE FROM object_inrefs o
+        WHERE o.inref = ANY(%(zoids)s::bigint[])
+        """ + condition + """
+        RETURNING o.zoid
+        """
+
+
+def remove_zoids(cursor, zoids, collect=False, outrefs=False):
+    """
+    remove a batch of zoids completly.
+    - remove their references in object_inrefs and decrement the counters of
+      the referenced zoids in object_refcount
+    - remove their incoming references, their counters and reference arrays
+    - remove their entries in object_state
+
+    returns the referenced zoids whose counter dropped to 1, these are the
+    next orphans. if collect is set, the other referenced zoids are recorded
+    as cycle candidates.
+
+    the counters are locked in zoid order before the update, so concurrent
+    removals decrementing shared counters do not deadlock each other.
+    """
+    params = {'zoids': list(zoids)}
+    stmt = """
+    WITH gone AS (""" + delete_refs_stmt(outrefs) + """),
+    decremented AS (
+        UPDATE object_refcount o
+        SET numinrefs = o.numinrefs - g.num
+        FROM (
+            SELECT r.zoid, n.num
+            FROM object_refcount r
+            JOIN (
+                SELECT zoid, count(*) AS num
+                FROM gone
+                GROUP BY zoid
+            ) n ON n.zoid = r.zoid
+            ORDER BY r.zoid
+            FOR UPDATE OF r
+        ) g
+        WHERE o.zoid = g.zoid
+        RETURNING o.zoid, o.numinrefs
+    )
+    SELECT zoid, numinrefs
+    FROM decremented
+    WHERE zoid <> ALL(%(zoids)s::bigint[]);
+    """
+    cursor.execute(stmt, params)
+    frontier = []
+    candidates = []
+    for zoid, numinrefs in cursor:
+        if numinrefs == 1:
+            frontier.append(zoid)
+        else:
+            candidates.append(zoid)
+    if collect and candidates:
+        record_candidates(cursor, candidates)
+
+    # finally delete data, all in one round-trip
+    tables = ['object_inrefs', 'object_refcount', 'object_state']
+    if collect:
+        tables.append('object_inrefs_candidates')
+    if outrefs:
+        tables.append('object_outrefs')
+    stmt = ''.join([
+        prepared(
+            cursor,
+            'packer_delete_%s' % table,
+            'DELETE FROM %s WHERE zoid = ANY($1::bigint[])' % table,
+            'zoids'
+        )
+        for table in tables
+    ])
+    cursor.execute(stmt, params)
+    metrics.inc('removed_objects_total', len(zoids))
+    log.debug(
+        '-> removed %d zoids, %d new orphans' % (len(zoids), len(frontier))
+    )
+    return frontier
+
+
+def remove_orphans(conns, blobs,
+                   batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE,
+                   collect=False, throttle=None, outrefs=False):
+    """remove orphans with blobs
+
+    orphans are removed in batches. referenced zoids becoming orphans by
+    removal of a batch are the frontier, they are removed next without
+    querying for orphans again. so cascading garbage is removed in one go.
+
+    the throttle paces after each commit. once its time budget is used up the
+    removed objects are committed and the rest is left to the next run.
+
+    do transactions in here manually, because of blobs: blobs are passed to
+    the blob remover only after the removal of their zoids was committed.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    cursor = conns.cursor
+    tick = time.time()
+    count = 0
+    frontier = []
+    removed = []
+    while True:
+        if throttle.expired():
+            # orphans of the frontier are found again by the next run
+            frontier = []
+        elif not frontier:
+            frontier = get_orphaned_zoids(cursor, batch_size)
+        if frontier:
+            zoids = frontier[:batch_size]
+            del frontier[:batch_size]
+            log.debug('-> Remove %d orphaned zoids' % len(zoids))
+            try:
+                frontier.extend(
+                    remove_zoids(cursor, zoids, collect, outrefs)
+                )
+            except:
+                conns.rollback()
+                raise
+            removed.extend(zoids)
+            if len(removed) < commit_size:
+                continue
+        if not removed:
+            break
+        try:
+            blobs.journal(removed)
+            commit_secs = conns.commit()
+        except:
+            conns.rollback()
+            raise
+        blobs.remove(removed)
+        count += len(removed)
+
+        conns.maybe_recycle()
+        cursor = conns.cursor
+        throttle.committed(cursor, len(removed), commit_secs)
+        removed = []
+
+        if (time.time() - tick) > 5:
+            log.info('Removed %s orphaned objects' % count)
+            tick = time.time()
+    log.info('finished removal of %s orphaned objects' % count)
+    return count
+
+
+################################################################################
+# Parallel removal
+
+def claim_orphans(cursor, limit):
+    """lock up to limit orphans not locked by other workers
+
+    rows of orphans removed or referenced meanwhile by a concurrent
+    transaction are rechecked after their lock was released and skipped.
+    """
+    stmt = """
+    SELECT zoid
+    FROM object_refcount
+    WHERE numinrefs = 1
+    LIMIT %d
+    FOR UPDATE SKIP LOCKED;
+    """ % limit
+    cursor.execute(stmt)
+    return [zoid for (zoid,) in cursor]
+
+
+def _remove_claimed(conns, blobs, batch_size, commit_size, collect,
+                    outrefs):
+    """claim and remove batches of orphans in one transaction
+
+    counters referenced from several batches are decremented by concurrent
+    workers in zoid order. locks of earlier batches of a transaction are not
+    ordered against later ones, a deadlock between workers rolls back one
+    transaction which is retried. returns the removed zoids and the duration
+    of the commit.
+    """
+    for attempt in xrange(DEADLOCK_RETRIES):
+        cursor = conns.cursor
+        removed = []
+        try:
+            while len(removed) < commit_size:
+                # orphans by decrements of this transaction are locked by it
+                zoids = claim_orphans(cursor, batch_size)
+                if not zoids:
+                    break
+                remove_zoids(cursor, zoids, collect, outrefs)
+                removed.extend(zoids)
+            blobs.journal(removed)
+            return removed, conns.commit()
+        except TransactionRollbackError, e:
+            conns.rollback()
+            log.info(
+                '-> transaction rolled back (%s), retry' %
+                str(e).splitlines()[0]
+            )
+            time.sleep(random.random() * RETRY_DELAY_SECS)
+        except:
+            conns.rollback()
+            raise
+    raise RuntimeError(
+        'Removal failed after %d rolled back transactions' %
+        DEADLOCK_RETRIES
+    )
+
+
+def _remove_worker(conns, blobs, shared, batch_size, commit_size, collect,
+                   throttle, outrefs):
+    """remove claimed orphans until no worker finds any orphans"""
+    try:
+        while not (throttle.expired() or shared['error']):
+            with shared['lock']:
+                shared['busy'] += 1
+            try:
+                removed, commit_secs = _remove_claimed(
+                    conns, blobs, batch_size, commit_size, collect, outrefs
+                )
+            finally:
+                with shared['lock']:
+                    shared['busy'] -= 1
+            if not removed:
+                # other workers may free new orphans with their commit
+                with shared['lock']:
+                    if not shared['busy']:
+                        break
+                time.sleep(IDLE_SECS)
+                continue
+            blobs.remove(removed)
+            with shared['lock']:
+                shared['count'] += len(removed)
+            conns.maybe_recycle()
+            throttle.committed(conns.cursor, len(removed), commit_secs)
+    except Exception, e:
+        log.exception('Removal worker failed')
+        shared['error'] = e
+    finally:
+        conns.close()
+
+
+def remove_orphans_parallel(conns, blobs, workers,
+                            batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE,
+                            collect=False, throttle=None, outrefs=False):
+    """remove orphans with blobs in workers threads, each on its own
+    connection
+
+    the workers claim batches of orphans with FOR UPDATE SKIP LOCKED, so no
+    orphan is removed twice and throughput scales with the cores of the
+    database. the main connection of conns is left alone.
+
+    the workers commit each batch, a transaction holds the counter locks of
+    one ordered update only and a rolled back one is cheap to retry.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    commit_size = min(commit_size, batch_size)
+    shared = {
+        'lock': threading.Lock(),
+        'busy': 0,
+        'count': 0,
+        'error': None,
+    }
+    threads = []
+    for idx in xrange(workers):
+        thread = threading.Thread(
+            target=_remove_worker,
+            name='remover-%d' % idx,
+            args=(conns.sibling(), blobs, shared, batch_size, commit_size,
+                  collect, throttle, outrefs)
+        )
+        thread.daemon = True
+        threads.append(thread)
+    log.info('Remove orphans with %d workers' % workers)
+    for thread in threads:
+        thread.start()
+    tick = time.time()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+            if (time.time() - tick) > 5:
+                log.info('Removed %s orphaned objects' % shared['count'])
+                tick = time.time()
+    if shared['error'] is not None:
+        raise shared['error']
+    log.info('finished removal of %s orphaned objects' % shared['count'])
+    return shared['count']
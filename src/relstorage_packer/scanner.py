@@ -0,0 +1,189 @@
+"""relstorage_packer - fast extraction of references from object states
+
+A ZODB state is two pickles, class metadata and object state. Only their
+persistent ids are of interest: the C unpickler skips everything else with
+``noload`` and appends the persistent ids to a list. The state is read
+through a ``cStringIO`` over the buffer from the database, without a copy.
+States compressed by zc.zlibstorage (prefix ``.z``, uncompressed ``.n``) are
+handled transparently. Pickles ``noload`` fails on are loaded completely by
+the Python unpickler, with a stub for every class.
+"""
+from ZODB.serialize import referencesf
+import cPickle
+import cStringIO
+import logging
+import pickle
+import struct
+import time
+import zlib
+
+BENCHMARK_STATES = 10000
+BENCHMARK_REPEAT = 5
+
+unpack_oid = struct.Struct('>Q').unpack
+
+log = logging.getLogger("pack.scanner")
+
+
+def _payload(state):
+    """the uncompressed pickle data of a state as buffer or string"""
+    prefix = state[:2]
+    if prefix == '.z':
+        return zlib.decompress(buffer(state, 2))
+    if prefix == '.n':
+        return buffer(state, 2)
+    return state
+
+
+def _scan(data):
+    """persistent ids of both pickles using the C unpickler"""
+    pids = []
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = pids
+    unpickler.noload()
+    unpickler.noload()
+    return pids
+
+
+class _Stub(object):
+    """stands in for every class of a pickle, takes any arguments and state
+    """
+
+    def __new__(cls, *args, **kw):
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kw):
+        pass
+
+    def __setstate__(self, state):
+        pass
+
+    def __setitem__(self, key, value):
+        pass
+
+    def append(self, value):
+        pass
+
+    def extend(self, values):
+        pass
+
+
+class _StubUnpickler(pickle.Unpickler):
+    """Python unpickler loading stubs instead of classes"""
+
+    def __init__(self, data):
+        pickle.Unpickler.__init__(self, cStringIO.StringIO(data))
+        self.pids = []
+
+    def find_class(self, module, name):
+        return _Stub
+
+    def persistent_load(self, pid):
+        self.pids.append(pid)
+
+
+def _load(data):
+    """persistent ids of both pickles by loading them completely, slow"""
+    unpickler = _StubUnpickler(data)
+    unpickler.load()
+    unpickler.load()
+    return unpickler.pids
+
+
+def get_references(state):
+    """Return the set of OIDs the given state refers to."""
+    refs = set()
+    if not state:
+        return refs
+    data = _payload(state)
+    try:
+        pids = _scan(data)
+    except Exception:
+        log.debug('Fall back to the full unpickler for an exotic pickle')
+        pids = _load(data)
+    for pid in pids:
+        # like referencesf: (oid, class) or oid, lists are weak or cross
+        # database references
+        if isinstance(pid, tuple):
+            pid = pid[0]
+        elif not isinstance(pid, str):
+            continue
+        refs.add(unpack_oid(pid)[0])
+    return refs
+
+
+def _referencesf_references(state):
+    """reference extraction of prior versions, for comparison"""
+    refs = set()
+    if state:
+        for oid in referencesf(str(state)):
+            refs.add(unpack_oid(oid)[0])
+    return refs
+
+
+################################################################################
+# Micro-benchmark
+
+class _Ref(object):
+
+    def __init__(self, zoid):
+        self.zoid = zoid
+
+
+def _persistent_id(obj):
+    if isinstance(obj, _Ref):
+        return (struct.pack('>Q', obj.zoid), None)
+    return None
+
+
+def synthetic_state(zoid, numrefs, payload_size=100):
+    """a state in the format of ZODB with numrefs persistent references"""
+    out = cStringIO.StringIO()
+    pickler = cPickle.Pickler(out, 1)
+    pickler.persistent_id = _persistent_id
+    pickler.dump((_Ref, None))
+    pickler.dump({
+        'payload': 'x' * payload_size,
+        'title': u'object %d' % zoid,
+        'children': [_Ref(zoid + idx + 1) for idx in xrange(numrefs)],
+        'parent': _Ref(max(zoid - 1, 0)),
+    })
+    return out.getvalue()
+
+
+def micro_benchmark(num=BENCHMARK_STATES, repeat=BENCHMARK_REPEAT,
+                    numrefs=5):
+    """time get_references against referencesf on synthetic states
+
+    states are passed as buffers like they come from the database. returns
+    the best seconds per variant and the states per second.
+    """
+    plain = [synthetic_state(zoid, numrefs) for zoid in xrange(num)]
+    variants = {
+        'plain': [buffer(state) for state in plain],
+        'zlib': [buffer('.z' + zlib.compress(state)) for state in plain],
+    }
+    for state in variants['plain'][:100]:
+        if get_references(state) != _referencesf_references(state):
+            raise AssertionError('Scanner and referencesf disagree')
+    result = {'states': num, 'refs_per_state': numrefs + 1}
+    functions = (
+        ('referencesf', _referencesf_references),
+        ('scanner', get_references),
+    )
+    for variant, states in sorted(variants.items()):
+        for name, func in functions:
+            if variant == 'zlib' and name == 'referencesf':
+                # referencesf knows nothing about compressed states
+                continue
+            best = None
+            for dummy in xrange(repeat):
+                start = time.time()
+                for state in states:
+                    func(state)
+                secs = time.time() - start
+                best = secs if best is None else min(best, secs)
+            key = '%s_%s' % (name, variant)
+            result[key + '_secs'] = best
+            result[key + '_per_sec'] = num / best if best else None
+    return result
@@ -0,0 +1,167 @@
+"""relstorage_packer - tables of the inverse object graph
+
+Schema version 2 keeps edges and counters apart:
+
+``object_inrefs``
+    one row per edge, zoid has an incoming reference from inref.
+
+``object_refcount``
+    one narrow row per zoid with the number of incoming references plus 1,
+    a partial index covers only the orphans (numinrefs = 1).
+
+``object_outrefs`` (optional)
+    one row per zoid with the array of its outgoing references. Prior
+    references of a zoid are a single row fetch then, the index on inref of
+    ``object_inrefs`` is not needed. Arrays may still list removed zoids,
+    these are skipped by all joins.
+
+Schema version 1 of releases up to 2.1 had the counters in ``object_inrefs``
+as rows with zoid == inref, ``migrate`` converts it in place.
+"""
+from .state import get_state
+from .state import set_state
+from .utils import table_exists
+import logging
+
+SCHEMA_VERSION = 2
+
+REFCOUNT_TABLE = """
+CREATE TABLE object_refcount (
+    zoid       BIGINT NOT NULL,
+    tid        BIGINT NOT NULL CHECK (tid > 0),
+    numinrefs  BIGINT NOT NULL DEFAULT 1
+) WITH (fillfactor = 90);
+"""
+
+REFCOUNT_INDEXES = """
+ALTER TABLE object_refcount ADD PRIMARY KEY (zoid);
+CREATE INDEX object_refcount_orphans
+    ON object_refcount (zoid)
+    WHERE numinrefs = 1;
+"""
+
+log = logging.getLogger("pack.schema")
+
+
+def schema_version(cursor):
+    """version of the existing tables, None if there are none
+    """
+    version = get_state(cursor)['schema_version']
+    if version is not None:
+        return version
+    if table_exists(cursor, 'object_refcount'):
+        return 2
+    if table_exists(cursor, 'object_inrefs'):
+        return 1
+    return None
+
+
+def drop_tables(cursor):
+    stmt = """
+    DROP FUNCTION IF EXISTS add_inref(BIGINT, BIGINT, BIGINT);
+    DROP TABLE IF EXISTS object_inrefs_candidates;
+    DROP TABLE IF EXISTS object_outrefs;
+    DROP TABLE IF EXISTS object_refcount;
+    DROP TABLE IF EXISTS object_inrefs;
+    """
+    cursor.execute(stmt)
+
+
+def has_outrefs(cursor):
+    """whether the optional table object_outrefs is kept"""
+    return table_exists(cursor, 'object_outrefs')
+
+
+def create_tables(cursor, partitions=0, outrefs=False):
+    """create the tables without primary keys and indexes
+
+    with partitions > 1 the edges are hash partitioned by zoid, this needs
+    PostgreSQL 11 or later.
+    """
+    partition_by = ''
+    if partitions > 1:
+        partition_by = 'PARTITION BY HASH (zoid)'
+    stmt = """
+    CREATE TABLE object_inrefs (
+        zoid       BIGINT NOT NULL,
+        inref      BIGINT NOT NULL,
+        tid        BIGINT NOT NULL CHECK (tid > 0)
+    ) %s;
+    """ % partition_by
+    cursor.execute(stmt)
+    cursor.execute(REFCOUNT_TABLE)
+    if outrefs:
+        stmt = """
+        CREATE TABLE object_outrefs (
+            zoid       BIGINT NOT NULL,
+            refs       BIGINT[] NOT NULL
+        );
+        """
+        cursor.execute(stmt)
+    for remainder in range(partitions if partitions > 1 else 0):
+        stmt = """
+        CREATE TABLE object_inrefs_p%(remainder)d
+        PARTITION OF object_inrefs
+        FOR VALUES WITH (MODULUS %(modulus)d, REMAINDER %(remainder)d);
+        """ % {'modulus': partitions, 'remainder': remainder}
+        cursor.execute(stmt)
+
+
+def create_indexes(cursor, outrefs=False):
+    cursor.execute("ALTER TABLE object_inrefs ADD PRIMARY KEY (zoid, inref);")
+    if outrefs:
+        cursor.execute("ALTER TABLE object_outrefs ADD PRIMARY KEY (zoid);")
+    else:
+        cursor.execute(
+            "CREATE INDEX object_inrefs_refs ON object_inrefs (inref);"
+        )
+    cursor.execute(REFCOUNT_INDEXES)
+    set_state(cursor, schema_version=SCHEMA_VERSION)
+
+
+def migrate(connection, cursor):
+    """convert object_inrefs of schema version 1 in place
+
+    the counter rows are moved to object_refcount, the counter column and its
+    index are dropped. do transactions in here manually, one transaction.
+    """
+    try:
+        version = schema_version(cursor)
+        if version is None:
+            raise RuntimeError('Nothing to migrate, run with --init')
+        if version == SCHEMA_VERSION:
+            log.info('Schema is up to date.')
+            connection.rollback()
+            return
+        log.info('Migrate schema version %d to %d.' % (version, SCHEMA_VERSION))
+        if get_state(cursor)['last_tid'] is None:
+            cursor.execute("SELECT max(tid) FROM object_inrefs;")
+            (last_tid,) = cursor.fetchone()
+            set_state(cursor, last_tid=last_tid or 0)
+        log.info('Move counters to object_refcount.')
+        cursor.execute(REFCOUNT_TABLE)
+        stmt = """
+        INSERT INTO object_refcount (zoid, tid, numinrefs)
+        SELECT zoid, tid, numinrefs
+        FROM object_inrefs
+        WHERE zoid = inref;
+        DROP INDEX IF EXISTS object_inrefs_numinrefs;
+        DROP INDEX IF EXISTS object_inrefs_tid;
+        DELETE FROM object_inrefs
+        WHERE zoid = inref;
+        ALTER TABLE object_inrefs DROP COLUMN numinrefs;
+        ALTER TABLE object_inrefs ALTER COLUMN inref SET NOT NULL;
+        DROP FUNCTION IF EXISTS add_inref(BIGINT, BIGINT, BIGINT);
+        """
+        cursor.execute(stmt)
+        log.info('Build indexes of object_refcount.')
+        cursor.execute(REFCOUNT_INDEXES)
+        set_state(cursor, schema_version=SCHEMA_VERSION)
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    log.info(
+        'Finished migration, run VACUUM ANALYZE object_inrefs to reclaim '
+        'the space of the removed counters.'
+    )
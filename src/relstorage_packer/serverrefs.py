@@ -0,0 +1,191 @@
+"""relstorage_packer - reference extraction inside PostgreSQL
+
+The PL/Python function ``relstorage_packer_refs(bytea)`` returns the zoids
+referenced by a state as ``bigint[]``, so states do not have to be sent to
+the packer. The initialization fills its load table with one
+``INSERT ... SELECT`` per range of zoids, the update streams the arrays of
+references instead of the states.
+
+The function returns NULL for pickles it fails on, these few states are
+fetched and handled by the scanner of the packer.
+"""
+from .reader import tid_range
+from .scanner import get_references
+from .utils import dbcommit
+import logging
+
+LANGUAGES = ('plpython3u', 'plpython2u', 'plpythonu')
+RANGE_SIZE = 100000
+
+# valid for Python 2 (noload of cPickle) and Python 3 (an unpickler loading
+# stubs instead of classes).
+FUNCTION = r"""
+CREATE OR REPLACE FUNCTION relstorage_packer_refs(state bytea)
+RETURNS bigint[] AS $$
+if 'scan' not in SD:
+    import struct
+    import zlib
+    try:
+        import cPickle
+        import cStringIO
+
+        def load_pids(data):
+            pids = []
+            unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+            unpickler.persistent_load = pids
+            unpickler.noload()
+            unpickler.noload()
+            return pids
+    except ImportError:
+        import io
+        import pickle
+
+        class Stub(object):
+            def __init__(self, *args, **kw):
+                pass
+
+            def __setstate__(self, state):
+                pass
+
+        class Scanner(pickle.Unpickler):
+            def find_class(self, module, name):
+                return Stub
+
+            def persistent_load(self, pid):
+                self.pids.append(pid)
+
+        def load_pids(data):
+            unpickler = Scanner(io.BytesIO(data), encoding='bytes')
+            unpickler.pids = []
+            unpickler.load()
+            unpickler.load()
+            return unpickler.pids
+
+    def scan(state):
+        if state[:2] == b'.z':
+            state = zlib.decompress(state[2:])
+        elif state[:2] == b'.n':
+            state = state[2:]
+        zoids = set()
+        for pid in load_pids(state):
+            # (oid, class) or oid, lists are weak or cross database refs
+            if isinstance(pid, tuple):
+                pid = pid[0]
+            if isinstance(pid, bytes):
+                zoids.add(struct.unpack('>Q', pid)[0])
+        return sorted(zoids)
+    SD['scan'] = scan
+try:
+    return SD['scan'](state)
+except Exception:
+    return None
+$$ LANGUAGE %s IMMUTABLE STRICT;
+"""
+
+log = logging.getLogger("pack.serverrefs")
+
+
+@dbcommit
+def install(cursor, language=LANGUAGES[0]):
+    """install the language and the function, needs a superuser"""
+    if language not in LANGUAGES:
+        raise ValueError('Unknown language %s' % language)
+    log.info('Install function relstorage_packer_refs in %s' % language)
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS %s;" % language)
+    cursor.execute(FUNCTION % language)
+
+
+def refs_after(lasttid, maxtid=None):
+    """statement selecting (zoid, tid, refs, state) of all transactions
+    after lasttid (up to maxtid) ordered by tid, state only where refs is
+    NULL
+
+    OFFSET 0 keeps the subquery, so the function runs once per state.
+    """
+    return """
+    SELECT zoid, tid, refs, CASE WHEN refs IS NULL THEN state END
+    FROM (
+        SELECT zoid, tid, state, relstorage_packer_refs(state) AS refs
+        FROM object_state
+        WHERE %s
+        OFFSET 0
+    ) s
+    ORDER BY tid;
+    """ % tid_range(lasttid, maxtid)
+
+
+def server_references(rows):
+    """(zoid, tid, refs) of rows of ``refs_after``"""
+    for zoid, tid, refs, state in rows:
+        if refs is None:
+            log.debug('-> extract references of zoid=%d locally' % zoid)
+            refs = get_references(state)
+        yield zoid, tid, refs
+
+
+def range_end(cursor, after):
+    """the zoid ending a range of RANGE_SIZE zoids after after, None for the
+    last range
+    """
+    stmt = """
+    SELECT zoid
+    FROM object_state
+    WHERE zoid > %d
+    ORDER BY zoid
+    OFFSET %d
+    LIMIT 1;
+    """ % (after, RANGE_SIZE - 1)
+    cursor.execute(stmt)
+    if not cursor.rowcount:
+        return None
+    return cursor.fetchone()[0]
+
+
+def load_range(cursor, after, end):
+    """insert the edges and self rows of a range of zoids into the load table
+
+    returns the zoids the function failed on (with self rows only), the
+    number of zoids and of references loaded.
+    """
+    condition = 'zoid > %d' % after
+    if end is not None:
+        condition += ' AND zoid <= %d' % end
+    stmt = """
+    WITH refs AS (
+        SELECT zoid, tid, relstorage_packer_refs(state) AS refs
+        FROM object_state
+        WHERE %s
+    ),
+    loaded AS (
+        INSERT INTO object_inrefs_load (zoid, inref, tid)
+        SELECT r.zoid, s.zoid, s.tid
+        FROM refs s
+        CROSS JOIN LATERAL unnest(
+            array_append(COALESCE(s.refs, '{}'), s.zoid)
+        ) AS r(zoid)
+        RETURNING zoid, inref
+    )
+    SELECT
+        (SELECT array_agg(zoid) FROM refs WHERE refs IS NULL),
+        (SELECT count(*) FROM refs),
+        (SELECT count(*) FROM loaded) - (SELECT count(*) FROM refs);
+    """ % condition
+    cursor.execute(stmt)
+    failed, zoid_count, refs_count = cursor.fetchone()
+    return failed or [], zoid_count, refs_count
+
+
+def local_edges(cursor, zoids):
+    """(zoid, inref, tid) edges of the given zoids extracted by the scanner
+    """
+    stmt = """
+    SELECT zoid, tid, state
+    FROM object_state
+    WHERE zoid = ANY(%(zoids)s::bigint[]);
+    """
+    cursor.execute(stmt, {'zoids': zoids})
+    rows = []
+    for zoid, tid, state in cursor.fetchall():
+        for ref in get_references(state):
+            rows.append((ref, zoid, tid))
+    return rows
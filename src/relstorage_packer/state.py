@@ -0,0 +1,90 @@
+"""relstorage_packer - persistent state of the packer in table packer_state
+
+A single row records the phase of the current or last run, the last fully
+analyzed tid, checkpoints of an initialization and statistics of the last
+run. So startup is cheap and an interrupted initialization can be resumed.
+"""
+from .metrics import metrics
+from .utils import dbcommit
+import json
+import logging
+
+PHASE_NEW = 'new'
+PHASE_INIT_LOAD = 'init-load'
+PHASE_INIT_BUILD = 'init-build'
+PHASE_ANALYZE = 'analyze'
+PHASE_REMOVE = 'remove'
+PHASE_DONE = 'done'
+INIT_PHASES = (PHASE_INIT_LOAD, PHASE_INIT_BUILD)
+
+COLUMNS = (
+    'phase',
+    'last_tid',
+    'init_tid',
+    'checkpoint',
+    'schema_version',
+    'stats',
+    'updated',
+)
+
+log = logging.getLogger("pack.state")
+
+
+@dbcommit
+def init_state(cursor):
+    """create the table packer_state and its row if missing"""
+    stmt = """
+    CREATE TABLE IF NOT EXISTS packer_state (
+        id          INTEGER NOT NULL PRIMARY KEY CHECK (id = 1),
+        phase       TEXT NOT NULL DEFAULT 'new',
+        last_tid    BIGINT,
+        init_tid    BIGINT,
+        checkpoint  BIGINT,
+        schema_version INTEGER,
+        stats       TEXT,
+        updated     TIMESTAMP NOT NULL DEFAULT now()
+    );
+    INSERT INTO packer_state (id)
+    SELECT 1
+    WHERE NOT EXISTS (SELECT 1 FROM packer_state);
+    """
+    cursor.execute(stmt)
+
+
+def get_state(cursor):
+    """the state as dict, stats are decoded
+    """
+    stmt = """
+    SELECT %s
+    FROM packer_state
+    WHERE id = 1;
+    """ % ', '.join(COLUMNS)
+    cursor.execute(stmt)
+    state = dict(zip(COLUMNS, cursor.fetchone()))
+    if state['stats']:
+        state['stats'] = json.loads(state['stats'])
+    return state
+
+
+def set_state(cursor, **values):
+    """update given values of the state, stats are encoded
+    """
+    for key in values:
+        if key not in COLUMNS:
+            raise ValueError('Unknown packer state %s' % key)
+    if 'stats' in values and values['stats'] is not None:
+        values['stats'] = json.dumps(values['stats'], sort_keys=True)
+    assignments = ['%s = %%(%s)s' % (key, key) for key in sorted(values)]
+    assignments.append('updated = now()')
+    stmt = """
+    UPDATE packer_state
+    SET %s
+    WHERE id = 1;
+    """ % ', '.join(assignments)
+    cursor.execute(stmt, values)
+    if 'phase' in values:
+        metrics.set_phase(values['phase'])
+    log.debug('state set to %r' % values)
+
+
+save_state = dbcommit(set_state)
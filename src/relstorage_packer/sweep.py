@@ -0,0 +1,266 @@
+"""relstorage_packer - sweep of blob directories no object refers to
+
+Blob directories left behind by crashed runs, manual deletes or other pack
+tools are never removed by the packer. The sweeper walks the blob directory
+in parallel threads (depth first, so the pending directories stay few),
+batches the zoids of the blob directories found, sorted, checks them
+against ``object_state`` with one anti-join per batch and removes the blob
+directories of missing objects with the blob remover. Memory is bound by the
+batch size, not by the number of blob directories.
+
+Blob directories changed within ``--min-age`` are skipped, in a shared blob
+directory a blob is stored before its object is committed.
+"""
+from .blobs import BlobRemover
+from .blobs import THREADS
+from .blobs import missing_zoids
+from .connmanager import ConnectionManager
+from .utils import get_storage
+from ZODB.utils import u64
+import Queue
+import errno
+import logging
+import optparse
+import os
+import sys
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+BATCH_SIZE = 10000
+MIN_AGE_SECS = 86400
+LOG_INTERVAL_SECS = 5
+
+log = logging.getLogger("pack.sweep")
+
+
+def _entries(path):
+    """(name, path, is_dir, mtime) of the entries of a directory"""
+    if scandir is not None:
+        for entry in scandir(path):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            mtime = entry.stat(follow_symlinks=False).st_mtime \
+                if is_dir else None
+            yield entry.name, entry.path, is_dir, mtime
+        return
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        is_dir = os.path.isdir(full) and not os.path.islink(full)
+        mtime = os.lstat(full).st_mtime if is_dir else None
+        yield name, full, is_dir, mtime
+
+
+class Walker(object):
+    """walks a blob directory in threads and puts (zoid, path) of the blob
+    directories older than min_age into a bounded queue, None at the end
+
+    empty directories older than min_age which are no blob directories are
+    removed unless dry_run.
+    """
+
+    def __init__(self, fshelper, threads=THREADS, min_age=MIN_AGE_SECS,
+                 dry_run=False):
+        self.fshelper = fshelper
+        self.base_dir = os.path.abspath(fshelper.base_dir)
+        self.skip = set([os.path.abspath(fshelper.temp_dir)])
+        self.min_age = min_age
+        self.dry_run = dry_run
+        self.started = time.time()
+        self.errors = 0
+        self.found = Queue.Queue(maxsize=BATCH_SIZE * 2)
+        self.dirs = Queue.LifoQueue()
+        self.dirs.put(self.base_dir)
+        self.lock = threading.Lock()
+        self.threads = []
+        for idx in range(threads):
+            thread = threading.Thread(
+                target=self._work,
+                name='blobwalker-%d' % idx
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        done = threading.Thread(target=self._wait, name='blobwalker-done')
+        done.daemon = True
+        done.start()
+
+    def _oid(self, path):
+        relpath = os.path.relpath(path, self.base_dir)
+        try:
+            return u64(self.fshelper.layout.path_to_oid(relpath))
+        except (ValueError, TypeError):
+            return None
+
+    def _old(self, mtime):
+        return self.started - mtime >= self.min_age
+
+    def _scan(self, path):
+        empty = True
+        for name, full, is_dir, mtime in _entries(path):
+            empty = False
+            if not is_dir or full in self.skip:
+                continue
+            zoid = self._oid(full)
+            if zoid is None:
+                self.dirs.put(full)
+            elif self._old(mtime):
+                self.found.put((zoid, full))
+        if empty and path != self.base_dir and self._oid(path) is None \
+           and self._old(os.lstat(path).st_mtime) and not self.dry_run:
+            try:
+                os.rmdir(path)
+                log.debug('-> Removed empty directory %s' % path)
+            except OSError, e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST,
+                                   errno.ENOENT):
+                    raise
+
+    def _work(self):
+        while True:
+            path = self.dirs.get()
+            try:
+                self._scan(path)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                log.exception('Failed to scan %s' % path)
+            finally:
+                self.dirs.task_done()
+
+    def _wait(self):
+        self.dirs.join()
+        self.found.put(None)
+
+    def batches(self, size=BATCH_SIZE):
+        """iterate over sorted lists of up to size (zoid, path)"""
+        batch = []
+        while True:
+            item = self.found.get()
+            if item is None:
+                break
+            batch.append(item)
+            if len(batch) >= size:
+                yield sorted(batch)
+                batch = []
+        if batch:
+            yield sorted(batch)
+
+
+def sweep(storage, threads=THREADS, min_age=MIN_AGE_SECS, dry_run=False,
+          batch_size=BATCH_SIZE):
+    """remove (or with dry_run only report) blob directories of zoids not in
+    object_state. returns the number of blob directories found and of
+    orphaned ones.
+
+    the removal shares the journal of the packer, it takes the packer lock.
+    """
+    blobhelper = storage.blobhelper
+    if blobhelper is None:
+        raise RuntimeError('No blob storage configured')
+    if not getattr(blobhelper, 'shared_blob_dir', True):
+        raise RuntimeError('Only a shared blob directory can be swept')
+    conns = ConnectionManager(storage)
+    if not dry_run and not conns.lock():
+        conns.close()
+        raise RuntimeError('The packer lock is held, a pack is running')
+    cursor = conns.cursor
+    walker = Walker(blobhelper.fshelper, threads, min_age, dry_run)
+    remover = None
+    found = 0
+    orphaned = 0
+    tick = time.time()
+    try:
+        if not dry_run:
+            remover = BlobRemover(storage, threads)
+        for batch in walker.batches(batch_size):
+            found += len(batch)
+            paths = dict(batch)
+            missing = missing_zoids(cursor, [zoid for zoid, path in batch])
+            orphaned += len(missing)
+            if dry_run:
+                for zoid in missing:
+                    log.info('Orphaned blobs of zoid=%d at %s' %
+                             (zoid, paths[zoid]))
+            else:
+                remover.journal(missing)
+                remover.remove(missing)
+            if (time.time() - tick) > LOG_INTERVAL_SECS:
+                log.info('Checked %d blob directories, %d orphaned' %
+                         (found, orphaned))
+                tick = time.time()
+    finally:
+        if remover is not None:
+            remover.close()
+        conns.unlock()
+        conns.close()
+    if walker.errors:
+        log.error('%d directories could not be scanned' % walker.errors)
+    log.info(
+        'Finished sweep of %d blob directories, %d %s' %
+        (found, orphaned, 'orphaned' if dry_run else 'removed')
+    )
+    return found, orphaned
+
+
+def run(argv=sys.argv):
+    parser = optparse.OptionParser(
+        description='Remove blob directories of objects which do not exist '
+                    'in a history free PostgreSQL RelStorage.',
+        usage="%prog config_file"
+    )
+    parser.add_option(
+        "-n", "--dry-run", dest="dry_run", default=False,
+        action="store_true",
+        help="Only report orphaned blob directories, remove nothing.",
+    )
+    parser.add_option(
+        "--min-age", dest="min_age", default=MIN_AGE_SECS, type="int",
+        metavar="SECS",
+        help="Skip blob directories changed within SECS seconds "
+             "(default: %d)." % MIN_AGE_SECS,
+    )
+    parser.add_option(
+        "-t", "--threads", dest="threads", default=THREADS, type="int",
+        help="Number of threads scanning and removing blob directories "
+             "(default: %d)." % THREADS,
+    )
+    parser.add_option(
+        "-b", "--batch-size", dest="batch_size", default=BATCH_SIZE,
+        type="int",
+        help="Number of blob directories checked by one query "
+             "(default: %d)." % BATCH_SIZE,
+    )
+    parser.add_option(
+        "-v", "--verbose", dest="verbose", default=False,
+        action="store_true",
+        help="More verbose output, includes debug messages.",
+    )
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("The name of one configuration file is required.")
+    if options.threads < 1 or options.batch_size < 1:
+        parser.error("Threads and batch size must be positive.")
+    if options.min_age < 0:
+        parser.error("The minimum age must not be negative.")
+    if options.verbose:
+        logging.getLogger('pack').setLevel(logging.DEBUG)
+    if scandir is None:
+        log.info('Install scandir for faster scans on Python 2.')
+    storage = get_storage(args[0])
+    try:
+        sweep(
+            storage,
+            options.threads,
+            options.min_age,
+            options.dry_run,
+            options.batch_size
+        )
+    finally:
+        storage.close()
@@ -0,0 +1,80 @@
+from relstorage_packer.benchmark import SyntheticGraph
+from relstorage_packer.benchmark import detach
+from relstorage_packer.benchmark import pack_mode
+import random
+import unittest
+
+
+class Options(object):
+    fanout = 3
+    garbage = 0.3
+    cycle_share = 0.5
+
+
+class TestSyntheticGraph(unittest.TestCase):
+
+    def test_detached_subtree(self):
+        # 0 -> 1 -> 4, 5, 6; 1 detached
+        graph = SyntheticGraph(7, 3, detached=[1])
+        self.assertEqual(graph.unreachable(), set([1, 4, 5, 6]))
+        self.assertEqual(graph.expected_removed(), 4)
+
+    def test_cycle_keeps_subtree(self):
+        graph = SyntheticGraph(7, 3, detached=[1], back={4: 1})
+        garbage = graph.unreachable()
+        self.assertEqual(garbage, set([1, 4, 5, 6]))
+        self.assertEqual(graph.refcounted(garbage), set())
+        self.assertEqual(graph.expected_removed(), 0)
+        self.assertEqual(graph.expected_removed('trace'), 4)
+        self.assertEqual(graph.expected_removed('refcount', 1), 4)
+
+    def test_detached_back_child_breaks_cycle(self):
+        graph = SyntheticGraph(7, 3, detached=[1, 4], back={4: 1})
+        self.assertEqual(graph.expected_removed(), 4)
+
+    def test_cycle_below_detached_parent(self):
+        # 0 -> 1 -> 4 -> 13; 1 and 4 detached, 13 refers back to 4
+        graph = SyntheticGraph(14, 3, detached=[1, 4], back={13: 4})
+        garbage = graph.unreachable()
+        self.assertEqual(garbage, set([1, 4, 5, 6, 13]))
+        self.assertEqual(graph.refcounted(garbage), set([1, 5, 6]))
+        self.assertEqual(graph.candidates(), [4])
+        self.assertEqual(graph.expected_removed('refcount', 1), 5)
+
+    def test_candidates_beyond_limit_wait(self):
+        graph = SyntheticGraph(
+            7, 3, detached=[1, 2], back={4: 1}, zoids=[0, 2, 1, 3, 4, 5, 6]
+        )
+        self.assertEqual(graph.candidates(), [1])
+        graph = SyntheticGraph(
+            10, 3, detached=[1, 2], back={4: 1, 7: 2},
+            zoids=[0, 2, 1, 3, 4, 5, 6, 7, 8, 9]
+        )
+        self.assertEqual(graph.candidates(), [2, 1])
+        self.assertEqual(graph.expected_removed('refcount', 1), 4)
+        self.assertEqual(graph.expected_removed('refcount', 2), 8)
+
+    def test_seeded(self):
+        detached, back = detach(random.Random(1), 40, Options())
+        self.assertEqual(
+            sorted(detached), [1, 3, 6, 10, 16, 18, 22, 25, 26, 29, 33]
+        )
+        self.assertEqual(back, {4: 1, 10: 3, 19: 6})
+        graph = SyntheticGraph(40, 3, detached, back)
+        self.assertEqual(len(graph.unreachable()), 30)
+        self.assertEqual(graph.expected_removed(), 19)
+        self.assertEqual(graph.expected_removed('trace'), 30)
+        self.assertEqual(graph.expected_removed('refcount', 1), 26)
+        self.assertEqual(graph.expected_removed('refcount', 3), 30)
+
+
+class TestPackMode(unittest.TestCase):
+
+    def test_pack_mode(self):
+        self.assertEqual(pack_mode([]), ('refcount', 0))
+        self.assertEqual(pack_mode(['--mode=trace']), ('trace', 0))
+        self.assertEqual(pack_mode(['-m', 'trace']), ('trace', 0))
+        self.assertEqual(
+            pack_mode(['--collect-cycles=50', '--jobs=4']),
+            ('refcount', 50)
+        )
@@ -0,0 +1,115 @@
+from relstorage_packer.blobs import BlobRemover
+from relstorage_packer.blobs import prune_empty_dirs
+from relstorage_packer.blobs import remove_blob
+from ZODB.utils import p64
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FSHelper(object):
+    """blob layout with one directory per zoid below a fan-out directory"""
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def getPathForOID(self, oid):
+        name = oid.encode('hex')
+        return os.path.join(self.base_dir, name[:14], name)
+
+
+class Storage(object):
+
+    def __init__(self, base_dir):
+        self.blobhelper = type('BlobHelper', (object,), {})()
+        self.blobhelper.fshelper = FSHelper(base_dir)
+
+
+class BlobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.fshelper = FSHelper(self.base_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def add_blob(self, zoid, size=10):
+        path = self.fshelper.getPathForOID(p64(zoid))
+        os.makedirs(path)
+        with open(os.path.join(path, 'blob'), 'w') as blob:
+            blob.write('x' * size)
+        return path
+
+
+class TestPruneEmptyDirs(BlobTestCase):
+
+    def test_prunes_up_to_base_dir(self):
+        path = os.path.join(self.base_dir, 'a', 'b', 'c')
+        os.makedirs(path)
+        os.rmdir(path)
+        prune_empty_dirs(self.base_dir, path)
+        self.assertEqual(os.listdir(self.base_dir), [])
+        self.assertTrue(os.path.isdir(self.base_dir))
+
+    def test_stops_at_sibling(self):
+        os.makedirs(os.path.join(self.base_dir, 'a', 'sibling'))
+        path = os.path.join(self.base_dir, 'a', 'b', 'c')
+        os.makedirs(path)
+        os.rmdir(path)
+        prune_empty_dirs(self.base_dir, path)
+        self.assertEqual(os.listdir(os.path.join(self.base_dir, 'a')),
+                         ['sibling'])
+
+    def test_gone(self):
+        path = os.path.join(self.base_dir, 'a', 'b', 'c')
+        prune_empty_dirs(self.base_dir, path)
+        self.assertEqual(os.listdir(self.base_dir), [])
+
+
+class TestRemoveBlob(BlobTestCase):
+
+    def test_remove(self):
+        path = self.add_blob(1, 10)
+        self.assertEqual(remove_blob(self.fshelper, 1), 10)
+        self.assertFalse(os.path.exists(path))
+        # parents are only pruned on request
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+        self.assertEqual(remove_blob(self.fshelper, 1), 0)
+
+    def test_prune(self):
+        path = self.add_blob(1)
+        remove_blob(self.fshelper, 1, prune=True)
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+
+class TestBlobRemover(BlobTestCase):
+
+    def journaled(self, remover):
+        with open(remover.journal_path) as journal:
+            return [int(line) for line in journal]
+
+    def test_journal_cut_down(self):
+        paths = [self.add_blob(zoid) for zoid in (1, 2, 3)]
+        remover = BlobRemover(Storage(self.base_dir), threads=2)
+        remover.journal([1, 2])
+        self.assertEqual(self.journaled(remover), [1, 2])
+        remover.journal([3])
+        remover.remove([1, 2])
+        remover.queue.join()
+        # 3 is not committed yet
+        self.assertEqual(self.journaled(remover), [3])
+        remover.remove([3])
+        remover.queue.join()
+        self.assertEqual(self.journaled(remover), [])
+        remover.close()
+        self.assertFalse(os.path.exists(remover.journal_path))
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_keep_journal_without_lock(self):
+        remover = BlobRemover(Storage(self.base_dir), threads=1)
+        remover.journal([1])
+        remover.close(remove_journal=False)
+        self.assertEqual(self.journaled(remover), [1])
@@ -0,0 +1,64 @@
+from relstorage_packer.extract import ReferenceExtractor
+from relstorage_packer.extract import _batches
+from relstorage_packer.extract import _extract_batch
+from relstorage_packer.extract import _unpack_batch
+from relstorage_packer.scanner import synthetic_state
+import unittest
+
+
+def _rows(num):
+    return [
+        (zoid, 100 + zoid // 3, buffer(synthetic_state(zoid, zoid % 4)))
+        for zoid in xrange(1, num + 1)
+    ]
+
+
+def _expected(num):
+    return [
+        (zoid, 100 + zoid // 3,
+         sorted([zoid - 1] + [zoid + idx + 1 for idx in xrange(zoid % 4)]))
+        for zoid in xrange(1, num + 1)
+    ]
+
+
+def _sorted_refs(items):
+    return [(zoid, tid, sorted(refs)) for zoid, tid, refs in items]
+
+
+class TestBatches(unittest.TestCase):
+
+    def test_batches(self):
+        rows = [(zoid, 1, buffer('x')) for zoid in xrange(5)]
+        batches = list(_batches(rows, 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(batches[0][0], (0, 1, 'x'))
+        self.assertTrue(isinstance(batches[0][0][2], str))
+
+    def test_none_state(self):
+        self.assertEqual(list(_batches([(1, 2, None)], 10)),
+                         [[(1, 2, None)]])
+
+    def test_roundtrip(self):
+        batch = [(zoid, tid, str(state)) for zoid, tid, state in _rows(7)]
+        result = list(_unpack_batch(_extract_batch(batch)))
+        self.assertEqual(_sorted_refs(result), _expected(7))
+
+
+class TestReferenceExtractor(unittest.TestCase):
+
+    def test_inline(self):
+        extractor = ReferenceExtractor(0)
+        try:
+            result = list(extractor.extract(_rows(10)))
+        finally:
+            extractor.close()
+        self.assertEqual(_sorted_refs(result), _expected(10))
+
+    def test_pool_keeps_order(self):
+        extractor = ReferenceExtractor(2, batch_size=3)
+        try:
+            result = list(extractor.extract(_rows(50)))
+        finally:
+            extractor.close()
+        self.assertEqual(_sorted_refs(result), _expected(50))
+        self.assertTrue(extractor.pool is None)
@@ -0,0 +1,89 @@
+from relstorage_packer.metrics import JsonFormatter
+from relstorage_packer.metrics import Metrics
+from relstorage_packer.metrics import _number
+from relstorage_packer.metrics import use_json_logging
+import json
+import logging
+import unittest
+
+
+class TestJsonLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers[:]
+        self.formatters = [handler.formatter for handler in self.handlers]
+        self.level = self.root.level
+
+    def tearDown(self):
+        self.root.handlers[:] = self.handlers
+        for handler, formatter in zip(self.handlers, self.formatters):
+            handler.setFormatter(formatter)
+        self.root.setLevel(self.level)
+
+    def test_existing_handlers(self):
+        handler = logging.StreamHandler()
+        self.root.handlers[:] = [handler]
+        use_json_logging()
+        self.assertEqual(self.root.handlers, [handler])
+        self.assertTrue(isinstance(handler.formatter, JsonFormatter))
+
+    def test_without_handlers(self):
+        self.root.handlers[:] = []
+        self.root.setLevel(logging.WARNING)
+        use_json_logging()
+        self.assertEqual(len(self.root.handlers), 1)
+        self.assertTrue(
+            isinstance(self.root.handlers[0].formatter, JsonFormatter)
+        )
+        self.assertEqual(self.root.level, logging.INFO)
+
+    def test_format(self):
+        record = logging.LogRecord(
+            'pack', logging.INFO, __file__, 1, 'removed %d', (5,), None
+        )
+        record.metrics = {'removed': 5}
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry['logger'], 'pack')
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['message'], 'removed 5')
+        self.assertEqual(entry['metrics'], {'removed': 5})
+
+
+class TestPrometheus(unittest.TestCase):
+
+    def test_number(self):
+        self.assertEqual(_number(3), '3')
+        self.assertEqual(_number(3L), '3')
+        self.assertEqual(_number(2 ** 70), '1180591620717411303424')
+        self.assertEqual(_number(0.25), '0.25')
+
+    def test_format(self):
+        registry = Metrics()
+        registry.inc('removed_objects_total', 5L)
+        registry.set('eta_seconds', 1.5)
+        registry.observe('commit_seconds', 0.02)
+        registry.set_phase('remove')
+        lines = registry.prometheus().splitlines()
+        self.assertTrue(
+            'relstorage_packer_removed_objects_total 5' in lines
+        )
+        self.assertTrue('relstorage_packer_eta_seconds 1.5' in lines)
+        self.assertTrue(
+            '# TYPE relstorage_packer_commit_seconds histogram' in lines
+        )
+        self.assertTrue(
+            'relstorage_packer_commit_seconds_bucket{le="0.01"} 0' in lines
+        )
+        self.assertTrue(
+            'relstorage_packer_commit_seconds_bucket{le="0.025"} 1' in lines
+        )
+        self.assertTrue(
+            'relstorage_packer_commit_seconds_bucket{le="+Inf"} 1' in lines
+        )
+        self.assertTrue('relstorage_packer_commit_seconds_count 1' in lines)
+        self.assertTrue(
+            'relstorage_packer_phase{phase="remove"} 1' in lines
+        )
+        for line in lines:
+            self.assertFalse(line.endswith('L'), line)
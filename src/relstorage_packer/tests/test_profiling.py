@@ -0,0 +1,55 @@
+from relstorage_packer.profiling import ProfilingCursor
+from relstorage_packer.profiling import template
+import unittest
+
+
+class Connection(object):
+    autocommit = False
+
+
+class Cursor(object):
+    connection = Connection()
+
+
+def explainable(query):
+    return ProfilingCursor._explainable.im_func(Cursor(), query)
+
+
+class TestTemplate(unittest.TestCase):
+
+    def test_template(self):
+        self.assertEqual(
+            template("SELECT zoid\n  FROM object_state\n"
+                     "  WHERE tid > 1234 AND name = 'x''s';"),
+            "SELECT zoid FROM object_state WHERE tid > ? AND name = '?''?';"
+        )
+
+    def test_identifiers_kept(self):
+        self.assertEqual(
+            template('EXECUTE packer_delete_object_state(%(zoids)s);'),
+            'EXECUTE packer_delete_object_state(%(zoids)s);'
+        )
+
+
+class TestExplainable(unittest.TestCase):
+
+    def test_single_statements(self):
+        self.assertTrue(explainable('SELECT 1;'))
+        self.assertTrue(explainable('  with gone AS (SELECT 1) SELECT 2'))
+        self.assertTrue(explainable('EXECUTE packer_delete_x(%(zoids)s);'))
+
+    def test_not_explainable(self):
+        self.assertFalse(explainable('ANALYZE packer_refs;'))
+        self.assertFalse(explainable('SELECT 1; SELECT 2;'))
+        self.assertFalse(explainable('TRUNCATE packer_chunk;'))
+        self.assertFalse(explainable('SELECT pg_try_advisory_lock(23);'))
+        self.assertFalse(explainable("SELECT pg_notify('x', '');"))
+        self.assertFalse(explainable("SELECT nextval('s');"))
+
+    def test_autocommit(self):
+        cursor = Cursor()
+        cursor.connection = Connection()
+        cursor.connection.autocommit = True
+        self.assertFalse(
+            ProfilingCursor._explainable.im_func(cursor, 'SELECT 1;')
+        )
@@ -0,0 +1,51 @@
+from relstorage_packer.refcount import windows
+import unittest
+
+
+def _items(tids):
+    """(zoid, tid, refs) with one zoid per entry of tids"""
+    return [(zoid, tid, []) for zoid, tid in enumerate(tids)]
+
+
+def _shape(result):
+    return [
+        ([item[0] for item in chunk], tid, numtids)
+        for chunk, tid, numtids in result
+    ]
+
+
+class TestWindows(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(list(windows([], 2)), [])
+
+    def test_windows_of_tids(self):
+        result = windows(_items([1, 1, 2, 3, 3, 3, 4]), 2)
+        self.assertEqual(_shape(result), [
+            ([0, 1, 2], 2, 2),
+            ([3, 4, 5, 6], 4, 2),
+        ])
+
+    def test_last_window_partial(self):
+        result = windows(_items([1, 2, 3]), 2)
+        self.assertEqual(_shape(result), [
+            ([0, 1], 2, 2),
+            ([2], 3, 1),
+        ])
+
+    def test_chunks_within_window(self):
+        result = windows(_items([1, 1, 1, 1, 1, 2]), 10, chunk_size=2)
+        self.assertEqual(_shape(result), [
+            ([0, 1], None, None),
+            ([2, 3], None, None),
+            ([4, 5], None, None),
+            ([], 2, 2),
+        ])
+
+    def test_window_ends_with_full_chunk(self):
+        result = windows(_items([1, 1, 2]), 1, chunk_size=2)
+        self.assertEqual(_shape(result), [
+            ([0, 1], None, None),
+            ([], 1, 1),
+            ([2], 2, 1),
+        ])
@@ -0,0 +1,61 @@
+from relstorage_packer import scanner
+from relstorage_packer.scanner import get_references
+from relstorage_packer.scanner import synthetic_state
+import cPickle
+import cStringIO
+import struct
+import unittest
+import zlib
+
+
+def _state(*pids):
+    """a state referencing the persistent ids pids"""
+    out = cStringIO.StringIO()
+    pickler = cPickle.Pickler(out, 1)
+    pickler.persistent_id = lambda obj: \
+        obj if [pid for pid in pids if pid is obj] else None
+    pickler.dump((dict, None))
+    pickler.dump({'refs': list(pids)})
+    return out.getvalue()
+
+
+class TestGetReferences(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(get_references(None), set())
+        self.assertEqual(get_references(''), set())
+
+    def test_synthetic(self):
+        state = synthetic_state(10, 3)
+        self.assertEqual(get_references(state), set([9, 11, 12, 13]))
+        self.assertEqual(get_references(buffer(state)), set([9, 11, 12, 13]))
+
+    def test_compressed(self):
+        state = synthetic_state(10, 3)
+        self.assertEqual(
+            get_references(buffer('.z' + zlib.compress(state))),
+            set([9, 11, 12, 13])
+        )
+        self.assertEqual(get_references('.n' + state), set([9, 11, 12, 13]))
+
+    def test_plain_oid_and_weak_reference(self):
+        oid = struct.pack('>Q', 7)
+        weak = ['w', (struct.pack('>Q', 8),)]
+        self.assertEqual(get_references(_state(oid, weak)), set([7]))
+
+    def test_fallback(self):
+        state = synthetic_state(10, 3)
+
+        def failing(data):
+            raise cPickle.UnpicklingError('noload failed')
+
+        original = scanner._scan
+        scanner._scan = failing
+        try:
+            self.assertEqual(get_references(state), set([9, 11, 12, 13]))
+        finally:
+            scanner._scan = original
+
+    def test_full_load_with_stubs(self):
+        state = synthetic_state(3, 2)
+        self.assertEqual(scanner._load(state), scanner._scan(state))
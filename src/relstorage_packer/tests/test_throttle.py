@@ -0,0 +1,89 @@
+from relstorage_packer import throttle
+from relstorage_packer.throttle import RateLimiter
+from relstorage_packer.throttle import Throttle
+import unittest
+
+
+class Clock(object):
+    """stands in for the time module, sleeping advances the clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time = throttle.time
+        throttle.time = self.clock
+
+    def tearDown(self):
+        throttle.time = self.time
+
+
+class TestRateLimiter(ClockTestCase):
+
+    def test_unlimited(self):
+        RateLimiter(0).consume(1000)
+        self.assertEqual(self.clock.slept, [])
+
+    def test_rate(self):
+        limiter = RateLimiter(100)
+        limiter.consume(50)
+        limiter.consume(100)
+        self.assertEqual(self.clock.slept, [0.5, 1.0])
+
+    def test_idle_time_not_saved(self):
+        limiter = RateLimiter(100)
+        limiter.consume(50)
+        self.clock.now += 10
+        limiter.consume(50)
+        self.assertEqual(self.clock.slept, [0.5, 0.5])
+
+
+class TestThrottle(ClockTestCase):
+
+    def test_no_limits(self):
+        pacer = Throttle()
+        pacer.committed(None, 1000, 100)
+        self.assertFalse(pacer.expired())
+        self.assertEqual(self.clock.slept, [])
+
+    def test_time_budget(self):
+        pacer = Throttle(time_budget=60)
+        self.assertFalse(pacer.expired())
+        self.clock.now += 60
+        self.assertTrue(pacer.expired())
+        self.assertTrue(pacer.stopped)
+
+    def test_back_off_on_slow_commits(self):
+        pacer = Throttle(max_commit_secs=1)
+        pacer.committed(None, 10, 2)
+        pacer.committed(None, 10, 2)
+        pacer.committed(None, 10, 2)
+        self.assertEqual(self.clock.slept, [1, 2, 4])
+        pacer.committed(None, 10, 0.5)
+        self.assertEqual(pacer.backoff, 0)
+        pacer.committed(None, 10, 2)
+        self.assertEqual(self.clock.slept[-1], 1)
+
+    def test_back_off_limited(self):
+        pacer = Throttle(max_commit_secs=1)
+        for dummy in range(10):
+            pacer.committed(None, 10, 2)
+        self.assertEqual(max(self.clock.slept), throttle.MAX_BACKOFF_SECS)
+
+    def test_back_off_within_time_budget(self):
+        pacer = Throttle(time_budget=3, max_commit_secs=1)
+        for dummy in range(3):
+            pacer.committed(None, 10, 2)
+        self.assertEqual(self.clock.slept, [1, 2, 0])
@@ -0,0 +1,55 @@
+from relstorage_packer.trace import HAS_NUMPY
+import unittest
+
+if HAS_NUMPY:
+    from relstorage_packer.trace import _lookup
+    from relstorage_packer.trace import _mark
+    import numpy
+
+
+def _csr(num, edges):
+    """CSR adjacency of num nodes and (source, target) edges"""
+    edges = sorted(edges)
+    counts = numpy.zeros(num, dtype=numpy.int64)
+    for source, target in edges:
+        counts[source] += 1
+    indptr = numpy.zeros(num + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=indptr[1:])
+    indices = numpy.array([target for source, target in edges],
+                          dtype=numpy.int32)
+    return indptr, indices
+
+
+@unittest.skipUnless(HAS_NUMPY, 'needs numpy')
+class TestLookup(unittest.TestCase):
+
+    def test_lookup(self):
+        nodes = numpy.array([0, 3, 7, 12], dtype=numpy.int64)
+        zoids = numpy.array([7, 0, 5, 12, 13, -1], dtype=numpy.int64)
+        self.assertEqual(list(_lookup(nodes, zoids)), [2, 0, -1, 3, -1, -1])
+
+    def test_empty_nodes(self):
+        nodes = numpy.zeros(0, dtype=numpy.int64)
+        zoids = numpy.array([1], dtype=numpy.int64)
+        self.assertEqual(list(_lookup(nodes, zoids)), [-1])
+
+
+@unittest.skipUnless(HAS_NUMPY, 'needs numpy')
+class TestMark(unittest.TestCase):
+
+    def test_reachable(self):
+        # 0 -> 1 -> 2, 3 <-> 4 unreachable cycle, 4 -> 5
+        indptr, indices = _csr(6, [(0, 1), (1, 2), (3, 4), (4, 3), (4, 5)])
+        marked = _mark(indptr, indices, numpy.array([0]))
+        self.assertEqual(list(marked), [True, True, True, False, False,
+                                        False])
+
+    def test_several_roots_and_cycles(self):
+        indptr, indices = _csr(5, [(0, 1), (1, 0), (2, 3), (3, 3)])
+        marked = _mark(indptr, indices, numpy.array([0, 3]))
+        self.assertEqual(list(marked), [True, True, False, True, False])
+
+    def test_without_edges(self):
+        indptr, indices = _csr(3, [])
+        marked = _mark(indptr, indices, numpy.array([1]))
+        self.assertEqual(list(marked), [False, True, False])
@@ -0,0 +1,122 @@
+"""relstorage_packer - throttling of a run against a live site
+
+A wall clock budget ends a run cleanly after the current commit, the next run
+continues where it stopped. Removed objects and blob bytes per second are
+limited and the run backs off while commits are slow or replicas lag behind.
+Pauses are only taken between transactions, never while holding locks.
+"""
+import logging
+import threading
+import time
+
+LAG_CHECK_SECS = 10
+BACKOFF_SECS = 1
+MAX_BACKOFF_SECS = 60
+
+log = logging.getLogger("pack.throttle")
+
+
+def replication_lag(cursor):
+    """replay lag of the slowest replica in seconds, needs PostgreSQL 10
+
+    the transaction is rolled back, so no snapshot is held while pausing.
+    """
+    stmt = """
+    SELECT COALESCE(max(EXTRACT(EPOCH FROM replay_lag)), 0)
+    FROM pg_stat_replication;
+    """
+    cursor.execute(stmt)
+    (lag,) = cursor.fetchone()
+    cursor.connection.rollback()
+    return float(lag)
+
+
+class RateLimiter(object):
+    """paces amounts to a rate per second, thread safe
+
+    the caller sleeps after consuming until the amount is due. idle time is
+    not saved up for bursts. a rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.due = 0
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate or not amount:
+            return
+        with self.lock:
+            now = time.time()
+            self.due = max(self.due, now) + amount / float(self.rate)
+            delay = self.due - now
+        time.sleep(delay)
+
+
+class Throttle(object):
+    """time budget, rate limits and back-off of a run
+
+    all limits are optional, a Throttle without arguments never pauses and
+    never expires.
+    """
+
+    def __init__(self, time_budget=0, max_rate=0, max_blob_rate=0,
+                 max_lag=0, max_commit_secs=0):
+        self.deadline = None
+        if time_budget:
+            self.deadline = time.time() + time_budget
+        self.objects = RateLimiter(max_rate)
+        self.blob_bytes = RateLimiter(max_blob_rate)
+        self.max_lag = max_lag
+        self.max_commit_secs = max_commit_secs
+        self.backoff = 0
+        self.lag_checked = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def expired(self):
+        """True once the time budget is used up"""
+        if not self.stopped and self.deadline is not None \
+           and time.time() >= self.deadline:
+            log.info('Time budget used up, the next run continues.')
+            self.stopped = True
+        return self.stopped
+
+    def _lagging(self, cursor):
+        if not self.max_lag:
+            return False
+        if not self.backoff \
+           and time.time() - self.lag_checked < LAG_CHECK_SECS:
+            return False
+        self.lag_checked = time.time()
+        lag = replication_lag(cursor)
+        if lag > self.max_lag:
+            log.info('Replication lag is %.1fs' % lag)
+            return True
+        return False
+
+    def committed(self, cursor, count, commit_secs):
+        """pace after a commit of count objects which took commit_secs
+
+        call with a fresh cursor outside of a transaction. thread safe, the
+        back-off is shared by all workers.
+        """
+        self.objects.consume(count)
+        slow = self.max_commit_secs and commit_secs > self.max_commit_secs
+        if slow:
+            log.info('Commit took %.2fs' % commit_secs)
+        with self.lock:
+            if not (self._lagging(cursor) or slow):
+                self.backoff = 0
+                return
+            self.backoff = min(max(self.backoff * 2, BACKOFF_SECS),
+                               MAX_BACKOFF_SECS)
+            delay = self.backoff
+        if self.deadline is not None:
+            delay = max(min(delay, self.deadline - time.time()), 0)
+        log.info('Back off for %.1fs' % delay)
+        time.sleep(delay)
+
+    def blob_removed(self, size):
+        """pace after removal of size bytes of blobs"""
+        self.blob_bytes.consume(size)
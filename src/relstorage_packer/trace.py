@@ -0,0 +1,262 @@
+"""relstorage_packer - mark and sweep of unreachable objects
+
+Reference counting never removes objects in unreachable reference cycles.
+Here the edges of ``object_inrefs`` are loaded into a compact CSR adjacency
+structure (arrays of node and edge indexes), everything reachable from the
+root object is marked and the rest is swept.
+"""
+from .removal import BATCH_SIZE
+from .removal import COMMIT_SIZE
+from .removal import remove_zoids
+from .scanner import get_references
+from .throttle import Throttle
+import logging
+import time
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+FETCH_SIZE = 100000
+MARK_CHUNK_SIZE = 1000000
+LOG_INTERVAL_SECS = 5
+
+log = logging.getLogger("pack.trace")
+
+################################################################################
+# Loading of the graph
+
+def _fetch_arrays(connection, name, stmt):
+    """stream rows of BIGINT columns as chunks of int64 arrays"""
+    reader = connection.cursor(name)
+    reader.itersize = FETCH_SIZE
+    reader.execute(stmt)
+    while True:
+        result = reader.fetchmany(FETCH_SIZE)
+        if not result:
+            break
+        yield numpy.array(result, dtype=numpy.int64)
+    reader.close()
+
+
+def _lookup(nodes, zoids):
+    """map zoids to node indexes, -1 for zoids not in nodes"""
+    idx = numpy.searchsorted(nodes, zoids)
+    found = idx < len(nodes)
+    found[found] = nodes[idx[found]] == zoids[found]
+    idx[~found] = -1
+    return idx
+
+
+def _load_nodes(connection):
+    """sorted array of all zoids in object_state, 8 bytes per node"""
+    chunks = [
+        chunk[:, 0] for chunk in _fetch_arrays(
+            connection,
+            'packer_trace_nodes',
+            "SELECT zoid FROM object_state ORDER BY zoid;"
+        )
+    ]
+    if not chunks:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.concatenate(chunks)
+
+
+def _load_edges(connection, nodes, outrefs=False):
+    """CSR adjacency of the edges in object_inrefs
+
+    edges are streamed ordered by source, so only the target index of an edge
+    is kept (4 bytes per edge) and one offset per node. the sources of a
+    chunk are a sorted range of nodes, their counts are added to that slice
+    only. with outrefs they are read in primary key order of object_outrefs
+    instead of sorting.
+    """
+    stmt = """
+    SELECT inref, zoid
+    FROM object_inrefs
+    ORDER BY inref;
+    """
+    if outrefs:
+        stmt = """
+        SELECT zoid, unnest(refs)
+        FROM object_outrefs
+        ORDER BY zoid;
+        """
+    itype = numpy.int32 if len(nodes) < 2 ** 31 else numpy.int64
+    counts = numpy.zeros(len(nodes), dtype=numpy.int64)
+    chunks = []
+    tick = time.time()
+    num = 0
+    for chunk in _fetch_arrays(
+        connection,
+        'packer_trace_edges',
+        stmt
+    ):
+        sources = _lookup(nodes, chunk[:, 0])
+        targets = _lookup(nodes, chunk[:, 1])
+        # edges from outside (the root) or to missing objects are irrelevant,
+        # so are stale references of object_outrefs
+        valid = (sources >= 0) & (targets >= 0)
+        sources = sources[valid]
+        if len(sources):
+            first = sources[0]
+            found = numpy.bincount(sources - first)
+            counts[first:first + len(found)] += found
+        chunks.append(targets[valid].astype(itype))
+        num += len(chunk)
+        if (time.time() - tick) > LOG_INTERVAL_SECS:
+            log.info('Loaded %d edges' % num)
+            tick = time.time()
+    indptr = numpy.zeros(len(nodes) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=indptr[1:])
+    del counts
+    if chunks:
+        indices = numpy.concatenate(chunks)
+    else:
+        indices = numpy.zeros(0, dtype=itype)
+    log.info('Loaded %d edges of %d objects' % (len(indices), len(nodes)))
+    return indptr, indices
+
+
+def _load_roots(connection, nodes, boundary):
+    """node indexes of the root object and of all objects changed after the
+    analysis, these and their references are not known in object_inrefs.
+
+    the states are streamed, only their zoids and references are kept.
+    """
+    stmt = """
+    SELECT zoid, state
+    FROM object_state
+    WHERE tid > %d;
+    """ % boundary
+    reader = connection.cursor('packer_trace_roots')
+    reader.itersize = FETCH_SIZE
+    reader.execute(stmt)
+    roots = set([0])
+    for zoid, state in reader:
+        roots.add(zoid)
+        roots.update(get_references(state))
+    reader.close()
+    if len(roots) > 1:
+        log.info(
+            '%d objects changed after analysis are handled as roots' %
+            (len(roots) - 1)
+        )
+    roots = _lookup(nodes, numpy.array(sorted(roots), dtype=numpy.int64))
+    return roots[roots >= 0]
+
+
+################################################################################
+# Mark and sweep
+
+def _mark(indptr, indices, roots):
+    """breadth first marking of all nodes reachable from roots"""
+    marked = numpy.zeros(len(indptr) - 1, dtype=numpy.bool_)
+    marked[roots] = True
+    frontier = roots
+    while len(frontier):
+        next_frontier = []
+        for pos in xrange(0, len(frontier), MARK_CHUNK_SIZE):
+            chunk = frontier[pos:pos + MARK_CHUNK_SIZE]
+            starts = indptr[chunk]
+            lengths = indptr[chunk + 1] - starts
+            total = lengths.sum()
+            if not total:
+                continue
+            # positions of all outgoing edges of the chunk in indices
+            offsets = numpy.repeat(
+                starts - numpy.cumsum(lengths) + lengths, lengths
+            )
+            offsets += numpy.arange(total)
+            targets = indices[offsets]
+            targets = numpy.unique(targets[~marked[targets]])
+            marked[targets] = True
+            next_frontier.append(targets)
+        if not next_frontier:
+            break
+        frontier = numpy.concatenate(next_frontier)
+    return marked
+
+
+def _sweep(conns, blobs, zoids, batch_size, commit_size, throttle, outrefs):
+    """remove the given unreachable zoids with the code of the orphan removal
+
+    do transactions in here manually, because of blobs
+    """
+    cursor = conns.cursor
+    tick = time.time()
+    count = 0
+    for pos in xrange(0, len(zoids), commit_size):
+        if throttle.expired():
+            break
+        removed = [int(zoid) for zoid in zoids[pos:pos + commit_size]]
+        try:
+            for bpos in xrange(0, len(removed), batch_size):
+                remove_zoids(
+                    cursor,
+                    removed[bpos:bpos + batch_size],
+                    outrefs=outrefs
+                )
+            blobs.journal(removed)
+            commit_secs = conns.commit()
+        except:
+            conns.rollback()
+            raise
+        blobs.remove(removed)
+        count += len(removed)
+
+        conns.maybe_recycle()
+        cursor = conns.cursor
+        throttle.committed(cursor, len(removed), commit_secs)
+
+        if (time.time() - tick) > LOG_INTERVAL_SECS:
+            log.info('Removed %s unreachable objects' % count)
+            tick = time.time()
+    log.info('finished removal of %s unreachable objects' % count)
+    return count
+
+
+def trace_and_sweep(conns, blobs, boundary,
+                    batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE,
+                    throttle=None, outrefs=False):
+    """mark everything reachable from the root and sweep the rest
+
+    boundary is the last tid analyzed into object_inrefs. Nodes, edges and
+    objects changed after the boundary are read in one snapshot. unreachable
+    objects left when the time budget of the throttle is used up are swept by
+    the next run.
+    """
+    if throttle is None:
+        throttle = Throttle()
+    if not HAS_NUMPY:
+        raise RuntimeError('Trace mode needs numpy installed')
+    try:
+        conns.commit()
+        conns.cursor.execute(
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;"
+        )
+        nodes = _load_nodes(conns.connection)
+        indptr, indices = _load_edges(conns.connection, nodes, outrefs)
+        roots = _load_roots(conns.connection, nodes, boundary)
+        if len(nodes) and not len(roots):
+            raise RuntimeError('Root object is missing, refusing to sweep')
+        conns.commit()
+    except:
+        conns.rollback()
+        raise
+    marked = _mark(indptr, indices, roots)
+    del indptr, indices
+    zoids = nodes[~marked]
+    del nodes, marked
+    log.info('Found %d unreachable objects' % len(zoids))
+    return _sweep(
+        conns,
+        blobs,
+        zoids,
+        batch_size,
+        commit_size,
+        throttle,
+        outrefs
+    )
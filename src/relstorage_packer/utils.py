@@ -1,8 +1,12 @@
+from .metrics import CountingCursor
+from .metrics import metrics
+from .profiling import ProfilingCursor
+from .profiling import profiler
 import logging
+import psycopg2
+import time
 from StringIO import StringIO
 import ZConfig
-from ZODB.serialize import referencesf
-from ZODB.utils import u64
 
 log = logging.getLogger("utils")
 
@@ -15,16 +19,13 @@ schema_xml = """
 """
 
 def dbcommit(func):
-    """decorator with save commit
-
-    closes cursor!
+    """decorator with save commit, the cursor stays usable
     """
 
     def _wrapper(connection, cursor, *args, **kw):
         try:
             result = func(cursor, *args, **kw)
-            cursor.close()
-            connection.commit()
+            timed_commit(connection)
         except:
             connection.rollback()
             raise
@@ -49,17 +50,53 @@ def get_storage(config_file):
         raise RuntimeError('Only PostgreSQL databases are supported')
     return storage
 
+def timed_commit(connection):
+    """commit and return its duration, recorded in the metrics"""
+    start = time.time()
+    connection.commit()
+    secs = time.time() - start
+    metrics.inc('db_roundtrips_total')
+    metrics.observe('commit_seconds', secs)
+    return secs
+
 def get_conn_and_cursor(storage):
     adapter = storage._adapter
-    return adapter.connmanager.open()
+    connection, cursor = adapter.connmanager.open()
+    cursor.close()
+    return _counted(connection)
+
+def get_read_conn_and_cursor(dsn):
+    """a read only connection to dsn, e.g. a streaming replica"""
+    connection = psycopg2.connect(dsn)
+    connection.set_session(readonly=True)
+    return _counted(connection)
 
-def get_cursor(connection):
-    return connection.cursor()
+def _counted(connection):
+    # count round-trips of all cursors of the connection, with profiling
+    # also time them
+    if profiler.enabled:
+        connection.cursor_factory = ProfilingCursor
+    else:
+        connection.cursor_factory = CountingCursor
+    return connection, connection.cursor()
 
-def get_references(state):
-    """Return the set of OIDs the given state refers to."""
-    refs = set()
-    if state:
-        for oid in referencesf(str(state)):
-            refs.add(u64(oid))
-    return refs
+def table_exists(cursor, name):
+    stmt = """
+    SELECT 1
+    FROM pg_tables
+    WHERE tablename = %(name)s;
+    """
+    cursor.execute(stmt, {'name': name})
+    return bool(cursor.rowcount)
+
+def copy_rows(cursor, table, columns, rows):
+    """bulk load rows of integers into table using COPY
+    """
+    if not rows:
+        return
+    data = StringIO()
+    line = '\t'.join(['%d'] * len(columns)) + '\n'
+    for row in rows:
+        data.write(line % row)
+    data.seek(0)
+    cursor.copy_from(data, table, columns=columns)